@@ -13,6 +13,7 @@ from .context_managers import open_output_device as _open_output_device
     playing the audio back."""
 
 __all__ = ["record_audio",
+           "stream_audio",
            "play_audio"]
 
 # buffer size
@@ -51,6 +52,31 @@ def record_audio(time, device=None):
     return frames, _RATE
 
 
+def stream_audio(time, device=None):
+    """ Stream the input audio, one buffer at a time, as it is recorded.
+
+        The input device is closed once `time` seconds have been recorded,
+        or once the consumer stops iterating.
+
+        Parameters
+        ----------
+        time : float
+            The maximum amount of time, in seconds, to record for.
+
+        device : Optional[Dict[str, str]]
+            {name : device name,
+            index: device index from config prompt}
+
+        Yields
+        ------
+        bytes
+            The bytes for the next `_CHUNK` frames of the recorded signal, sampled
+            at `_RATE`."""
+    with _open_input_device(device) as mic:
+        for i in range(0, int(_RATE / _CHUNK * time)):
+            yield mic.read(_CHUNK)
+
+
 def play_audio(frames, time):
     """ Play an audio stream.
 
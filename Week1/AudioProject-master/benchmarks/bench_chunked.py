@@ -0,0 +1,95 @@
+""" Reports the time taken, and the peak memory used, to find the spectrogram peaks of
+a long audio file, when it is decoded whole versus a block at a time.
+
+A synthetic track of `--minutes` is written to a temporary .wav file, at
+`--sample-rate` (resampling it to 44.1 kHz is part of decoding it). Each way of
+decoding it is measured in a fresh process, whose peak resident memory is reported
+(see `resource.getrusage`); the peaks that they find are compared too.
+
+    python benchmarks/bench_chunked.py --minutes 60
+"""
+
+import argparse
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+from typing import Optional
+
+import numpy as np
+
+from bench_cutoff import synthetic_track
+
+SEGMENT = 30.0
+
+
+def write_track(path: str, minutes: float, fs: int):
+    import soundfile
+
+    with soundfile.SoundFile(path, "w", fs, 2, "PCM_16") as f:
+        for n in range(int(np.ceil(minutes * 60 / SEGMENT))):
+            segment = synthetic_track(SEGMENT, fs, seed=n)
+            segment = 0.9 * segment / np.abs(segment).max()
+            f.write(np.stack([segment, segment], axis=1))
+
+
+def measure(path: str, block_size: Optional[int]):
+    """ Finds the file's peaks, decoding it whole if `block_size` is `None`."""
+    from songfp.cache import AudioCache
+    from songfp.chunked import file_peaks
+
+    start = time.perf_counter()
+    if block_size is None:
+        cache = AudioCache(enabled=False, stream_seconds=float("inf"))
+        peaks = cache.load_peaks(path)
+    else:
+        peaks = file_peaks(path, block_size=block_size)
+    elapsed = time.perf_counter() - start
+    # kilobytes on Linux, bytes on macOS
+    scale = 1 if os.uname().sysname == "Darwin" else 2 ** 10
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2 ** 20
+    return peaks, elapsed, peak_mb
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--minutes", type=float, default=60.0)
+    parser.add_argument("--sample-rate", type=int, default=48000)
+    parser.add_argument("--block-size", type=int, nargs="+", default=[2 ** 16, 2 ** 18])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "track.wav")
+        write_track(path, args.minutes, args.sample_rate)
+        print(
+            "{:.0f} minutes, {:.0f} MB on disk".format(
+                args.minutes, os.path.getsize(path) / 2 ** 20
+            )
+        )
+
+        # each measurement runs in a fresh process, so that peak memory is its own
+        context = multiprocessing.get_context("spawn")
+        runs = [("whole", None)]
+        runs += [("blocks of {}".format(b), b) for b in args.block_size]
+        print(
+            "{:<18} {:>9} {:>8} {:>8} {:>10}".format(
+                "decode", "peaks", "s", "peak MB", "identical"
+            )
+        )
+        reference = None
+        for label, block_size in runs:
+            with context.Pool(1) as pool:
+                peaks, elapsed, peak_mb = pool.apply(measure, (path, block_size))
+            if reference is None:
+                reference = peaks
+            identical = len(peaks) == len(reference) and (peaks == reference).all()
+            print(
+                "{:<18} {:>9} {:>8.1f} {:>8.0f} {:>10}".format(
+                    label, len(peaks), elapsed, peak_mb, str(identical)
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+""" Benchmarks the spectrogram-cutoff step of `songfp.functions.digital_to_spec`.
+
+Compares the original full sort against selection (`spectrogram_cutoff`) and
+against the streaming histogram (`CutoffSketch`), on a synthetic track.
+
+    python benchmarks/bench_cutoff.py --duration 240
+"""
+
+import argparse
+import timeit
+
+import numpy as np
+
+from songfp.functions import CutoffSketch, digital_to_spec, spectrogram_cutoff
+
+
+def synthetic_track(duration: float, fs: int = 44100, seed: int = 0) -> np.ndarray:
+    """ A mixture of random tone bursts and noise, in [-1, 1]."""
+    rng = np.random.RandomState(seed)
+    t = np.arange(int(duration * fs)) / fs
+    digital = 0.01 * rng.randn(len(t))
+    for start in rng.uniform(0, duration, size=int(4 * duration)):
+        burst = (t >= start) & (t < start + rng.uniform(0.1, 0.5))
+        digital[burst] += 0.2 * np.sin(2 * np.pi * rng.uniform(100, 5000) * t[burst])
+    return digital / np.abs(digital).max()
+
+
+def sort_cutoff(log_spectrogram: np.ndarray, frac_cut: float) -> float:
+    """ The cutoff as originally computed by `digital_to_spec`."""
+    a = np.sort(log_spectrogram.flatten())
+    return a[int(len(a) * frac_cut)]
+
+
+def sketch_cutoff(log_spectrogram: np.ndarray, frac_cut: float, block: int = 64):
+    """ The streaming cutoff estimate, fed `block` columns at a time."""
+    sketch = CutoffSketch(frac_cut)
+    for n in range(0, log_spectrogram.shape[1], block):
+        sketch.update(log_spectrogram[:, n : n + block])
+    return sketch.cutoff()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--duration", type=float, default=240.0, help="seconds of audio")
+    parser.add_argument("--frac-cut", type=float, default=0.77)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    S, _ = digital_to_spec(synthetic_track(args.duration), 44100, args.frac_cut)
+    print(
+        "spectrogram: {} x {} ({:.1f} MB)".format(*S.shape, S.nbytes / 1e6)
+    )
+
+    exact = sort_cutoff(S, args.frac_cut)
+    for name, func in [
+        ("np.sort (original)", sort_cutoff),
+        ("np.partition", spectrogram_cutoff),
+        ("CutoffSketch", sketch_cutoff),
+    ]:
+        cutoff = func(S, args.frac_cut)
+        best = min(
+            timeit.repeat(lambda: func(S, args.frac_cut), number=1, repeat=args.repeat)
+        )
+        print(
+            "{:<20} {:8.2f} ms   cutoff={:.6f} (error {:.2e})".format(
+                name, 1000 * best, cutoff, cutoff - exact
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+""" Benchmarks, and guards, the time taken to import `songfp`.
+
+Importing `songfp` must not import `librosa`, `matplotlib`, `microphone` (and thus
+PyAudio), or `scipy`; these are deferred until decoding, plotting, recording, or
+computing a spectrogram. Each import is timed in a fresh interpreter, and the
+time beyond that of importing `numpy` alone is compared against a budget. The
+script exits with an error if a deferred module is imported, or if the budget
+is exceeded.
+
+    python benchmarks/bench_import.py --budget 0.25
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+
+DEFERRED = ("librosa", "matplotlib", "microphone", "pyaudio", "scipy")
+
+_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps(dict(elapsed=elapsed, modules=sorted(sys.modules))))
+"""
+
+
+def time_import(module: str) -> dict:
+    """ Imports `module` in a fresh interpreter; returns the time taken and the
+    modules loaded as a result."""
+    out = subprocess.run(
+        [sys.executable, "-c", _SCRIPT.format(module=module)],
+        check=True,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    ).stdout
+    return json.loads(out.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=0.25,
+        help="seconds that importing songfp may take beyond importing numpy",
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    baseline = min(time_import("numpy")["elapsed"] for _ in range(args.repeat))
+    runs = [time_import("songfp") for _ in range(args.repeat)]
+    elapsed = min(run["elapsed"] for run in runs)
+    print("import numpy  {:8.1f} ms".format(1000 * baseline))
+    print("import songfp {:8.1f} ms".format(1000 * elapsed))
+
+    failed = False
+    loaded = sorted(
+        {
+            name
+            for run in runs
+            for name in run["modules"]
+            if name.split(".")[0] in DEFERRED
+        }
+    )
+    if loaded:
+        roots = sorted({name.split(".")[0] for name in loaded})
+        print("importing songfp imported deferred modules: {}".format(", ".join(roots)))
+        failed = True
+    if elapsed - baseline > args.budget:
+        print(
+            "importing songfp took {:.1f} ms beyond numpy; the budget is {:.1f} ms".format(
+                1000 * (elapsed - baseline), 1000 * args.budget
+            )
+        )
+        failed = True
+    if failed:
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+""" Reports the recall, and the query cost, of the exact fingerprints versus the
+multi-resolution fingerprints of `songfp.multires`, on degraded recordings.
+
+A catalog is built from synthetic tracks. Clips of the tracks are then degraded in
+each of these ways, and matched against the catalog under each scheme:
+
+ - noise: white noise is added, at `--snr` dB
+ - resample: the clip is resampled, which speeds it up and raises its pitch, by
+   each of `--speeds`
+ - stretch: the clip is time-stretched, without changing its pitch, by each of
+   `--speeds` (this requires librosa)
+
+The spectrogram peaks of each clip are computed once, and shared by the schemes;
+only the hashing, lookup, and ranking are timed. The number of postings scanned per
+query is reported too (see `songfp.instrument`). The multi-resolution indices ignore
+keys with more than `--max-postings` postings (by default, the number of songs),
+except for the one labelled "uncapped".
+
+    python benchmarks/bench_multires.py --songs 100 --clips 100
+"""
+
+import argparse
+import time
+from fractions import Fraction
+
+import numpy as np
+
+from bench_cutoff import synthetic_track
+from songfp import instrument
+from songfp.database import FingerprintIndex
+from songfp.functions import (
+    digital_to_spec,
+    hashes_to_matches,
+    local_peak_array,
+    peaks_to_hashes,
+    rank_matches,
+)
+from songfp.multires import MultiResolutionIndex, Resolution
+
+FS = 44100
+
+
+def peaks_of(digital: np.ndarray) -> np.ndarray:
+    return local_peak_array(*digital_to_spec(digital, FS, frac_cut=0.77), p_nn=20)
+
+
+def add_noise(clip: np.ndarray, snr: float, rng: np.random.RandomState) -> np.ndarray:
+    noise = rng.randn(len(clip)) * np.sqrt(np.mean(clip ** 2) / 10 ** (snr / 10))
+    return clip + noise
+
+
+def resample(clip: np.ndarray, speed: float) -> np.ndarray:
+    """ Plays the clip back `speed` times as fast: both its tempo and pitch scale."""
+    from scipy.signal import resample_poly
+
+    ratio = Fraction(speed).limit_denominator(1000)
+    return resample_poly(clip, ratio.denominator, ratio.numerator)
+
+
+def stretch(clip: np.ndarray, speed: float) -> np.ndarray:
+    """ Plays the clip back `speed` times as fast, without changing its pitch."""
+    import librosa
+
+    return librosa.effects.time_stretch(clip.astype(np.float32), rate=speed)
+
+
+class ExactScheme:
+    name = "exact"
+
+    def __init__(self, tracks_peaks):
+        keys, song_ids, times = [], [], []
+        for song_id, peaks in enumerate(tracks_peaks):
+            hashes, t1 = peaks_to_hashes(peaks, fan_value=15)
+            keys.append(hashes)
+            song_ids.append(np.full(len(hashes), song_id))
+            times.append(t1)
+        self.index = FingerprintIndex.from_postings(
+            np.concatenate(keys), np.concatenate(song_ids), np.concatenate(times)
+        )
+
+    def rank(self, peaks):
+        hashes, t1 = peaks_to_hashes(peaks, fan_value=15)
+        song_ids, offsets = hashes_to_matches(hashes, t1, self.index)
+        return rank_matches(song_ids, offsets, len(hashes), k=1)
+
+
+class MultiResolutionScheme:
+    def __init__(self, tracks_peaks, resolutions, probe: float, max_postings=None):
+        self.name = "{} probe={:g}{}".format(
+            "+".join("{:g}/{:g}".format(*r) for r in resolutions),
+            probe,
+            "" if max_postings else " uncapped",
+        )
+        self.probe = probe
+        self.index = MultiResolutionIndex(resolutions, max_postings=max_postings)
+        for song_id, peaks in enumerate(tracks_peaks):
+            self.index.add_peaks(peaks, song_id)
+
+    def rank(self, peaks):
+        return self.index.rank_peaks(peaks, k=1, probe=self.probe)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--songs", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds per song")
+    parser.add_argument("--clips", type=int, default=100)
+    parser.add_argument("--clip-duration", type=float, default=5.0)
+    parser.add_argument("--snr", type=float, default=5.0, help="dB, for the noise")
+    parser.add_argument("--speeds", type=float, nargs="+", default=[0.95, 1.02, 1.05])
+    parser.add_argument("--max-postings", type=int)
+    parser.add_argument("--no-stretch", action="store_true", help="skip librosa")
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    tracks = [synthetic_track(args.duration, FS, seed=n) for n in range(args.songs)]
+    tracks_peaks = [peaks_of(track) for track in tracks]
+    cap = args.max_postings or args.songs
+
+    fine, coarse = Resolution(24, 8), Resolution(8, 4)
+    schemes = [
+        ExactScheme(tracks_peaks),
+        MultiResolutionScheme(tracks_peaks, [fine], 0.0, cap),
+        MultiResolutionScheme(tracks_peaks, [fine], 0.25, cap),
+        MultiResolutionScheme(tracks_peaks, [fine, coarse], 0.0, cap),
+        MultiResolutionScheme(tracks_peaks, [fine, coarse], 0.25, cap),
+        MultiResolutionScheme(tracks_peaks, [fine, coarse], 0.5, cap),
+        MultiResolutionScheme(tracks_peaks, [fine, coarse], 0.25),
+    ]
+
+    clip_len = int(args.clip_duration * FS)
+    clips = []
+    for _ in range(args.clips):
+        song_id = rng.randint(args.songs)
+        begin = rng.randint(len(tracks[song_id]) - clip_len)
+        clips.append((song_id, tracks[song_id][begin : begin + clip_len]))
+
+    degradations = [("clean", lambda clip: clip)]
+    degradations.append(
+        ("noise {:g} dB".format(args.snr), lambda clip: add_noise(clip, args.snr, rng))
+    )
+    for speed in args.speeds:
+        degradations.append(
+            ("resample x{:g}".format(speed), lambda clip, s=speed: resample(clip, s))
+        )
+    if not args.no_stretch:
+        for speed in args.speeds:
+            degradations.append(
+                ("stretch x{:g}".format(speed), lambda clip, s=speed: stretch(clip, s))
+            )
+
+    print(
+        "{:<16} {:<30} {:>8} {:>10} {:>14}".format(
+            "degradation", "scheme", "recall", "query ms", "postings/query"
+        )
+    )
+    for label, degrade in degradations:
+        degraded = [(song_id, peaks_of(degrade(clip))) for song_id, clip in clips]
+        for scheme in schemes:
+            correct = 0
+            with instrument.collect() as stats:
+                start = time.perf_counter()
+                for song_id, peaks in degraded:
+                    ranked = scheme.rank(peaks)
+                    correct += bool(ranked) and ranked[0].song_id == song_id
+                elapsed = time.perf_counter() - start
+            print(
+                "{:<16} {:<30} {:>7.1%} {:>10.2f} {:>14.0f}".format(
+                    label,
+                    scheme.name,
+                    correct / len(degraded),
+                    1000 * elapsed / len(degraded),
+                    stats.counts["postings_scanned"] / len(degraded),
+                )
+            )
+        print()
+
+
+if __name__ == "__main__":
+    main()
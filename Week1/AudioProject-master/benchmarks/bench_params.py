@@ -0,0 +1,161 @@
+""" Sweeps the fingerprint parameters, and reports how each setting trades the size of
+the index against the time taken to add songs, the time taken to match a sample, and
+the accuracy of matching.
+
+Starting from the default parameters (see `songfp.functions.FingerprintParams`), one
+parameter at a time is set to each of the values given for it. For each setting, a
+catalog of synthetic tracks is fingerprinted and indexed (the ingest time), and
+noisy clips of the tracks are fingerprinted and matched against it (the query time,
+per clip). Samples are always fingerprinted with the catalog's parameters, as
+`songfp.match_sample` does with those stored in the database.
+
+    python benchmarks/bench_params.py --songs 50 --fan-value 5 10 15 20
+    python benchmarks/bench_params.py --nfft 2048 4096 8192 --overlap 0.25 0.5 0.75
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from bench_cutoff import synthetic_track
+from songfp.database import FingerprintIndex
+from songfp.functions import (
+    DEFAULT_PARAMS,
+    FingerprintParams,
+    digital_to_hashes,
+    hashes_to_matches,
+    rank_matches,
+)
+
+FS = 44100
+
+
+def index_nbytes(index: FingerprintIndex) -> int:
+    return sum(
+        getattr(index, name).nbytes for name in ("keys", "offsets", "song_ids", "times")
+    )
+
+
+def sweep(args) -> list:
+    """ The settings to be measured: the defaults, and then each parameter varied
+    in turn."""
+    settings = [DEFAULT_PARAMS]
+    for field in ("frac_cut", "p_nn", "fan_value"):
+        for value in getattr(args, field) or ():
+            settings.append(DEFAULT_PARAMS._replace(**{field: value}))
+    for nfft in args.nfft or (DEFAULT_PARAMS.nfft,):
+        overlaps = args.overlap or (DEFAULT_PARAMS.noverlap / DEFAULT_PARAMS.nfft,)
+        for overlap in overlaps:
+            settings.append(
+                DEFAULT_PARAMS._replace(nfft=nfft, noverlap=int(round(overlap * nfft)))
+            )
+    unique = []
+    for params in settings:
+        if params not in unique:
+            unique.append(params.validate())
+    return unique
+
+
+def measure(params: FingerprintParams, tracks, clips) -> dict:
+    start = time.perf_counter()
+    keys, song_ids, times = [], [], []
+    for song_id, track in enumerate(tracks):
+        hashes, t1 = digital_to_hashes(track, FS, params)
+        keys.append(hashes)
+        song_ids.append(np.full(len(hashes), song_id))
+        times.append(t1)
+    index = FingerprintIndex.from_postings(
+        np.concatenate(keys), np.concatenate(song_ids), np.concatenate(times)
+    )
+    ingest = time.perf_counter() - start
+
+    correct = 0
+    start = time.perf_counter()
+    for song_id, clip in clips:
+        hashes, t1 = digital_to_hashes(clip, FS, params)
+        ids, offsets = hashes_to_matches(hashes, t1, index)
+        ranked = rank_matches(
+            ids, offsets, len(hashes), k=1, time_step=params.time_step(FS)
+        )
+        correct += bool(ranked) and ranked[0].song_id == song_id
+    query = time.perf_counter() - start
+
+    return dict(
+        postings=len(index),
+        keys=index.num_keys,
+        mb=index_nbytes(index) / 2 ** 20,
+        ingest=ingest,
+        query_ms=1000 * query / len(clips),
+        accuracy=correct / len(clips),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--songs", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds per song")
+    parser.add_argument("--clips", type=int, default=100)
+    parser.add_argument("--clip-duration", type=float, default=5.0)
+    parser.add_argument("--noise", type=float, default=0.05)
+    parser.add_argument("--frac-cut", type=float, nargs="*", default=[0.7, 0.85, 0.9])
+    parser.add_argument("--p-nn", type=int, nargs="*", default=[10, 15, 25])
+    parser.add_argument("--fan-value", type=int, nargs="*", default=[5, 10, 20])
+    parser.add_argument("--nfft", type=int, nargs="*", default=[2048, 8192])
+    parser.add_argument(
+        "--overlap",
+        type=float,
+        nargs="*",
+        default=[0.25, 0.5, 0.75],
+        help="the overlap between FFT windows, as a fraction of nfft",
+    )
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    tracks = [synthetic_track(args.duration, FS, seed=n) for n in range(args.songs)]
+    clips = []
+    clip_len = int(args.clip_duration * FS)
+    for _ in range(args.clips):
+        song_id = rng.randint(args.songs)
+        begin = rng.randint(len(tracks[song_id]) - clip_len)
+        clip = tracks[song_id][begin : begin + clip_len]
+        clip = clip + args.noise * rng.randn(clip_len)
+        clips.append((song_id, clip / np.abs(clip).max()))
+
+    # the first spectrogram of each length pays for setting up its FFT
+    for params in sweep(args):
+        digital_to_hashes(clips[0][1], FS, params)
+
+    print(
+        "{:>8} {:>5} {:>5} {:>6} {:>8} {:>10} {:>9} {:>8} {:>9} {:>9} {:>9}".format(
+            "frac_cut",
+            "p_nn",
+            "fan",
+            "nfft",
+            "noverlap",
+            "postings",
+            "keys",
+            "MB",
+            "ingest s",
+            "query ms",
+            "accuracy",
+        )
+    )
+    for params in sweep(args):
+        result = measure(params, tracks, clips)
+        print(
+            "{:>8} {:>5} {:>5} {:>6} {:>8} {:>10} {:>9} {:>8.2f} {:>9.2f} {:>9.2f} "
+            "{:>9.1%}".format(
+                *params,
+                result["postings"],
+                result["keys"],
+                result["mb"],
+                result["ingest"],
+                result["query_ms"],
+                result["accuracy"],
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
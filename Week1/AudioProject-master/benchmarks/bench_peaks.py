@@ -0,0 +1,65 @@
+""" Benchmarks peak extraction: `local_peaks` versus `local_peak_array`.
+
+Before timing, this verifies that `local_peak_array` finds exactly the same
+peaks as the reference implementation, `local_peaks`, both on spectrograms of
+synthetic tracks and on small integer-valued arrays (whose many ties and
+boundary effects exercise the neighborhood semantics). The script exits with
+an error if any peak differs.
+
+    python benchmarks/bench_peaks.py --duration 240
+"""
+
+import argparse
+import sys
+import timeit
+
+import numpy as np
+
+from bench_cutoff import synthetic_track
+from songfp.functions import digital_to_spec, local_peak_array, local_peaks
+
+
+def check_same_peaks(log_spectrogram, amp_min, p_nn) -> bool:
+    reference = local_peaks(log_spectrogram, amp_min, p_nn)
+    peaks = local_peak_array(log_spectrogram, amp_min, p_nn)
+    return reference == list(zip(peaks["t"], peaks["f"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--duration", type=float, default=240.0, help="seconds of audio")
+    parser.add_argument("--p-nn", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    failures = 0
+    for trial in range(200):
+        shape = rng.randint(1, 60, size=2)
+        array = rng.randint(0, 4, size=shape).astype(np.float64)
+        p_nn = rng.randint(0, 25)
+        failures += not check_same_peaks(array, rng.randint(0, 4), p_nn)
+
+    for seed in range(3):
+        S, cutoff = digital_to_spec(synthetic_track(30, seed=seed), 44100, 0.77)
+        failures += not check_same_peaks(S, cutoff, args.p_nn)
+
+    if failures:
+        print("local_peak_array disagrees with local_peaks in {} cases".format(failures))
+        sys.exit(1)
+    print("local_peak_array matches local_peaks")
+
+    S, cutoff = digital_to_spec(synthetic_track(args.duration), 44100, 0.77)
+    print("spectrogram: {} x {}".format(*S.shape))
+    for name, func in [
+        ("local_peaks", local_peaks),
+        ("local_peak_array", local_peak_array),
+    ]:
+        best = min(
+            timeit.repeat(lambda: func(S, cutoff, args.p_nn), number=1, repeat=args.repeat)
+        )
+        print("{:<20} {:8.1f} ms".format(name, 1000 * best))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,371 @@
+""" Benchmarks each stage of the songfp pipeline, across catalog sizes.
+
+Songs are synthesized locally - mixtures of tone bursts, chirps, and noise - so
+the results are reproducible anywhere. A pool of songs is fingerprinted, during
+which the per-song stages are timed:
+
+    digital_to_spec, local_peak_array, local_peaks*, peaks_to_fingerprints*,
+    peaks_to_hashes
+
+A catalog of each requested size is then built from the pool's fingerprints;
+catalogs larger than the pool are filled out with copies of the pool's songs whose
+frequencies are scrambled (each copy XORs the f1 and f2 fields of its fingerprints
+with its own random masks), which keeps the posting-list statistics realistic
+without fingerprinting thousands of songs. For each catalog, these are timed:
+
+    FingerprintIndex.from_postings, Database.save, Database.load,
+    fingerprints_to_matches* + matches_to_best_match*,
+    hashes_to_matches + rank_matches, rank_samples (batched lookup)
+
+(* marks the reference implementations, skipped by `--no-reference`.)
+
+Each catalog is benchmarked in a fresh process, so that the peak RSS reported for
+its stages is its own. Each stage reports its time, the peak RSS of the process
+after the stage, and its throughput in fingerprints per second. The results are
+written as JSON; `--compare` prints the ratio of each stage's time to that in an
+earlier results file.
+
+    python benchmarks/bench_pipeline.py --sizes 10 100 1000 10000 --output results.json
+    python benchmarks/bench_pipeline.py --sizes 10 100 --compare results.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Sequence
+
+import numpy as np
+
+import songfp
+from songfp.database import FingerprintIndex
+from songfp.database._database import Database
+from songfp.functions import (
+    digital_to_spec,
+    fingerprints_to_matches,
+    hashes_to_matches,
+    local_peak_array,
+    local_peaks,
+    matches_to_best_match,
+    pack_fingerprints,
+    peaks_to_fingerprints,
+    peaks_to_hashes,
+    rank_matches,
+    unpack_fingerprints,
+)
+
+FS = 44100
+
+
+def synthetic_song(duration: float, fs: int = FS, seed: int = 0) -> np.ndarray:
+    """ A mixture of tone bursts, linear chirps, and low-passed noise, in [-1, 1]."""
+    rng = np.random.RandomState(seed)
+    n = int(duration * fs)
+    t = np.arange(n) / fs
+
+    # noise, smoothed by a short moving average so that it is not white
+    digital = np.convolve(rng.randn(n), np.ones(8) / 8, mode="same") * 0.02
+
+    for start in rng.uniform(0, duration, size=int(3 * duration)):
+        burst = slice(int(start * fs), int((start + rng.uniform(0.1, 0.5)) * fs))
+        digital[burst] += 0.2 * np.sin(2 * np.pi * rng.uniform(100, 5000) * t[burst])
+
+    for start in rng.uniform(0, duration, size=int(duration)):
+        span = rng.uniform(0.2, 1.0)
+        chirp = slice(int(start * fs), int((start + span) * fs))
+        f0, f1 = rng.uniform(200, 4000, size=2)
+        tau = t[chirp] - t[chirp][:1].sum()
+        phase = 2 * np.pi * (f0 * tau + 0.5 * (f1 - f0) / span * tau ** 2)
+        digital[chirp] += 0.15 * np.sin(phase)
+    return digital / np.abs(digital).max()
+
+
+def peak_rss_mb() -> float:
+    """ The peak resident set size of this process, in MB."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss / (2 ** 20 if sys.platform == "darwin" else 2 ** 10)
+
+
+class Stages:
+    """ Accumulates the time, peak RSS, and fingerprint throughput of each stage."""
+
+    def __init__(self):
+        self.results: Dict[str, Dict[str, float]] = {}
+
+    @contextmanager
+    def time(self, name: str, fingerprints: int = 0):
+        """ Times the body of the `with` statement, as one call of the stage `name`
+        that processed `fingerprints` fingerprints."""
+        start = time.perf_counter()
+        yield
+        elapsed = time.perf_counter() - start
+        stage = self.results.setdefault(
+            name, dict(seconds=0.0, calls=0, fingerprints=0)
+        )
+        stage["seconds"] += elapsed
+        stage["calls"] += 1
+        stage["fingerprints"] += fingerprints
+        stage["peak_rss_mb"] = peak_rss_mb()
+
+    def credit(self, names: Sequence[str], fingerprints: int):
+        """ Credits already-timed stages with fingerprints that were only counted
+        once they were done."""
+        for name in names:
+            self.results[name]["fingerprints"] += fingerprints
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        for stage in self.results.values():
+            stage["seconds_per_call"] = stage["seconds"] / stage["calls"]
+            stage["fingerprints_per_sec"] = (
+                stage["fingerprints"] / stage["seconds"] if stage["seconds"] else 0.0
+            )
+        return self.results
+
+
+def fingerprint_pool(args, stages: Stages):
+    """ Synthesizes and fingerprints the pool of songs, and the query clips."""
+    pool = []
+    for seed in range(args.pool):
+        digital = synthetic_song(args.duration, seed=seed)
+        # each stage is credited with the song's fingerprints, thus its throughput is
+        # the rate at which it would produce fingerprints were it the only stage
+        with stages.time("digital_to_spec"):
+            S, cutoff = digital_to_spec(digital, FS, frac_cut=0.77)
+        with stages.time("local_peak_array"):
+            peaks = local_peak_array(S, cutoff, p_nn=20)
+        with stages.time("peaks_to_hashes"):
+            hashes, times = peaks_to_hashes(peaks, fan_value=15)
+        stages.credit(("digital_to_spec", "local_peak_array", "peaks_to_hashes"), len(hashes))
+
+        if args.reference and seed < args.reference_songs:
+            with stages.time("local_peaks", fingerprints=len(hashes)):
+                local_peaks(S, cutoff, p_nn=20)
+            with stages.time("peaks_to_fingerprints", fingerprints=len(hashes)):
+                list(peaks_to_fingerprints(list(zip(peaks["t"], peaks["f"])), 15))
+        pool.append((digital, hashes, times))
+
+    rng = np.random.RandomState(args.pool)
+    clip_len = int(args.clip_duration * FS)
+    clips = []
+    for _ in range(args.queries):
+        song_id = rng.randint(args.pool)
+        digital = pool[song_id][0]
+        start = rng.randint(len(digital) - clip_len)
+        clip = digital[start : start + clip_len] + 0.01 * rng.randn(clip_len)
+        clips.append((song_id, clip / np.abs(clip).max()))
+    return pool, clips
+
+
+def build_catalog(pool_hashes: List[np.ndarray], pool_times: List[np.ndarray], size: int):
+    """ The postings of a catalog of `size` songs, built from the pool's fingerprints."""
+    rng = np.random.RandomState(size)
+    keys, song_ids, times = [], [], []
+    for song_id in range(size):
+        hashes = pool_hashes[song_id % len(pool_hashes)]
+        if song_id >= len(pool_hashes):
+            f1, f2, dt = unpack_fingerprints(hashes)
+            m1, m2 = rng.randint(1, 2 ** 16, size=2)
+            hashes = pack_fingerprints(f1 ^ m1, f2 ^ m2, dt)
+        keys.append(hashes)
+        song_ids.append(np.full(len(hashes), song_id, dtype=np.int32))
+        times.append(pool_times[song_id % len(pool_times)])
+    return np.concatenate(keys), np.concatenate(song_ids), np.concatenate(times)
+
+
+def bench_catalog(size: int, data_path: str, args_dict: dict) -> dict:
+    """ Benchmarks the catalog-dependent stages; run in a fresh process."""
+    args = argparse.Namespace(**args_dict)
+    data = np.load(data_path)
+    bounds = data["bounds"]
+    pool_hashes = np.split(data["hashes"], bounds[1:-1])
+    pool_times = np.split(data["times"], bounds[1:-1])
+    clip_songs = data["clip_songs"]
+    clip_bounds = data["clip_bounds"]
+    clip_hashes = np.split(data["clip_hashes"], clip_bounds[1:-1])
+    clip_times = np.split(data["clip_times"], clip_bounds[1:-1])
+
+    stages = Stages()
+    keys, song_ids, times = build_catalog(pool_hashes, pool_times, size)
+    with stages.time("FingerprintIndex.from_postings", fingerprints=len(keys)):
+        index = FingerprintIndex.from_postings(keys, song_ids, times)
+    del keys, song_ids, times
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database = Database()
+        database.path = Path(tmp) / "bench.fpdb"
+        database.index = index
+        database.song_list = [("song{}".format(n), None) for n in range(size)]
+        with stages.time("Database.save", fingerprints=len(index)):
+            database.save()
+        loaded = Database()
+        loaded.path = database.path
+        with stages.time("Database.load", fingerprints=len(index)):
+            loaded.load()
+        index = loaded.index
+
+        # queries are only drawn from the songs that are in the catalog
+        queries = [
+            n for n, song_id in enumerate(clip_songs) if song_id < min(size, args.pool)
+        ]
+        correct = 0
+        for n in queries:
+            hashes, t1 = clip_hashes[n], clip_times[n]
+            with stages.time("hashes_to_matches", fingerprints=len(hashes)):
+                ids, offsets = hashes_to_matches(hashes, t1, index)
+            with stages.time("rank_matches", fingerprints=len(hashes)):
+                ranked = rank_matches(ids, offsets, len(hashes), k=5)
+            correct += bool(ranked) and ranked[0].song_id == clip_songs[n]
+
+        if args.reference:
+            for n in queries[: args.reference_queries]:
+                hashes, t1 = clip_hashes[n], clip_times[n]
+                f1, f2, dt = unpack_fingerprints(hashes)
+                fingerprints = list(zip(zip(f1.tolist(), f2.tolist(), dt.tolist()), t1.tolist()))
+                with stages.time("fingerprints_to_matches", fingerprints=len(hashes)):
+                    matches = list(fingerprints_to_matches(fingerprints, index))
+                with stages.time("matches_to_best_match", fingerprints=len(hashes)):
+                    matches_to_best_match(matches)
+
+        if queries:
+            # the batched lookup, against the loaded database
+            from songfp.database import database as global_database
+
+            global_database.switch_db(loaded.path)
+            clips = data["clips"][queries]
+            total = int(sum(len(clip_hashes[n]) for n in queries))
+            with stages.time("rank_samples (whole pipeline, batched)", fingerprints=total):
+                songfp.rank_samples(clips, FS)
+
+    return dict(
+        size=size,
+        num_postings=len(index),
+        num_queries=len(queries),
+        accuracy=correct / max(1, len(queries)),
+        stages=stages.summary(),
+    )
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=str(Path(__file__).parent),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+        ).stdout.strip()
+    except OSError:
+        return ""
+
+
+def print_stages(title: str, stages: dict, baseline: dict = None):
+    print(title)
+    for name, stage in stages.items():
+        line = "  {:<40} {:10.2f} ms/call {:12.0f} fp/s {:9.1f} MB".format(
+            name,
+            1000 * stage["seconds_per_call"],
+            stage["fingerprints_per_sec"],
+            stage["peak_rss_mb"],
+        )
+        if baseline is not None and name in baseline:
+            line += "   x{:.2f}".format(
+                stage["seconds_per_call"] / baseline[name]["seconds_per_call"]
+            )
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument("--pool", type=int, default=20, help="songs fingerprinted")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per song")
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--clip-duration", type=float, default=5.0)
+    parser.add_argument(
+        "--no-reference",
+        dest="reference",
+        action="store_false",
+        help="skip the (slow) reference implementations",
+    )
+    parser.add_argument("--reference-songs", type=int, default=2)
+    parser.add_argument("--reference-queries", type=int, default=5)
+    parser.add_argument("--output", type=str, default=None, help="write JSON results here")
+    parser.add_argument("--compare", type=str, default=None, help="earlier JSON results")
+    args = parser.parse_args()
+
+    stages = Stages()
+    pool, clips = fingerprint_pool(args, stages)
+    clip_fingerprints = [peaks_to_hashes(
+        local_peak_array(*digital_to_spec(clip, FS, frac_cut=0.77), p_nn=20), 15
+    ) for _, clip in clips]
+
+    results = dict(
+        commit=git_commit(),
+        python=platform.python_version(),
+        numpy=np.__version__,
+        platform=platform.platform(),
+        params={k: v for k, v in vars(args).items() if k not in {"output", "compare"}},
+        song_stages=stages.summary(),
+        catalogs=[],
+    )
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_stages(
+        "per-song stages ({} songs, {:g} s each):".format(args.pool, args.duration),
+        results["song_stages"],
+        baseline and baseline["song_stages"],
+    )
+
+    with tempfile.TemporaryDirectory() as tmp:
+        data_path = os.path.join(tmp, "pool.npz")
+        np.savez(
+            data_path,
+            hashes=np.concatenate([h for _, h, _ in pool]),
+            times=np.concatenate([t for _, _, t in pool]),
+            bounds=np.cumsum([0] + [len(h) for _, h, _ in pool]),
+            clip_songs=np.array([song_id for song_id, _ in clips]),
+            clips=np.stack([clip for _, clip in clips]),
+            clip_hashes=np.concatenate([h for h, _ in clip_fingerprints]),
+            clip_times=np.concatenate([t for _, t in clip_fingerprints]),
+            clip_bounds=np.cumsum([0] + [len(h) for h, _ in clip_fingerprints]),
+        )
+        # a fresh ("spawned") process per catalog, so each reports its own peak RSS
+        context = multiprocessing.get_context("spawn")
+        for size in args.sizes:
+            with context.Pool(1) as worker:
+                catalog = worker.apply(bench_catalog, (size, data_path, vars(args)))
+            results["catalogs"].append(catalog)
+
+            old = None
+            if baseline is not None:
+                old = next(
+                    (c["stages"] for c in baseline["catalogs"] if c["size"] == size), None
+                )
+            print_stages(
+                "catalog of {} songs ({} postings, accuracy {:.0%}):".format(
+                    size, catalog["num_postings"], catalog["accuracy"]
+                ),
+                catalog["stages"],
+                old,
+            )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print("results written to {}".format(args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+""" Reports how capping posting lists, and weighting fingerprints by IDF, affect the
+share of the index that lookups use, the time taken to match samples, and the
+accuracy of matching.
+
+A database is built from synthetic tracks that all begin with the same segment
+(standing in for a shared intro, hum, or near-silence), which produces fingerprints
+common to every track. Noisy clips, some of which overlap the shared segment, are
+then matched against the database under each `max_postings` cap - the posting-list
+lengths at several percentiles - with and without IDF weighting. Only the lookup and
+ranking are timed; computing the clips' fingerprints is the same in every
+configuration.
+
+The cap filters lookups only: the index stores every posting under every cap. The
+"keys used" and "postings used" columns are the shares of the index's keys and
+postings that remain visible to lookups.
+
+    python benchmarks/bench_stoplist.py --songs 100 --clips 200
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from bench_cutoff import synthetic_track
+from songfp.database import FingerprintIndex
+from songfp.functions import (
+    digital_to_spec,
+    hashes_to_matches,
+    local_peak_array,
+    peaks_to_hashes,
+    rank_matches,
+    weighted_hashes_to_matches,
+)
+
+FS = 44100
+
+
+def fingerprint(digital: np.ndarray):
+    peaks = local_peak_array(*digital_to_spec(digital, FS, frac_cut=0.77), p_nn=20)
+    return peaks_to_hashes(peaks, fan_value=15)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--songs", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds per song")
+    parser.add_argument("--clips", type=int, default=200)
+    parser.add_argument("--clip-duration", type=float, default=5.0)
+    parser.add_argument("--noise", type=float, default=0.005)
+    parser.add_argument(
+        "--shared", type=float, default=3.0, help="seconds common to every song"
+    )
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    shared = synthetic_track(args.shared, FS, seed=args.songs)
+    tracks = [
+        np.concatenate([shared, synthetic_track(args.duration, FS, seed=seed)])
+        for seed in range(args.songs)
+    ]
+    keys, song_ids, times = [], [], []
+    for song_id, track in enumerate(tracks):
+        hashes, t1 = fingerprint(track)
+        keys.append(hashes)
+        song_ids.append(np.full(len(hashes), song_id))
+        times.append(t1)
+    index = FingerprintIndex.from_postings(
+        np.concatenate(keys), np.concatenate(song_ids), np.concatenate(times)
+    )
+
+    stats = index.posting_stats()
+    print("posting-list lengths:")
+    for name, value in stats.items():
+        print("  {:<15} {}".format(name, round(value, 4)))
+
+    clips = []
+    clip_len = int(args.clip_duration * FS)
+    for _ in range(args.clips):
+        song_id = rng.randint(args.songs)
+        start = rng.randint(len(tracks[song_id]) - clip_len)
+        clip = tracks[song_id][start : start + clip_len]
+        clip = clip + args.noise * rng.randn(clip_len)
+        clips.append((song_id, fingerprint(clip / np.abs(clip).max())))
+
+    caps = [None] + sorted(
+        {int(stats[p]) for p in ("p999", "p99", "p90") if stats[p] >= 1}, reverse=True
+    )
+    lengths = index.posting_lengths()
+    print()
+    print(
+        "{:>8} {:>5} {:>12} {:>14} {:>10} {:>9}".format(
+            "cap", "idf", "keys used", "postings used", "match ms", "accuracy"
+        )
+    )
+    for cap in caps:
+        index.max_postings = cap
+        used = lengths <= (np.inf if cap is None else cap)
+        for idf in (False, True):
+            correct = 0
+            start = time.perf_counter()
+            for song_id, (hashes, t1) in clips:
+                if idf:
+                    ids, offsets, weights, total = weighted_hashes_to_matches(
+                        hashes, t1, index
+                    )
+                    ranked = rank_matches(ids, offsets, total, k=1, weights=weights)
+                else:
+                    ids, offsets = hashes_to_matches(hashes, t1, index)
+                    ranked = rank_matches(ids, offsets, len(hashes), k=1)
+                correct += bool(ranked) and ranked[0].song_id == song_id
+            elapsed = time.perf_counter() - start
+            print(
+                "{:>8} {:>5} {:>11.1%} {:>13.1%} {:>10.2f} {:>9.1%}".format(
+                    "none" if cap is None else cap,
+                    "yes" if idf else "no",
+                    used.mean(),
+                    lengths[used].sum() / lengths.sum(),
+                    1000 * elapsed / len(clips),
+                    correct / len(clips),
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
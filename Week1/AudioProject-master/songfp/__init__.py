@@ -6,28 +6,42 @@ In effect, `songfp` provides a service similar to popular song-recognition progr
 It can "listen" to a song, and match it against a database of song fingerprints, which is populated by the user.
 
 `songfp` was created as a prototype for the CogWorks summer program in the
-Beaver Works Summer Institute at MIT. It was developed by Ryan Soklaski."""
+Beaver Works Summer Institute at MIT. It was developed by Ryan Soklaski.
+
+Importing `songfp` does not import `librosa`, `matplotlib`, or `microphone` (and
+thus PyAudio); these are imported upon first decoding, plotting, or recording."""
 
 from pathlib import Path
-from typing import Tuple, Union
+from typing import TYPE_CHECKING, List, Sequence, Tuple, Union
 
 import numpy as _np
-from matplotlib.pyplot import Axes, Figure
-
-import librosa as _librosa
-from microphone import record_audio
 
 from .database import list_songs, load_song_db
+from .functions import FingerprintParams, Match
+from .functions import batch_hashes_to_matches as _batch_hashes_to_matches
+from .functions import digital_to_hashes as _digital_to_hashes
 from .functions import digital_to_spec as _digital_to_spec
-from .functions import fingerprints_to_matches as _fingerprints_to_matches
-from .functions import local_peaks as _local_peaks
-from .functions import matches_to_best_match as _matches_to_best_match
-from .functions import peaks_to_fingerprints as _peaks_to_fingerprints
+from .functions import hashes_to_matches as _hashes_to_matches
+from .functions import local_peak_array as _local_peak_array
+from .functions import rank_hashes as _rank_hashes
+from .functions import rank_matches as _rank_matches
+from .functions import weighted_hashes_to_matches as _weighted_hashes_to_matches
+from .streaming import StreamingRecognizer
+
+if TYPE_CHECKING:
+    from matplotlib.pyplot import Axes, Figure
 
 __all__ = [
     "list_songs",
+    "FingerprintParams",
+    "Match",
+    "rank_sample",
     "match_sample",
+    "rank_samples",
+    "match_samples",
     "match_recording",
+    "match_stream",
+    "StreamingRecognizer",
     "plot_recording",
     "plot_song",
 ]
@@ -35,6 +49,97 @@ __all__ = [
 __version__ = "0.0"
 
 
+def __getattr__(name):
+    # `record_audio` and `stream_audio` are re-exported from `microphone`
+    # on first access, as importing it requires PyAudio
+    if name in {"record_audio", "stream_audio"}:
+        import microphone
+
+        return getattr(microphone, name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+@load_song_db
+def rank_sample(
+    sample_digital: _np.ndarray,
+    fs: int,
+    k: int = 5,
+    idf: bool = False,
+    bounded: bool = False,
+) -> List[Match]:
+    """ Given a digital signal, rank the best-matching songs from the fingerprint database.
+
+    Parameters
+    ----------
+    sample_digital : numpy.ndarray, shape=(T,)
+        The digital signal
+
+    fs : int
+        The sampling rate for the signal
+
+    k : int, optional (default=5)
+        The maximum number of candidates to return
+
+    idf : bool, optional (default=False)
+        If `True`, each matching fingerprint's vote is weighted by the inverse
+        document frequency of the fingerprint: the rarer a fingerprint is among
+        the database's songs, the more its vote counts. Not supported by a sharded
+        database (see `songfp.database.shard`).
+
+    bounded : bool, optional (default=False)
+        If `True`, the sample is scored with an offset histogram that is bounded by
+        the number of candidate songs, rather than by the number of matching
+        fingerprints, which may be very large for a sample that contains common
+        fingerprints (see `songfp.functions.rank_hashes`). Not supported by a
+        sharded database.
+
+    Returns
+    -------
+    List[Match]
+        Up to `k` candidates, in order of descending score. Each provides the
+        song-ID, the time (in seconds) in the song at which the sample begins,
+        the number of fingerprints voting for that alignment, the fraction of the
+        sample's fingerprints that those votes represent, and the margin of votes
+        over the best other candidate. The list is empty if there is no match.
+
+    Raises
+    ------
+    ValueError
+        If `idf` or `bounded` is requested of a sharded database."""
+    from .database import database
+
+    return _rank_sample(database.snapshot(), sample_digital, fs, k, idf, bounded)
+
+
+def _rank_sample(
+    snapshot, sample_digital: _np.ndarray, fs: int, k: int, idf: bool, bounded: bool
+) -> List[Match]:
+    # matches against one version of the database (see `Database.snapshot`), with
+    # the sample fingerprinted as the database's songs were
+    if snapshot.shards is not None and (idf or bounded):
+        raise ValueError(
+            "a sharded database does not support `idf` or `bounded` ranking; "
+            "see `songfp.database.unshard`"
+        )
+    hashes, times = _digital_to_hashes(sample_digital, fs, snapshot.params)
+    time_step = snapshot.params.time_step(fs)
+    if bounded:
+        return _rank_hashes(
+            hashes, times, snapshot.index, k=k, time_step=time_step, idf=idf
+        )
+    if idf:
+        song_ids, offsets, weights, total = _weighted_hashes_to_matches(
+            hashes, times, snapshot.index
+        )
+        return _rank_matches(
+            song_ids, offsets, total, k=k, time_step=time_step, weights=weights
+        )
+    if snapshot.shards is not None:
+        return snapshot.shards.rank(hashes, times, k=k, time_step=time_step)
+    song_ids, offsets = _hashes_to_matches(hashes, times, snapshot.index)
+    return _rank_matches(song_ids, offsets, len(hashes), k=k, time_step=time_step)
+
+
 @load_song_db
 def match_sample(sample_digital: _np.ndarray, fs: int) -> str:
     """ Given a digital signal, produce the best match from the fingerprint database.
@@ -53,21 +158,109 @@ def match_sample(sample_digital: _np.ndarray, fs: int) -> str:
         The song-ID for the best match. `None` if no mat"""
     from .database import database
 
-    if not database:
+    snapshot = database.snapshot()
+    if not snapshot.song_list:
         print("No songs to match - your _database is empty!")
         return "no match... your database is empty!"
-    peaks = _local_peaks(*_digital_to_spec(sample_digital, fs, frac_cut=0.77), p_nn=20)
-    fingerprints = _peaks_to_fingerprints(peaks, fan_value=15)
-    matches = _fingerprints_to_matches(fingerprints, database.pair_mapping)
-    song_id = _matches_to_best_match(matches)
+    ranked = _rank_sample(snapshot, sample_digital, fs, k=1, idf=False, bounded=False)
 
-    if song_id is None:
+    if not ranked:
         return "no match..."
+    return _describe_song(snapshot, ranked[0].song_id)
+
 
-    name, artist = database.song_list[song_id]
+def _describe_song(snapshot, song_id: int) -> str:
+    name, artist = snapshot.song_list[song_id]
     return name + ("" if artist is None else " by {}".format(artist))
 
 
+@load_song_db
+def rank_samples(
+    samples: Sequence[_np.ndarray], fs: int, k: int = 5
+) -> List[List[Match]]:
+    """ Given many digital signals, rank the best-matching songs for each of them.
+
+    Equivalent to calling `rank_sample` on each signal, but the database is loaded
+    once, the spectrograms share one FFT engine, and all of the signals' fingerprints
+    are looked up in the database at once.
+
+    Parameters
+    ----------
+    samples : Sequence[numpy.ndarray]
+        The digital signals, each of shape (T_i,)
+
+    fs : int
+        The sampling rate for the signals
+
+    k : int, optional (default=5)
+        The maximum number of candidates to return for each signal
+
+    Returns
+    -------
+    List[List[Match]]
+        The candidates for each signal (see `rank_sample`)."""
+    from .database import database
+
+    return _rank_samples(database.snapshot(), samples, fs, k)
+
+
+def _rank_samples(snapshot, samples: Sequence[_np.ndarray], fs: int, k: int):
+    if not len(samples):
+        return []
+
+    # Each signal's spectrogram and peaks are computed separately: these stages are
+    # bound by the size of the spectrogram, not by per-call overhead, and run
+    # fastest on arrays that fit in cache
+    hashes, times = zip(
+        *(_digital_to_hashes(sample, fs, snapshot.params) for sample in samples)
+    )
+    time_step = snapshot.params.time_step(fs)
+
+    if snapshot.shards is not None:
+        return [
+            snapshot.shards.rank(h, t, k=k, time_step=time_step)
+            for h, t in zip(hashes, times)
+        ]
+    matches = _batch_hashes_to_matches(hashes, times, snapshot.index)
+    return [
+        _rank_matches(song_ids, offsets, len(h), k=k, time_step=time_step)
+        for h, (song_ids, offsets) in zip(hashes, matches)
+    ]
+
+
+@load_song_db
+def match_samples(samples: Sequence[_np.ndarray], fs: int) -> List[str]:
+    """ Given many digital signals, produce the best match for each of them from the
+    fingerprint database.
+
+    Equivalent to calling `match_sample` on each signal, but much faster for many
+    short signals (see `rank_samples`).
+
+    Parameters
+    ----------
+    samples : Sequence[numpy.ndarray]
+        The digital signals, each of shape (T_i,)
+
+    fs : int
+        The sampling rate for the signals
+
+    Returns
+    -------
+    List[str]
+        The best match for each signal."""
+    from .database import database
+
+    snapshot = database.snapshot()
+    if not snapshot.song_list:
+        print("No songs to match - your _database is empty!")
+        return ["no match... your database is empty!"] * len(samples)
+
+    return [
+        _describe_song(snapshot, ranked[0].song_id) if ranked else "no match..."
+        for ranked in _rank_samples(snapshot, samples, fs, k=1)
+    ]
+
+
 def match_recording(time: float) -> str:
     """ Record a song for the specified time, and return the best match from the fingerprint database.
 
@@ -80,21 +273,80 @@ def match_recording(time: float) -> str:
     -------
     str
         The song-ID for the best match"""
+    from microphone import record_audio
 
     frames, sample_rate = record_audio(time)
     digital_data = _np.hstack([_np.frombuffer(i, _np.int16) for i in frames])
     return match_sample(digital_data, sample_rate)
 
 
+@load_song_db
+def match_stream(
+    max_time: float = 10.0, min_votes: int = 10, min_margin: int = 5
+) -> str:
+    """ Listen to the microphone, and return the best match from the fingerprint database
+    as soon as it is a confident one.
+
+    The recording is fingerprinted as it arrives, rather than after it has finished.
+
+    Parameters
+    ----------
+    max_time : float, optional (default=10.)
+        The maximum time, in seconds, for which the microphone will record.
+
+    min_votes : int, optional (default=10)
+        The number of fingerprints that must agree on the best match before
+        recording stops early.
+
+    min_margin : int, optional (default=5)
+        The number of votes by which the best match must lead the runner-up
+        before recording stops early.
+
+    Returns
+    -------
+    str
+        The song-ID for the best match"""
+    from microphone import stream_audio
+    from microphone.context_managers import RATE
+
+    from .database import database
+
+    snapshot = database.snapshot()
+    if not snapshot.song_list:
+        print("No songs to match - your _database is empty!")
+        return "no match... your database is empty!"
+
+    recognizer = StreamingRecognizer(
+        snapshot.index,
+        fs=RATE,
+        min_votes=min_votes,
+        min_margin=min_margin,
+        **snapshot.params._asdict()
+    )
+    for frames in stream_audio(max_time):
+        recognizer.feed(_np.frombuffer(frames, _np.int16))
+        if recognizer.confident:
+            break
+    else:
+        recognizer.finish()
+
+    if recognizer.best is None:
+        return "no match..."
+
+    print("matched after {:.2f} seconds".format(recognizer.duration))
+    return _describe_song(snapshot, recognizer.best.song_id)
+
+
 def plot_song(
     song: Union[str, Path, _np.ndarray], with_peaks: bool = True
-) -> Tuple[Figure, Axes]:
+) -> Tuple["Figure", "Axes"]:
     """ Plot a spectrogram and fingerprint features for a song.
 
     Parameters
     ----------
     song : Union[str, pathlib.Path, numpy.ndarray]
-        The filepath to a song-file, or the digital signal itself.
+        The filepath to a song-file, or a digital signal recorded by `microphone`
+        (at its sampling rate).
 
     with_peaks : bool
         If True, include peak-value scatter-points
@@ -102,30 +354,42 @@ def plot_song(
     Returns
     -------
     matplotlib.pyplot.Figure, matplotlib.pyplot.Axes """
-    from microphone.config import settings
-    from pathlib import Path
-
     if isinstance(song, (str, Path)):
-        digital, fs = _librosa.load(str(song), sr=44100, mono=True)
+        from .cache import get_cache
+
+        digital, fs = get_cache().load_audio(song, sr=44100)
     elif isinstance(song, _np.ndarray):
+        # (`microphone` requires `pyaudio`; only arrays from it need its rate)
+        from microphone.context_managers import RATE
+
         digital = song
-        fs = settings.rate
+        fs = RATE  # the rate at which `microphone.record_audio` records
     else:
         raise TypeError("`song` must be a path to a song or an audio signal array")
-    S, cut, fig, ax, df, dt = _digital_to_spec(digital, fs, frac_cut=0.77, plot=True)
+    from .database import database
+
+    # the spectrogram and peaks with which the database's songs are fingerprinted
+    params = database.snapshot().params
+    S, cut, fig, ax, df, dt = _digital_to_spec(
+        digital,
+        fs,
+        params.frac_cut,
+        plot=True,
+        nfft=params.nfft,
+        noverlap=params.noverlap,
+    )
 
     if with_peaks:
-        peaks = _local_peaks(S, cut, p_nn=20)
-        t_loc, f_loc = zip(*peaks)
-        ts = dt * _np.array(list(t_loc))
-        fs = df * _np.array(list(f_loc))
+        peaks = _local_peak_array(S, cut, p_nn=params.p_nn)
+        ts = dt * peaks["t"]
+        fs = df * peaks["f"]
         ax.scatter(ts, fs, s=4)
         ax.set_xlabel("Time (sec)")
         ax.set_ylabel("Frequency (Hz)")
     return fig, ax
 
 
-def plot_recording(time: float, with_peaks: bool = True) -> Tuple[Figure, Axes]:
+def plot_recording(time: float, with_peaks: bool = True) -> Tuple["Figure", "Axes"]:
     """ Plot a spectrogram and fingerprint features for a live recording
 
     Parameters
@@ -139,6 +403,8 @@ def plot_recording(time: float, with_peaks: bool = True) -> Tuple[Figure, Axes]:
     Returns
     -------
     matplotlib.pyplot.Figure, matplotlib.pyplot.Axes """
+    from microphone import record_audio
+
     frames, sample_rate = record_audio(time)
     digital_data = _np.hstack([_np.frombuffer(i, _np.int16) for i in frames])
     return plot_song(digital_data, with_peaks=with_peaks)
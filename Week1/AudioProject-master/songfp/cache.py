@@ -0,0 +1,381 @@
+"""
+An on-disk cache of decoded audio and of spectrogram peaks.
+
+Decoding (and resampling) a song file dominates the cost of fingerprinting it.
+`AudioCache` stores, for each song file:
+
+ - its decoded, mono PCM signal, at a given sampling rate
+ - its spectrogram peaks, for a given set of peak-finding parameters
+
+Entries are keyed by a hash of the file's contents together with the parameters
+that produced them, thus a moved or renamed file still hits the cache, while an
+edited file, or a change of parameters, misses it. Rebuilding a database with
+unchanged parameters therefore skips decoding entirely; changing the peak-finding
+parameters skips decoding but recomputes the peaks.
+
+Files longer than `AudioCache.stream_seconds` are never decoded at once: their
+peaks are found as they are decoded, a block at a time (see `songfp.chunked`),
+thus the memory used is bounded regardless of their duration. Only their peaks are
+cached, as their decoded audio would be too large to be worth caching.
+
+The cache is bounded in size: once it exceeds `max_bytes`, the least-recently used
+entries are evicted. Each entry is a `.npy` file, written to a temporary file and
+then moved into place, thus concurrent processes (e.g. the workers of
+`songfp.database.add_songs`) can share a cache. Each process keeps a running total
+of the bytes that it has written, and only scans the cache's directory to evict
+entries once that total exceeds `max_bytes`; the cache can thus briefly exceed its
+bound by what other processes wrote since its last scan.
+
+The cache used by `songfp` is opt-in: it is disabled unless the `SONGFP_CACHE_DIR`
+environment variable names its directory, or it is enabled via `configure` (in
+which case it lives in `~/.cache/songfp` by default). The worker processes of
+`songfp.database.add_songs` and of `songfp.server` use the cache of the process
+that started them (see `use_cache`).
+"""
+
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+from typing import Optional, Tuple, Union
+
+import numpy as np
+
+from .functions import NFFT, NOVERLAP, PEAK_DTYPE, digital_to_spec, local_peak_array
+
+__all__ = ["AudioCache", "configure", "get_cache", "use_cache"]
+
+# incremented whenever the format of the cached data changes
+_CACHE_VERSION = 1
+_CHUNK = 2 ** 20
+
+
+def _default_directory() -> Path:
+    return Path(
+        os.environ.get("SONGFP_CACHE_DIR", Path("~", ".cache", "songfp"))
+    ).expanduser()
+
+
+def file_hash(path: Union[str, Path]) -> str:
+    """ Computes the SHA-256 hex-digest of a file's contents.
+
+    Parameters
+    ----------
+    path : PathLike
+
+    Returns
+    -------
+    str"""
+    digest = hashlib.sha256()
+    with open(str(path), "rb") as f:
+        for chunk in iter(lambda: f.read(_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def decode(path: Union[str, Path], sr: int = 44100) -> Tuple[np.ndarray, int]:
+    """ Decodes an audio file to a mono signal, bypassing the cache.
+
+    Parameters
+    ----------
+    path : PathLike
+        Path to a .mp3, .wav, (and maybe other formats) file.
+
+    sr : int, optional (default=44100)
+        The sampling rate to which the audio is resampled.
+
+    Returns
+    -------
+    Tuple[numpy.ndarray[float32], int]
+        The signal, and its sampling rate."""
+    import librosa
+
+    return librosa.load(str(path), sr=sr, mono=True)
+
+
+class AudioCache:
+    def __init__(
+        self,
+        directory: Optional[Union[str, Path]] = None,
+        max_bytes: int = 256 * 2 ** 20,
+        enabled: bool = True,
+        stream_seconds: float = 600.0,
+    ):
+        """ Parameters
+        ----------
+        directory : Optional[PathLike]
+            The directory in which entries are stored. Defaults to `~/.cache/songfp`,
+            or to the `SONGFP_CACHE_DIR` environment variable.
+
+        max_bytes : int, optional (default=256 MiB)
+            The total size of the entries above which the least-recently used
+            entries are evicted.
+
+        enabled : bool, optional (default=True)
+            If `False`, nothing is read from or written to the cache.
+
+        stream_seconds : float, optional (default=600.)
+            `load_peaks` decodes files longer than this a block at a time, rather
+            than decoding them whole; `float("inf")` decodes every file whole."""
+        assert 0 <= max_bytes and 0 <= stream_seconds
+        self.directory = _default_directory() if directory is None else Path(directory)
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.stream_seconds = stream_seconds
+        # the size of the entries as of the last scan, plus the bytes written since;
+        # `None` until the directory is first scanned
+        self._size: Optional[int] = None
+
+    def __getstate__(self):
+        # a copy in another process scans the directory itself
+        return dict(self.__dict__, _size=None)
+
+    def _entry(self, content_hash: str, kind: str, **params) -> Path:
+        description = repr((_CACHE_VERSION, content_hash, kind, sorted(params.items())))
+        key = hashlib.sha256(description.encode("utf-8")).hexdigest()
+        return self.directory / "{}-{}.npy".format(kind, key)
+
+    def _read(self, entry: Path) -> Optional[np.ndarray]:
+        try:
+            array = np.load(str(entry), allow_pickle=False)
+        except (OSError, ValueError):
+            # missing, or evicted / corrupted by another process
+            return None
+        try:
+            # mark the entry as recently used
+            os.utime(str(entry))
+        except OSError:
+            pass
+        return array
+
+    def _write(self, entry: Path, array: np.ndarray):
+        if array.nbytes > self.max_bytes:
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=str(self.directory), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, array, allow_pickle=False)
+            os.replace(tmp, str(entry))
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        if self._size is None:
+            self._size = self.size
+        else:
+            self._size += os.path.getsize(str(entry))
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """ Deletes the least-recently used entries until the cache fits in `max_bytes`."""
+        if not self.directory.is_dir():
+            self._size = 0
+            return
+        entries = []
+        for entry in self.directory.glob("*.npy"):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry))
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries, key=lambda x: x[0]):
+            if total <= self.max_bytes:
+                break
+            try:
+                entry.unlink()
+            except OSError:
+                pass
+            total -= size
+        self._size = total
+
+    def clear(self):
+        """ Deletes every entry."""
+        for entry in self.directory.glob("*.npy"):
+            try:
+                entry.unlink()
+            except OSError:
+                pass
+        self._size = 0
+
+    @property
+    def size(self) -> int:
+        """ The total size, in bytes, of the cache's entries."""
+        return sum(entry.stat().st_size for entry in self.directory.glob("*.npy"))
+
+    def load_audio(
+        self, path: Union[str, Path], sr: int = 44100, content_hash: Optional[str] = None
+    ) -> Tuple[np.ndarray, int]:
+        """ Decodes an audio file to a mono signal, via the cache.
+
+        Parameters
+        ----------
+        path : PathLike
+            Path to a .mp3, .wav, (and maybe other formats) file.
+
+        sr : int, optional (default=44100)
+            The sampling rate to which the audio is resampled.
+
+        content_hash : Optional[str]
+            The file's `file_hash`, if it is already known.
+
+        Returns
+        -------
+        Tuple[numpy.ndarray[float32], int]
+            The signal, and its sampling rate."""
+        if not self.enabled:
+            return decode(path, sr=sr)
+
+        content_hash = content_hash or file_hash(path)
+        entry = self._entry(content_hash, "pcm", sr=sr)
+        digital = self._read(entry)
+        if digital is None:
+            digital, sr = decode(path, sr=sr)
+            self._write(entry, digital)
+        return digital, sr
+
+    def load_peaks(
+        self,
+        path: Union[str, Path],
+        frac_cut: float = 0.77,
+        p_nn: int = 20,
+        sr: int = 44100,
+        nfft: int = NFFT,
+        noverlap: int = NOVERLAP,
+    ) -> np.ndarray:
+        """ Computes the spectrogram peaks of an audio file, via the cache.
+
+        Parameters
+        ----------
+        path : PathLike
+            Path to a .mp3, .wav, (and maybe other formats) file.
+
+        frac_cut : float, optional (default=0.77)
+            See `songfp.functions.digital_to_spec`.
+
+        p_nn : int, optional (default=20)
+            See `songfp.functions.local_peak_array`.
+
+        sr : int, optional (default=44100)
+            The sampling rate to which the audio is resampled.
+
+        nfft : int, optional (default=NFFT)
+        noverlap : int, optional (default=NOVERLAP)
+            See `songfp.functions.digital_to_spec`.
+
+        Returns
+        -------
+        numpy.ndarray[PEAK_DTYPE], shape=(N,)
+            The peaks, as returned by `songfp.functions.local_peak_array`.
+
+        Notes
+        -----
+        Files longer than `stream_seconds` are decoded a block at a time (see
+        `songfp.chunked.file_peaks`), provided that `soundfile` can read them, and
+        their decoded audio is not cached."""
+        content_hash = file_hash(path) if self.enabled else None
+        if self.enabled:
+            entry = self._entry(
+                content_hash,
+                "peaks",
+                sr=sr,
+                frac_cut=frac_cut,
+                p_nn=p_nn,
+                nfft=nfft,
+                noverlap=noverlap,
+            )
+            peaks = self._read(entry)
+            if peaks is not None and peaks.dtype == PEAK_DTYPE:
+                return peaks
+
+        kwargs = dict(frac_cut=frac_cut, p_nn=p_nn, sr=sr, nfft=nfft, noverlap=noverlap)
+        peaks = self._stream_peaks(path, **kwargs) if self._streams(path) else None
+        if peaks is None:
+            digital, fs = self.load_audio(path, sr=sr, content_hash=content_hash)
+            S, cutoff = digital_to_spec(
+                digital, fs, frac_cut=frac_cut, nfft=nfft, noverlap=noverlap
+            )
+            peaks = local_peak_array(S, cutoff, p_nn=p_nn)
+        if self.enabled:
+            self._write(entry, peaks)
+        return peaks
+
+    def _streams(self, path: Union[str, Path]) -> bool:
+        # whether the file is long enough to be decoded a block at a time
+        if self.stream_seconds == float("inf"):
+            return False
+        import soundfile
+
+        try:
+            return soundfile.info(str(path)).duration > self.stream_seconds
+        except RuntimeError:
+            # a format that only `librosa.load` (via audioread) can decode
+            return False
+
+    def _stream_peaks(self, path: Union[str, Path], **kwargs) -> Optional[np.ndarray]:
+        from .chunked import file_peaks
+
+        try:
+            return file_peaks(path, **kwargs)
+        except RuntimeError:
+            return None
+
+
+_cache = AudioCache(enabled="SONGFP_CACHE_DIR" in os.environ)
+
+
+def get_cache() -> AudioCache:
+    """ Returns the cache used by `songfp`."""
+    return _cache
+
+
+def use_cache(cache: AudioCache):
+    """ Makes `cache` the cache used by `songfp`.
+
+    Worker processes are started with the cache of their parent process, e.g.
+
+    >>> ProcessPoolExecutor(initializer=use_cache, initargs=(get_cache(),))
+
+    Parameters
+    ----------
+    cache : AudioCache"""
+    global _cache
+    _cache = cache
+
+
+def configure(
+    directory: Optional[Union[str, Path]] = None,
+    max_bytes: Optional[int] = None,
+    enabled: Optional[bool] = None,
+    stream_seconds: Optional[float] = None,
+):
+    """ Configures the cache used by `songfp`, which is disabled by default unless
+    the `SONGFP_CACHE_DIR` environment variable is set.
+
+    Parameters
+    ----------
+    directory : Optional[PathLike]
+        The directory in which the cache is stored.
+
+    max_bytes : Optional[int]
+        The size, in bytes, to which the cache is bounded.
+
+    enabled : Optional[bool]
+        Whether the cache is used at all.
+
+    stream_seconds : Optional[float]
+        The duration above which files are decoded a block at a time (see
+        `AudioCache`); `float("inf")` decodes every file whole."""
+    if directory is not None:
+        _cache.directory = Path(directory)
+        _cache._size = None
+    if max_bytes is not None:
+        assert 0 <= max_bytes
+        _cache.max_bytes = max_bytes
+    if enabled is not None:
+        _cache.enabled = enabled
+    if stream_seconds is not None:
+        assert 0 <= stream_seconds
+        _cache.stream_seconds = stream_seconds
@@ -0,0 +1,329 @@
+"""
+Fingerprinting of long audio files in bounded memory.
+
+`songfp.cache.decode` decodes an entire file at once; an hour-long mix is
+decoded to over half a gigabyte of samples, and its spectrogram is larger still.
+Here, a file is instead decoded a block at a time (see `decode_blocks`), and each
+block is fed to a `ChunkedPeakFinder`, which extends the spectrogram by the frames
+that the block completes and searches the columns whose neighborhoods have been
+fully observed. Only these columns, and the `p_nn` columns on either side of them,
+are held in memory, thus the memory used is independent of the file's duration,
+but for the peaks themselves.
+
+The peak threshold depends on the intensities of the entire spectrogram (see
+`songfp.functions.digital_to_spec`), which are only known once the file has been
+decoded. The local maxima are therefore kept, along with their intensities, and
+are thresholded at the end. The intensities are tallied in a
+`songfp.functions.CutoffSketch`, which locates the threshold to within one of its
+bins; only the maxima that fall in that bin depend on the threshold's exact value.
+If there are any, the file is decoded a second time, and the intensities in that
+bin are collected and selected from, exactly as `digital_to_spec` does. The peaks
+are thus identical to those of `songfp.functions.local_peak_array`.
+
+The maxima of digital silence (intensities at the floor to which `digital_to_spec`
+clips) only exceed the threshold if most of the spectrogram is silent. They are
+kept as a bitmask, which is a small fraction of the size of the spectrogram.
+
+    >>> peaks = file_peaks("path/to/mix.mp3")
+"""
+
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, Optional, Union
+
+import numpy as np
+
+from .functions import (
+    NFFT,
+    NOVERLAP,
+    PEAK_DTYPE,
+    CutoffSketch,
+    diamond_maximum_filter,
+)
+from .spectrogram import SpectrogramEngine
+
+__all__ = ["decode_blocks", "ChunkedPeakFinder", "file_peaks"]
+
+# `digital_to_spec` clips amplitudes to this before taking their logarithm
+_FLOOR = np.log(1e-20)
+
+
+def decode_blocks(
+    path: Union[str, Path], sr: int = 44100, block_size: int = 2 ** 18
+) -> Iterator[np.ndarray]:
+    """ Decodes an audio file to a mono signal, a block at a time.
+
+    The signal is that of `songfp.cache.decode`: channels are averaged, and the
+    audio is resampled with the same (soxr) resampler as `librosa.load`.
+
+    Parameters
+    ----------
+    path : PathLike
+        Path to an audio file that `soundfile` can read (.wav, .flac, .ogg, .mp3,
+        and more, depending on the version of libsndfile).
+
+    sr : int, optional (default=44100)
+        The sampling rate to which the audio is resampled.
+
+    block_size : int, optional (default=2**18)
+        The number of samples, at the file's sampling rate, decoded at a time.
+
+    Yields
+    ------
+    numpy.ndarray[float32], shape=(T,)
+        Successive blocks of the signal; a block may be empty.
+
+    Raises
+    ------
+    RuntimeError
+        `soundfile` cannot read the file."""
+    import soundfile
+
+    with soundfile.SoundFile(str(path)) as f:
+        resampler = None
+        if f.samplerate != sr:
+            import soxr
+
+            resampler = soxr.ResampleStream(f.samplerate, sr, 1, dtype="float32")
+        for block in f.blocks(blocksize=block_size, dtype="float32", always_2d=True):
+            block = block.mean(axis=1, dtype=np.float32)
+            yield block if resampler is None else resampler.resample_chunk(block)
+        if resampler is not None:
+            yield resampler.resample_chunk(np.empty(0, dtype=np.float32), last=True)
+
+
+class ChunkedPeakFinder:
+    def __init__(
+        self,
+        fs: int,
+        frac_cut: float = 0.77,
+        p_nn: int = 20,
+        nfft: int = NFFT,
+        noverlap: int = NOVERLAP,
+        gain: float = 2 ** 15,
+    ):
+        """ Parameters
+        ----------
+        fs : int
+            The sampling rate of the signal.
+
+        frac_cut : float, optional (default=0.77)
+            See `songfp.functions.digital_to_spec`.
+
+        p_nn : int, optional (default=20)
+            See `songfp.functions.local_peak_array`.
+
+        nfft : int, optional (default=NFFT)
+        noverlap : int, optional (default=NOVERLAP)
+            See `songfp.functions.digital_to_spec`.
+
+        gain : float, optional (default=2**15)
+            The factor by which the signal is scaled prior to the transform;
+            `digital_to_spec` scales signals in [-1, 1] to the range of 16-bit PCM.
+            """
+        self.p_nn = p_nn
+        # `iterate_structure` treats zero iterations like one
+        self._radius = max(p_nn, 1)
+        self.gain = gain
+        self._engine = SpectrogramEngine(fs, nfft=nfft, noverlap=noverlap)
+        self._cutoff = CutoffSketch(frac_cut, num_bins=2 ** 16)
+
+        self._num_samples = 0
+        # the number of intensities at the floor
+        self._num_floor = 0
+        # the log-spectrogram columns that have not yet been searched, preceded by
+        # up to `radius` columns of context; `_start` is the index of the first
+        self._columns = np.empty((self._engine.num_freqs, 0))
+        self._start = 0
+        # the index of the first column that has not yet been searched
+        self._next_column = 0
+        # the local maxima found thus far, and their log-amplitudes
+        self._maxima = []
+        self._values = []
+        # the local maxima at the floor: (first column, packed bitmask) of each
+        # searched span of columns
+        self._floor_maxima = []
+
+    @property
+    def num_columns(self) -> int:
+        """ The number of spectrogram columns computed thus far."""
+        return self._start + self._columns.shape[1]
+
+    def feed(self, block: np.ndarray):
+        """ Appends a block to the signal, and searches the spectrogram columns whose
+        neighborhoods are complete.
+
+        Parameters
+        ----------
+        block : numpy.ndarray, shape=(T,)
+            The next samples of the signal."""
+        self._num_samples += len(block)
+        self._extend(self._engine.feed(block, gain=self.gain))
+        self._search(self.num_columns - self._radius)
+
+    def finish(
+        self, reread: Optional[Callable[[], Iterable[np.ndarray]]] = None
+    ) -> np.ndarray:
+        """ Treats the signal fed thus far as complete, and returns its peaks.
+
+        Parameters
+        ----------
+        reread : Optional[Callable[[], Iterable[numpy.ndarray]]]
+            Returns the blocks of the signal anew; it is called if the exact
+            threshold is needed to decide which of the maxima are peaks. If it is
+            not given, the threshold is instead estimated, as the lower edge of the
+            `CutoffSketch` bin that contains it, and the peaks may include maxima
+            that `local_peak_array` would discard.
+
+        Returns
+        -------
+        numpy.ndarray[PEAK_DTYPE], shape=(N,)
+            The peaks, as returned by `songfp.functions.local_peak_array`."""
+        if not self.num_columns:
+            self._extend(self._engine.feed(self._padding(), gain=self.gain))
+        self._search(self.num_columns)
+        self._engine.reset()
+
+        if self._maxima:
+            peaks = np.concatenate(self._maxima)
+            values = np.concatenate(self._values)
+        else:
+            peaks = np.empty(0, dtype=PEAK_DTYPE)
+            values = np.empty(0)
+        cutoff_bin, rank = self._cutoff.cutoff_bin()
+        # the floor lies in the first bin, and is the cutoff if enough of the
+        # intensities lie at it; otherwise the maxima at the floor are discarded
+        at_floor = not cutoff_bin and rank < self._num_floor
+        if at_floor:
+            cutoff = _FLOOR
+        elif reread is not None and (self._cutoff.bins(values) == cutoff_bin).any():
+            cutoff = self._exact_cutoff(reread(), cutoff_bin, rank)
+        else:
+            # the cutoff's exact value within its bin decides none of the maxima
+            cutoff = self._cutoff.cutoff()
+
+        peaks = peaks[values >= cutoff]
+        if at_floor and self._floor_maxima:
+            peaks = np.sort(np.concatenate([peaks, self._unpack_floor_maxima()]))
+        return peaks
+
+    def _padding(self) -> np.ndarray:
+        # like `digital_to_spec`, zero-pad short signals to one window
+        return np.zeros(max(self._engine.nfft - self._num_samples, 0))
+
+    def _log(self, S: np.ndarray) -> np.ndarray:
+        np.clip(S, a_min=1e-20, a_max=None, out=S)
+        return np.log(S, out=S)
+
+    def _extend(self, S: np.ndarray):
+        if not S.shape[1]:
+            return
+        S = self._log(S)
+        self._cutoff.update(S)
+        self._num_floor += int(np.count_nonzero(S == _FLOOR))
+        self._columns = np.concatenate([self._columns, S], axis=1)
+
+    def _exact_cutoff(self, blocks: Iterable[np.ndarray], cutoff_bin: int, rank: int):
+        # selects the cutoff from the intensities of the bin that contains it; the
+        # intensities at the floor are counted already
+        engine = SpectrogramEngine(
+            self._engine.fs, nfft=self._engine.nfft, noverlap=self._engine.noverlap
+        )
+        if not cutoff_bin:
+            rank -= self._num_floor
+        num_columns = 0
+        in_bin = []
+        for block in blocks:
+            S = self._log(engine.feed(block, gain=self.gain))
+            num_columns += S.shape[1]
+            in_bin.append(S[(self._cutoff.bins(S) == cutoff_bin) & (S != _FLOOR)])
+        if not num_columns:
+            S = self._log(engine.feed(self._padding(), gain=self.gain))
+            in_bin.append(S[(self._cutoff.bins(S) == cutoff_bin) & (S != _FLOOR)])
+        in_bin = np.concatenate(in_bin)
+        return np.partition(in_bin, rank)[rank]
+
+    def _unpack_floor_maxima(self) -> np.ndarray:
+        peaks = []
+        for first_column, packed in self._floor_maxima:
+            is_max = np.unpackbits(packed, axis=0, count=self._engine.num_freqs)
+            ts, fs = np.nonzero(is_max.T)
+            maxima = np.empty(len(ts), dtype=PEAK_DTYPE)
+            maxima["t"] = ts + first_column
+            maxima["f"] = fs
+            peaks.append(maxima)
+        return np.concatenate(peaks)
+
+    def _search(self, stop_column: int):
+        # finds the local maxima of the columns [_next_column, stop_column); each
+        # column's neighborhood lies within the columns held
+        if stop_column <= self._next_column:
+            return
+        S = self._columns
+        is_max = diamond_maximum_filter(S, self._radius) == S
+        begin = self._next_column - self._start
+        is_max = is_max[:, begin : stop_column - self._start]
+        # digital silence is a plateau of maxima, which are kept compactly
+        at_floor = is_max & (S[:, begin : stop_column - self._start] == _FLOOR)
+        if at_floor.any():
+            self._floor_maxima.append(
+                (self._next_column, np.packbits(at_floor, axis=0))
+            )
+            is_max &= ~at_floor
+        ts, fs = np.nonzero(is_max.T)
+
+        maxima = np.empty(len(ts), dtype=PEAK_DTYPE)
+        maxima["t"] = ts + self._next_column
+        maxima["f"] = fs
+        self._maxima.append(maxima)
+        self._values.append(S[fs, ts + begin])
+
+        # keep the context needed by the columns that remain to be searched
+        keep = max(stop_column - self._radius, 0)
+        self._columns = S[:, keep - self._start :].copy()
+        self._start = keep
+        self._next_column = stop_column
+
+
+def file_peaks(
+    path: Union[str, Path],
+    frac_cut: float = 0.77,
+    p_nn: int = 20,
+    sr: int = 44100,
+    nfft: int = NFFT,
+    noverlap: int = NOVERLAP,
+    block_size: int = 2 ** 18,
+) -> np.ndarray:
+    """ Computes the spectrogram peaks of an audio file, decoding it a block at a time.
+
+    Parameters
+    ----------
+    path : PathLike
+        Path to an audio file that `soundfile` can read.
+
+    frac_cut : float, optional (default=0.77)
+    p_nn : int, optional (default=20)
+    sr : int, optional (default=44100)
+    nfft : int, optional (default=NFFT)
+    noverlap : int, optional (default=NOVERLAP)
+        See `songfp.cache.AudioCache.load_peaks`.
+
+    block_size : int, optional (default=2**18)
+        See `decode_blocks`.
+
+    Returns
+    -------
+    numpy.ndarray[PEAK_DTYPE], shape=(N,)
+        The peaks, as returned by `songfp.functions.local_peak_array`. The file is
+        decoded a second time if the exact peak threshold is needed (see
+        `ChunkedPeakFinder.finish`).
+
+    Raises
+    ------
+    RuntimeError
+        `soundfile` cannot read the file."""
+    finder = ChunkedPeakFinder(
+        sr, frac_cut=frac_cut, p_nn=p_nn, nfft=nfft, noverlap=noverlap
+    )
+    for block in decode_blocks(path, sr=sr, block_size=block_size):
+        finder.feed(block)
+    return finder.finish(lambda: decode_blocks(path, sr=sr, block_size=block_size))
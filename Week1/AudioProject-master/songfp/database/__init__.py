@@ -3,20 +3,33 @@ This module contains all of the functionality for managing song databases, inclu
 adding/removing songs to/from a database.
 
 Every song is ascribed a song_id based on its position in database._song_list.
-If a song is removed, that song's fingerprints are removed from the database
-and its entry in database._song_list is replaced with `None`.
+If a song is removed, that song's entry in database._song_list is replaced with `None`,
+and its fingerprints are masked out of the database until the database is compacted.
 """
 
 
 from ._database import database
+from ._index import FingerprintIndex
+from ._shards import ShardedIndex
+from ._storage import convert_pickle_db
 
 
-__all__ = ["load_song_db",
+__all__ = ["FingerprintIndex",
+           "ShardedIndex",
+           "convert_pickle_db",
+           "load_song_db",
            "clear",
            "add_songs",
            "switch_db",
            "list_songs",
-           "remove_song"]
+           "remove_song",
+           "compact",
+           "shard",
+           "unshard",
+           "posting_stats",
+           "set_max_postings",
+           "get_params",
+           "set_params"]
 
 
 def load_song_db(func=None):
@@ -50,7 +63,7 @@ def switch_db(path=None):
     function with no argument will revert to the default database.
 
     Providing a name with no directories will assume songfp/database as the directory,
-    otherwise the provided path is used. All databases will be saved as .pkl files.
+    otherwise the provided path is used. All databases will be saved as .fpdb files.
 
     Parameters
     ----------
@@ -77,7 +90,7 @@ def save():
 
 
 @load_song_db
-def add_songs(songs, names=None, artists=None):
+def add_songs(songs, names=None, artists=None, n_jobs=1):
     """ Add songs to the fingerprinting database
 
         Parameters
@@ -92,11 +105,14 @@ def add_songs(songs, names=None, artists=None):
         artists : Optional[Sequence[Union[str, None]]]
            Corresponding song artists.
 
+        n_jobs : int, optional (default=1)
+           The number of worker processes used to decode and fingerprint the songs.
+
         Notes
         -----
         `add_songs_to_database('path/to/song/SongTitle.mp3')` will log this song in the database
         under the title 'SongTitle'. """
-    database.add_songs(songs, names=names, artists=artists)
+    database.add_songs(songs, names=names, artists=artists, n_jobs=n_jobs)
 
 
 @load_song_db
@@ -109,3 +125,92 @@ def remove_song(name, artist=None):
     database.remove_song(name, artist)
 
 
+@load_song_db
+def compact(wait=False):
+    """ Drop the fingerprints of removed songs from the database, and fold its saved
+    segments into the database file.
+
+    Unsaved changes are saved first, and the compacted database is written to disk
+    on a background thread; there is no need to run `songfp.database.save()`
+    afterwards. This happens automatically when saving, once enough of the database
+    belongs to removed songs.
+
+    Parameters
+    ----------
+    wait : bool, optional (default=False)
+        If `True`, block until the database file has been rewritten."""
+    database.compact(wait=wait)
+
+
+@load_song_db
+def shard(num_shards, by="hash", processes=True):
+    """ Partition the database into shards, against which samples are matched
+    by scatter-gather.
+
+    Parameters
+    ----------
+    num_shards : int
+        The number of shards.
+
+    by : str, optional (default="hash")
+        "hash" to partition by ranges of fingerprint hashes, or "song" to
+        partition by ranges of song-IDs.
+
+    processes : bool, optional (default=True)
+        If `True`, each shard is loaded by a dedicated worker process, and the
+        shards are queried concurrently."""
+    database.shard(num_shards, by=by, processes=processes)
+
+
+def unshard():
+    """ Discard the database's shards, and match against the whole database."""
+    database.unshard()
+
+
+@load_song_db
+def posting_stats():
+    """ Summarize how many times the database's fingerprints occur.
+
+    Returns
+    -------
+    Dict[str, Union[int, float]]
+        See `FingerprintIndex.posting_stats`."""
+    return database.index.posting_stats()
+
+
+@load_song_db
+def set_max_postings(max_postings):
+    """ Ignore the fingerprints that occur more than `max_postings` times in the
+    database when matching. Pass `None` to remove the limit. The fingerprints remain
+    in the database; only matching ignores them.
+
+    You must subsequently run `songfp.database.save()` to save this setting.
+
+    Parameters
+    ----------
+    max_postings : Optional[int]"""
+    database.set_max_postings(max_postings)
+
+
+@load_song_db
+def get_params():
+    """ The parameters with which the database's songs were fingerprinted.
+
+    Returns
+    -------
+    songfp.functions.FingerprintParams"""
+    return database.params
+
+
+@load_song_db
+def set_params(params):
+    """ Set the parameters with which songs, and the samples matched against them,
+    are fingerprinted; the database must not hold any songs.
+
+    You must subsequently run `songfp.database.save()` to save this setting.
+
+    Parameters
+    ----------
+    params : songfp.functions.FingerprintParams
+        e.g. `FingerprintParams(fan_value=10)`"""
+    database.set_params(params)
@@ -1,26 +1,102 @@
-import pickle
-from collections import abc, defaultdict
+import multiprocessing
+import os
+import threading
+from collections import abc
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial, wraps
 from pathlib import Path
-from typing import Dict, List, Optional, Sequence, Tuple, Union
-
-import librosa
-from songfp.functions import digital_to_spec, local_peaks, peaks_to_fingerprints
+from typing import List, NamedTuple, Optional, Sequence, Tuple, Union
+
+import numpy as np
+from songfp.cache import get_cache, use_cache
+from songfp.functions import DEFAULT_PARAMS, FingerprintParams, peaks_to_hashes
+
+from ._index import FingerprintIndex
+from ._shards import ShardedIndex, partition_index
+from ._storage import (
+    DB_SUFFIX,
+    read_database_segments,
+    read_pickle_database,
+    remove_segments,
+    write_database,
+    write_segment,
+)
+
+
+def fingerprint_file(
+    file_path: Union[str, Path], params: FingerprintParams = DEFAULT_PARAMS
+) -> Tuple[np.ndarray, np.ndarray]:
+    """ Decodes an audio file and computes its fingerprints.
+
+    Parameters
+    ----------
+    file_path : PathLike
+        Path to a .mp3, .wav, (and maybe other formats) file.
+
+    params : FingerprintParams, optional (default=DEFAULT_PARAMS)
+        The parameters with which the song is fingerprinted.
+
+    Returns
+    -------
+    Tuple[numpy.ndarray[uint64], numpy.ndarray]
+        The packed fingerprint hashes of the song, and the time at
+        which each fingerprint occurs.
+
+    Notes
+    -----
+    The decoded audio and its peaks are cached (see `songfp.cache`), thus
+    fingerprinting the same file again does not decode it."""
+    peaks = get_cache().load_peaks(
+        file_path,
+        frac_cut=params.frac_cut,
+        p_nn=params.p_nn,
+        sr=44100,
+        nfft=params.nfft,
+        noverlap=params.noverlap,
+    )
+    return peaks_to_hashes(peaks, fan_value=params.fan_value)
+
+
+class Snapshot(NamedTuple):
+    """ An immutable version of a `Database`, as returned by `Database.snapshot`."""
+
+    # incremented each time that the database publishes a new version
+    version: int
+    index: FingerprintIndex
+    # the (song-name, artist) of each song-ID; `None` for removed songs
+    song_list: Tuple[Optional[Tuple[str, Optional[str]]], ...]
+    shards: Optional[ShardedIndex]
+    # the parameters with which samples must be fingerprinted to match the songs
+    params: FingerprintParams
+
+
+def _writes(method):
+    """ Serializes a method that modifies the database, and publishes the database's
+    new version once the method returns."""
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self._publish()
+
+    return wrapper
 
 
 class Database:
     def __init__(self):
-        self.default_path = Path(__file__).parent / "song_db.pkl"
+        self.default_path = Path(__file__).parent / ("song_db" + DB_SUFFIX)
         self.path: Path = self.default_path
-        self.song_list_path = self.path / "_song_list.pkl"
 
         # Stores the mapping: (f1, f2, dt) -> [(song-ID, t1), ...]
         # where (f1, f2, dt) are the frequencies of two peaks and dt is
         # their separation in time. [(song-ID, t1), ...] is the list
         # of all song-IDs that contain this "fingerprint feature", along
         # with the time at which it occurs.
-        self.pair_mapping: Dict[
-            Tuple[int, int, int], List[Tuple[int, int]]
-        ] = defaultdict(list)
+        # See `FingerprintIndex` for details of the array-based layout.
+        self.index = FingerprintIndex()
 
         # A list of (song-name, artist)
         # Items should not be removed from this list! The song-ID in the
@@ -28,30 +104,96 @@ class Database:
         # Instead, a song is removed by replacing its tuple with None
         self.song_list: List[Optional[Tuple[str, Optional[str]]], ...] = list()
 
+        # The parameters with which the songs were fingerprinted; these are saved
+        # with the database, and samples are fingerprinted with them too
+        self.params: FingerprintParams = DEFAULT_PARAMS
+
+        # Removed songs' fingerprints remain in the index, masked, until it
+        # is compacted. Saving compacts the database once the fraction of its
+        # postings that belong to removed songs exceeds this threshold, or once
+        # more than `max_segments` segments have been saved.
+        self.compact_fraction = 0.25
+        self.max_segments = 16
+
         self._loaded = False
 
+        # Saving appends the changes made since the last save as a segment
+        # (see `songfp.database._storage`), rather than rewriting the database.
+        # `_rewrite` is set when the database file must be written in full.
+        self._rewrite = True
+        self._segment = 0  # the sequence number of the last segment saved or loaded
+        self._num_segments = 0  # the number of segments not folded into the database file
+        self._num_saved = 0  # the number of songs in `song_list` at the last save
+        self._saved_max_postings = None  # `index.max_postings` at the last save
+        self._unsaved = []  # the (keys, song-IDs, times) added since the last save
+        self._unsaved_removals = []  # the song-IDs removed since the last save
+        self._compaction: Optional[threading.Thread] = None
+
+        # When set (see `shard`), samples are matched against these shards
+        # rather than against `index`
+        self.shards: Optional[ShardedIndex] = None
+        self._num_shardings = 0  # distinguishes the files of successive shardings
+
+        # Readers match against the most recently published `Snapshot`, which is
+        # never modified; writers - serialized by `_lock` - modify `index` and
+        # `song_list`, and then publish a new snapshot by replacing `_snapshot`,
+        # which is atomic. Readers thus never block on, or race with, writers.
+        self._lock = threading.RLock()
+        self._snapshot: Optional[Snapshot] = None
+        self._publish()
+
     def __len__(self):
         return len(self.song_list)
 
+    def snapshot(self) -> Snapshot:
+        """ Returns the current version of the database, loading it if need be.
+
+        The snapshot is immutable: songs that are added or removed afterwards (e.g.
+        by another thread) are reflected by later snapshots, not by this one.
+        Matching against a snapshot is thus safe while the database is modified.
+
+        Returns
+        -------
+        Snapshot"""
+        self.load()
+        return self._snapshot
+
+    def _publish(self):
+        version = 0 if self._snapshot is None else self._snapshot.version + 1
+        self._snapshot = Snapshot(
+            version,
+            self.index.snapshot(),
+            tuple(self.song_list),
+            self.shards,
+            self.params,
+        )
+
+    @_writes
     def clear(self):
         """Clears the database"""
-        self.pair_mapping.clear()
+        self.unshard()
+        self.index = FingerprintIndex()
         self.song_list = list()
         self._loaded = False
+        self._rewrite = True
+        self._mark_saved()
 
+    @_writes
     def switch_db(self, path=None):
         """ Switch the song database being used by specifying its load/save path. Calling this
         function with no argument will revert to the default database.
 
         Providing a name with no directories will assume songfp/database as the directory,
-        otherwise the provided path is used. All databases will be saved as .pkl files.
+        otherwise the provided path is used. All databases will be saved as .fpdb files.
 
         Parameters
         ----------
         path : PathLike"""
 
-        _backup_db = self.pair_mapping
+        _backup_db = self.index
+        _backup_songs = self.song_list
         _backup_path = self.path
+        _backup_params = self.params
         _loaded = self._loaded
 
         try:
@@ -60,12 +202,13 @@ class Database:
                 parent = (
                     path.parent if str(path.parent) != "." else self.default_path.parent
                 )
-                self.path = parent / (path.stem + ".pkl")
+                self.path = parent / (path.stem + DB_SUFFIX)
                 assert self.path.parent.exists(), f"{self.path.parent} doesn't exist"
             else:
                 self.path = self.default_path
             self._loaded = False
-            self.pair_mapping = defaultdict(list)
+            self.index = FingerprintIndex()
+            self.params = DEFAULT_PARAMS
             self.load()
 
         except Exception as e:
@@ -75,18 +218,25 @@ class Database:
                     _backup_path.absolute()
                 )
             )
-            self.pair_mapping = _backup_db
+            self.index = _backup_db
+            self.song_list = _backup_songs
             self.path = _backup_path
+            self.params = _backup_params
             self._loaded = _loaded
             raise e
 
     def load(self, force=False):
-        """ Load the database from songfp/database/song_db.pkl if it isn't
+        """ Load the database from songfp/database/song_db.fpdb if it isn't
         already loaded.
 
         Call this if you want to load the database up front. Otherwise,
         the other database methods will automatically load it.
 
+        The fingerprint index is memory-mapped from the database file, thus
+        loading is fast regardless of the size of the database. If only a
+        database saved in the legacy pickle format is present, it is read
+        instead; saving the database will write it in the new format.
+
         Parameters
         ----------
         force : bool, optional (default=False)
@@ -94,72 +244,200 @@ class Database:
             is already in-memory."""
         if not force and self._loaded:
             return
-
-        if not self.path.is_file():
+        with self._lock:
+            if not force and self._loaded:
+                # loaded by another thread in the meantime
+                return
+            try:
+                self._load()
+            finally:
+                self._publish()
+
+    def _load(self):
+        self._wait_for_compaction()
+        self.unshard()
+        legacy_path = self.path.with_suffix(".pkl")
+
+        if self.path.is_file():
+            self.index, self.song_list, header = read_database_segments(self.path)
+            # databases saved before the parameters were recorded used the defaults
+            self.params = FingerprintParams.from_dict(header.get("params", {}))
+            self._segment = header["segment"]
+            self._num_segments = header["num_segments"]
+            self._rewrite = False
+            print("song database loaded from: {}".format(self.path.absolute()))
+        elif legacy_path.is_file():
+            self.index, self.song_list = read_pickle_database(legacy_path)
+            self.params = DEFAULT_PARAMS
+            print("song database loaded from: {}".format(legacy_path.absolute()))
+            print(
+                "\tThis database is stored in the legacy pickle format. "
+                "Saving it will save to {}".format(self.path.absolute())
+            )
+        else:
             print(
                 "No song database found. Creating empty database...\n"
                 "\tSaving it will save to {}".format(self.path.absolute())
             )
-            self.pair_mapping = defaultdict(list)
+            self.index = FingerprintIndex()
             self.song_list = list()
-        else:
-            with self.path.open(mode="rb") as f:
-                data = pickle.load(f)
-
-            assert isinstance(
-                data, defaultdict
-            ), f"the loaded database should be a defaultdict, got: {data}"
-
-            self.pair_mapping = data
-
-            with (self.path.parent / (self.path.stem + "_song_list.pkl")).open(
-                mode="rb"
-            ) as f:
-                song_list = pickle.load(f)
-
-            assert isinstance(
-                song_list, list
-            ), f"the loaded song_list should be a list, got: {song_list}"
-
-            self.song_list = song_list
-            print("song database loaded from: {}".format(self.path.absolute()))
+        if not self.path.is_file():
+            self._rewrite = True
+        self.index.remove_songs(
+            song_id for song_id, entry in enumerate(self.song_list) if entry is None
+        )
+        self._mark_saved()
         self._loaded = True
 
+    @_writes
     def remove_song(self, name: str, artist: Optional[str] = None):
         try:
             # do not delete items from song list. song_id in database
             # is determined by song's position in song list. Removing
             # song will create offset in results.
             song_id = self.song_list.index((name, artist))
+            self.unshard()
             self.song_list[song_id] = None
-
-            for key, value in self.pair_mapping.items():
-                self.pair_mapping[key] = [x for x in value if x[0] != song_id]
+            self.index.remove_song(song_id)  # O(1): the song is masked until `compact`
+            self._unsaved_removals.append(song_id)
 
             print("{} removed from database. Be sure to save.".format((name, artist)))
         except ValueError:
             print("{} not in database".format((name, artist)))
 
+    @_writes
     def save(self):
-        if self.pair_mapping is None:
-            print("No changes to face-database to save")
+        """ Save the changes made to the database.
+
+        The first save of a database writes the whole database file; subsequent
+        saves only append the songs added and removed since the previous save, as
+        a segment. Once enough segments accumulate, or enough of the database
+        belongs to removed songs, the database is compacted (see `compact`)."""
+        if self._rewrite or not self.path.is_file():
+            self._write_database()
+        elif self._has_changes():
+            self._write_segment()
+        else:
+            print("No changes to song database to save")
             return None
+        print("Song database saved to: {}".format(self.path.absolute()))
 
-        with self.path.open(mode="wb") as f:
-            pickle.dump(self.pair_mapping, f)
+        if (
+            self._num_segments > self.max_segments
+            or self.index.num_dead > self.compact_fraction * len(self.index)
+        ):
+            self.compact()
 
-        with (self.path.parent / (self.path.stem + "_song_list.pkl")).open(
-            mode="wb"
-        ) as f:
-            pickle.dump(self.song_list, f)
+    @_writes
+    def compact(self, wait: bool = False):
+        """ Reclaims the space occupied by the fingerprints of removed songs, and
+        folds the saved segments into the database file.
 
-        print("Song database saved to: {}".format(self.path.absolute()))
+        Unsaved changes are saved first. Removing a song only masks its fingerprints;
+        this drops them from the index, in time proportional to the size of the index.
+        The database file is then rewritten in a background thread; the database can
+        be used, modified, and saved in the meantime.
 
+        Parameters
+        ----------
+        wait : bool, optional (default=False)
+            If `True`, block until the database file has been rewritten."""
+        self._wait_for_compaction()
+
+        num_dead = self.index.num_dead
+        self.index.compact()
+        if num_dead:
+            print("{} fingerprints of removed songs dropped".format(num_dead))
+
+        if self._rewrite or not self.path.is_file():
+            self._write_database()
+            return
+
+        if self._has_changes():
+            self._write_segment()
+
+        # the snapshot is unaffected by songs that are added while the file is
+        # being written
+        index = self.index.snapshot()
+        self._compaction = threading.Thread(
+            target=self._fold_segments,
+            args=(self.path, index, list(self.song_list), self._metadata()),
+        )
+        self._num_segments = 0
+        self._compaction.start()
+        if wait:
+            self._wait_for_compaction()
+
+    @staticmethod
+    def _fold_segments(path: Path, index: FingerprintIndex, song_list, metadata):
+        try:
+            write_database(path, index, song_list, metadata=metadata)
+            remove_segments(path, metadata["segment"])
+        except Exception as e:
+            print("Compacting {} failed: {}".format(path.absolute(), e))
+
+    def _wait_for_compaction(self):
+        if self._compaction is not None:
+            self._compaction.join()
+            self._compaction = None
+
+    def _has_changes(self) -> bool:
+        return bool(
+            self._unsaved
+            or self.index.max_postings != self._saved_max_postings
+            or self._unsaved_removals
+            or len(self.song_list) > self._num_saved
+        )
+
+    def _mark_saved(self):
+        self._num_saved = len(self.song_list)
+        self._saved_max_postings = self.index.max_postings
+        self._unsaved = []
+        self._unsaved_removals = []
+
+    def _metadata(self) -> dict:
+        # the header entries that accompany the index and song list
+        return dict(segment=self._segment, params=self.params._asdict())
+
+    def _write_database(self):
+        # writes the entire database; every existing segment is superseded
+        self._wait_for_compaction()
+        if self.index.num_dead > self.compact_fraction * len(self.index):
+            self.index.compact()
+        write_database(self.path, self.index, self.song_list, metadata=self._metadata())
+        remove_segments(self.path, self._segment)
+        self._rewrite = False
+        self._num_segments = 0
+        self._mark_saved()
+
+    def _write_segment(self):
+        # appends the changes made since the last save
+        if self._unsaved:
+            keys, song_ids, times = (np.concatenate(x) for x in zip(*self._unsaved))
+            added = FingerprintIndex.from_postings(keys, song_ids, times)
+        else:
+            added = FingerprintIndex()
+        added.max_postings = self.index.max_postings
+        self._segment += 1
+        write_segment(
+            self.path,
+            self._segment,
+            added,
+            self.song_list[self._num_saved :],
+            self._num_saved,
+            self._unsaved_removals,
+            metadata=dict(params=self.params._asdict()),
+        )
+        self._num_segments += 1
+        self._mark_saved()
+
+    @_writes
     def add_songs(
         self,
         songs: Union[Path, Sequence[Path]],
         names: Optional[Union[Path, Sequence[Path]]] = None,
         artists: Optional[Union[Path, Sequence[Path]]] = None,
+        n_jobs: int = 1,
     ):
         """ Add songs to the fingerprinting database
 
@@ -175,10 +453,17 @@ class Database:
         artists : Optional[Sequence[Union[str, None]]]
            Corresponding song artists.
 
+        n_jobs : int, optional (default=1)
+           The number of worker processes used to decode and fingerprint the songs.
+           The fingerprints are merged into the database by this process. Song-IDs
+           are assigned in the order in which the songs are provided, regardless
+           of `n_jobs`.
+
         Notes
         -----
         `add_songs('path/to/song/SongTitle.mp3')` will log this song
         in the database under the title 'SongTitle'. """
+        assert 1 <= n_jobs
 
         if isinstance(songs, str):
             songs = [songs]
@@ -195,23 +480,61 @@ class Database:
 
         old_num = len(self.song_list)
 
+        # Song-IDs are assigned up front, so that they do not depend on
+        # the order in which the worker processes finish
+        to_add = []
+        known = set(self.song_list)
         for file_path, name, artist in zip(songs, names, artists):
-            song_id = len(self.song_list)
             if name is None:
                 name = Path(file_path).name
 
-            if (name, artist) in self.song_list:
+            if (name, artist) in known:
                 print("{} already in song database. Skipping song.".format(name))
                 continue
-            print("adding {}..".format(name))
-
-            digital, fs = librosa.load(file_path, sr=44100, mono=True)
-            peaks = local_peaks(*digital_to_spec(digital, fs, frac_cut=0.77), p_nn=20)
-
-            for f1_f2_dt, t1 in peaks_to_fingerprints(peaks, fan_value=15):
-                self.pair_mapping[f1_f2_dt].append((song_id, t1))
-
-            self.song_list.append((name, artist))
+            known.add((name, artist))
+            to_add.append((file_path, (name, artist)))
+
+        new_keys, new_ids, new_times = [], [], []
+        files = [file_path for file_path, _ in to_add]
+
+        executor = None
+        if n_jobs > 1:
+            # the workers use this process's cache, which may have been configured;
+            # forking this process, which may be running threads (e.g. a compaction,
+            # or a server's), can deadlock the workers, thus they are spawned
+            executor = ProcessPoolExecutor(
+                n_jobs,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=use_cache,
+                initargs=(get_cache(),),
+            )
+        try:
+            # results are streamed back in the order that the songs were submitted
+            fingerprints = (executor.map if executor else map)(
+                partial(fingerprint_file, params=self.params), files
+            )
+            for song_id, (_, entry), (hashes, t1) in zip(
+                range(old_num, old_num + len(to_add)), to_add, fingerprints
+            ):
+                print("adding {}..".format(entry[0]))
+                new_keys.append(hashes)
+                new_ids.append(np.full(len(t1), song_id))
+                new_times.append(t1)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        if new_keys:
+            added = (
+                np.concatenate(new_keys),
+                np.concatenate(new_ids),
+                np.concatenate(new_times),
+            )
+            self.index.add(*added)
+            self._unsaved.append(added)
+        self.song_list.extend(entry for _, entry in to_add)
+        if to_add:
+            self.unshard()
 
         if len(self.song_list) - old_num:
             print(
@@ -221,6 +544,112 @@ class Database:
                 )
             )
 
+    @_writes
+    def shard(self, num_shards: int, by: str = "hash", processes: bool = True):
+        """ Partition the fingerprint index into shards, against which samples are
+        matched by scatter-gather.
+
+        The shards are discarded when songs are added or removed, and must be
+        created anew. Snapshots taken while the database is sharded keep matching
+        against their shards; the shards' worker processes are shut down, and their
+        files deleted, once no snapshot references them.
+
+        Parameters
+        ----------
+        num_shards : int
+            The number of shards.
+
+        by : str, optional (default="hash")
+            "hash" to partition the index by ranges of fingerprint hashes, or
+            "song" to partition it by ranges of song-IDs.
+
+        processes : bool, optional (default=True)
+            If `True`, each shard is written alongside the database file, as
+            `<name>.shard-<n>.fpdb`, and is loaded by a dedicated worker process;
+            the shards are then queried concurrently. Otherwise, the shards are
+            held by this process."""
+        self.unshard()
+        shards, bounds = partition_index(self.index, num_shards, by=by)
+        if processes:
+            # the files of earlier shardings may still be in use by old snapshots
+            self._num_shardings += 1
+            paths = []
+            for n, shard in enumerate(shards):
+                path = self.path.parent / "{}.shard-{}-{}-{}{}".format(
+                    self.path.stem, os.getpid(), self._num_shardings, n, DB_SUFFIX
+                )
+                write_database(
+                    path, shard, [], metadata=dict(shard=n, num_shards=num_shards, by=by)
+                )
+                paths.append(path)
+            shards = paths
+        self.shards = ShardedIndex(shards, bounds, remove_files=processes)
+
+    @_writes
+    def unshard(self):
+        """ Discard the shards created by `shard`.
+
+        Snapshots that still hold the shards keep matching against them; the shards
+        are closed once the last of these is dropped (see `ShardedIndex`)."""
+        self.shards = None
+
+    @_writes
+    def set_max_postings(self, max_postings: Optional[int]):
+        """ Treat the fingerprints that occur more than `max_postings` times in the
+        database as stop-words: they are ignored when matching.
+
+        Such fingerprints (e.g. from low-frequency hum or silence) are shared by many
+        songs, thus they are costly to look up but do little to discriminate between
+        songs. See `FingerprintIndex.posting_stats` for the distribution of the number
+        of times that fingerprints occur. The setting is saved with the database.
+
+        This filters lookups only: the fingerprints remain in the database, which
+        is no smaller for it, and the limit can be raised or removed later.
+
+        Parameters
+        ----------
+        max_postings : Optional[int]
+            The maximum number of occurrences; `None` removes the limit."""
+        assert max_postings is None or 1 <= max_postings
+        self.index.max_postings = max_postings
+        self.unshard()
+
+    @_writes
+    def set_params(self, params: FingerprintParams):
+        """ Set the parameters with which songs, and the samples matched against
+        them, are fingerprinted.
+
+        Songs fingerprinted with one set of parameters cannot be matched against
+        samples fingerprinted with another, thus the parameters can only be changed
+        while the database holds no songs. The parameters are saved with the
+        database; on loading, they are restored, and samples are fingerprinted with
+        them (see `songfp.match_sample`).
+
+        Parameters
+        ----------
+        params : FingerprintParams
+            See `benchmarks/bench_params.py` for how each parameter trades the size
+            of the index against the time taken to add songs and to match samples.
+
+        Raises
+        ------
+        ValueError
+            If a parameter is out of range, or if the database holds songs."""
+        params = FingerprintParams(*params).validate()
+        if params == self.params:
+            return
+        if any(entry is not None for entry in self.song_list):
+            raise ValueError(
+                "the songs in the database were fingerprinted with {}; remove them "
+                "(or switch to a new database) before changing the parameters".format(
+                    self.params
+                )
+            )
+        self.params = params
+        # every segment must share the parameters of the database file
+        self._rewrite = True
+        self.unshard()
+
     def list_songs(self):
         return sorted(x for x in self.song_list if x is not None)
 
@@ -0,0 +1,544 @@
+"""
+A compact, columnar fingerprint index.
+
+The index stores the same information as the mapping
+
+    (f1, f2, dt) -> [(song-ID, t1), ...]
+
+but in a handful of flat NumPy arrays, laid out like a CSR sparse matrix:
+
+ - `keys`: the sorted, unique packed fingerprint keys (see `songfp.functions.pack_fingerprints`)
+ - `offsets`: the postings of `keys[i]` are stored in `[offsets[i], offsets[i + 1])`
+ - `song_ids`, `times`: the (song-ID, t1) postings, in parallel arrays
+
+Within a key, postings are kept in the order in which they were added. This
+preserves the behavior of the original list-of-tuples mapping.
+
+Adding postings to an index whose arrays are memory-mapped (e.g. one loaded by
+`songfp.database._storage.read_database`) would copy the mapped arrays into private
+memory. Such postings are instead held in a second, in-memory index - the overlay -
+which lookups consult alongside the mapped arrays; `flatten` merges the two.
+
+Removing a song merely marks its song-ID with a tombstone, which lookups filter
+out; this costs O(1), regardless of the size of the index. `compact` physically
+drops the postings of removed songs.
+
+Some keys (e.g. those produced by low-frequency hum, or by silence) occur in a great
+many songs; their long posting lists dominate the cost of matching while contributing
+little to it. `posting_stats` summarizes the lengths of the posting lists. Setting
+`max_postings` makes lookups ignore the keys whose posting lists exceed that length,
+as though they were stop-words, and `idf` weighs the remaining keys by their rarity.
+The cap filters lookups only: the postings of such keys are still stored, thus the
+cap can be raised, or removed, later.
+"""
+
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+import numpy as np
+
+from songfp import instrument
+from songfp.functions import pack_fingerprints, unpack_fingerprints
+
+__all__ = ["FingerprintIndex"]
+
+KEY_DTYPE = np.uint64
+OFFSET_DTYPE = np.int64
+SONG_ID_DTYPE = np.int32
+TIME_DTYPE = np.int32
+
+
+class FingerprintIndex:
+    def __init__(
+        self,
+        keys: Optional[np.ndarray] = None,
+        offsets: Optional[np.ndarray] = None,
+        song_ids: Optional[np.ndarray] = None,
+        times: Optional[np.ndarray] = None,
+    ):
+        """ Parameters
+        ----------
+        keys : Optional[numpy.ndarray[uint64]], shape=(K,)
+            Sorted, unique packed fingerprint keys.
+
+        offsets : Optional[numpy.ndarray[int64]], shape=(K + 1,)
+            CSR offsets into the posting arrays.
+
+        song_ids : Optional[numpy.ndarray[int32]], shape=(N,)
+            The song-ID of each posting.
+
+        times : Optional[numpy.ndarray[int32]], shape=(N,)
+            The time-bin, t1, of each posting."""
+        if keys is None:
+            keys = np.empty(0, dtype=KEY_DTYPE)
+            offsets = np.zeros(1, dtype=OFFSET_DTYPE)
+            song_ids = np.empty(0, dtype=SONG_ID_DTYPE)
+            times = np.empty(0, dtype=TIME_DTYPE)
+
+        assert len(offsets) == len(keys) + 1
+        assert len(song_ids) == len(times) == offsets[-1]
+        self.keys = keys
+        self.offsets = offsets
+        self.song_ids = song_ids
+        self.times = times
+
+        # tombstones[song_id] is True if the song has been removed
+        self.tombstones = np.zeros(0, dtype=bool)
+        # the number of postings of each song-ID; computed upon first use
+        self._song_sizes: Optional[np.ndarray] = None
+
+        # keys with more postings than this are ignored by lookups
+        self.max_postings: Optional[int] = None
+
+        # the postings added since the arrays were memory-mapped (see `add`)
+        self.overlay: Optional[FingerprintIndex] = None
+
+    def __len__(self) -> int:
+        """ The total number of postings in the index, including those of
+        removed songs that have not yet been compacted away."""
+        return sum(len(layer.song_ids) for layer in self._layers())
+
+    def __setstate__(self, state):
+        # indices pickled before tombstones were introduced lack these
+        state.setdefault("tombstones", np.zeros(0, dtype=bool))
+        state.setdefault("_song_sizes", None)
+        state.setdefault("max_postings", None)
+        state.setdefault("overlay", None)
+        self.__dict__.update(state)
+
+    def _layers(self) -> List["FingerprintIndex"]:
+        # the indices whose arrays hold this index's postings
+        return [self] if self.overlay is None else [self, self.overlay]
+
+    @property
+    def song_sizes(self) -> np.ndarray:
+        """ The number of postings stored for each song-ID."""
+        if self._song_sizes is None:
+            sizes = np.zeros(len(self.tombstones), dtype=np.intp)
+            for layer in self._layers():
+                sizes = _add_counts(sizes, np.bincount(layer.song_ids))
+            self._song_sizes = sizes
+        return self._song_sizes
+
+    @property
+    def num_dead(self) -> int:
+        """ The number of postings that belong to removed songs."""
+        sizes = self.song_sizes
+        removed = np.flatnonzero(self.tombstones)
+        return int(sizes[removed[removed < len(sizes)]].sum())
+
+    def _live(self, song_ids: np.ndarray) -> Optional[np.ndarray]:
+        # boolean mask of the postings whose songs are not removed;
+        # `None` if no song has been removed
+        if not self.tombstones.any():
+            return None
+        size = max(len(self.tombstones), int(song_ids.max(initial=-1)) + 1)
+        removed = np.zeros(size, dtype=bool)
+        removed[: len(self.tombstones)] = self.tombstones
+        return ~removed[song_ids]
+
+    @property
+    def num_keys(self) -> int:
+        if self.overlay is None:
+            return len(self.keys)
+        return len(np.union1d(self.keys, self.overlay.keys))
+
+    @property
+    def num_songs(self) -> int:
+        """ The number of songs, excluding removed songs, that have postings."""
+        sizes = self.song_sizes.copy()
+        removed = np.flatnonzero(self.tombstones)
+        sizes[removed[removed < len(sizes)]] = 0
+        return int(np.count_nonzero(sizes))
+
+    @property
+    def max_time(self) -> int:
+        """ The latest time of any posting, or -1 if the index is empty; postings of
+        removed songs are included."""
+        return max(
+            (int(layer.times.max()) for layer in self._layers() if len(layer.times)),
+            default=-1,
+        )
+
+    def posting_lengths(self) -> np.ndarray:
+        """ Returns the length of each key's posting list, shape=(K,)."""
+        return np.diff(self.flatten().offsets)
+
+    def posting_stats(self) -> Dict[str, Union[int, float]]:
+        """ Summarizes the lengths of the posting lists.
+
+        Returns
+        -------
+        Dict[str, Union[int, float]]
+            The number of keys and of postings; the mean, median, 90th, 99th,
+            and 99.9th percentile, and maximum posting-list length; and the
+            fraction of all postings held by the 1% of keys with the longest
+            posting lists."""
+        lengths = self.posting_lengths()
+        if not len(lengths):
+            lengths = np.zeros(1, dtype=OFFSET_DTYPE)
+        p50, p90, p99, p999 = np.percentile(lengths, [50, 90, 99, 99.9])
+        top = np.sort(lengths)[::-1][: max(1, len(lengths) // 100)]
+        return dict(
+            num_keys=self.num_keys,
+            num_postings=len(self),
+            mean=float(lengths.mean()),
+            median=float(p50),
+            p90=float(p90),
+            p99=float(p99),
+            p999=float(p999),
+            max=int(lengths.max()),
+            top_1pct_share=float(top.sum() / max(1, lengths.sum())),
+        )
+
+    def stop_list(self, max_postings: int) -> np.ndarray:
+        """ Returns the keys whose posting lists are longer than `max_postings`.
+
+        Parameters
+        ----------
+        max_postings : int
+
+        Returns
+        -------
+        numpy.ndarray[uint64], shape=(S,)"""
+        flat = self.flatten()
+        return flat.keys[flat.posting_lengths() > max_postings]
+
+    def idf(self, keys: np.ndarray) -> np.ndarray:
+        """ Computes the inverse document frequency of each key:
+        `log(1 + num_songs / num_postings)`.
+
+        A key's postings stand in for the number of songs that contain it; a key
+        that is absent from the index receives the weight of a key with one posting.
+
+        Parameters
+        ----------
+        keys : numpy.ndarray[uint64], shape=(Q,)
+
+        Returns
+        -------
+        numpy.ndarray[float64], shape=(Q,)"""
+        lengths = self._lengths(np.asarray(keys, dtype=KEY_DTYPE))
+        return np.log1p(self.num_songs / np.maximum(lengths, 1))
+
+    def _ranges(self, keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # for each of `keys` that occurs in this index's own arrays (not in its
+        # overlay): its position in `keys`, and the start and length of its postings
+        if not len(self.keys):
+            empty = np.empty(0, dtype=np.intp)
+            return empty, empty.astype(OFFSET_DTYPE), empty.astype(OFFSET_DTYPE)
+        where = np.searchsorted(self.keys, keys)
+        where[where == len(self.keys)] = 0
+        query = np.flatnonzero(self.keys[where] == keys)
+        starts = self.offsets[where[query]]
+        return query, starts, self.offsets[where[query] + 1] - starts
+
+    def _lengths(self, keys: np.ndarray) -> np.ndarray:
+        # the number of postings of each key, shape=(Q,)
+        lengths = np.zeros(len(keys), dtype=OFFSET_DTYPE)
+        for layer in self._layers():
+            query, _, counts = layer._ranges(keys)
+            lengths[query] += counts
+        return lengths
+
+    @classmethod
+    def from_postings(
+        cls, keys: np.ndarray, song_ids: np.ndarray, times: np.ndarray
+    ) -> "FingerprintIndex":
+        """ Builds an index from (unsorted) parallel posting arrays.
+
+        Postings that share a key retain their relative order.
+
+        Parameters
+        ----------
+        keys : numpy.ndarray[uint64], shape=(N,)
+        song_ids : numpy.ndarray[int], shape=(N,)
+        times : numpy.ndarray[int], shape=(N,)
+
+        Returns
+        -------
+        FingerprintIndex"""
+        keys = np.asarray(keys, dtype=KEY_DTYPE)
+        order = np.argsort(keys, kind="stable")
+        return cls._from_sorted(
+            keys[order],
+            np.asarray(song_ids, dtype=SONG_ID_DTYPE)[order],
+            np.asarray(times, dtype=TIME_DTYPE)[order],
+        )
+
+    @classmethod
+    def from_mapping(
+        cls, mapping: Dict[Tuple[int, int, int], List[Tuple[int, int]]]
+    ) -> "FingerprintIndex":
+        """ Builds an index from a legacy `(f1, f2, dt) -> [(song-ID, t1), ...]` mapping.
+
+        Parameters
+        ----------
+        mapping : Dict[Tuple[int, int, int], List[Tuple[int, int]]]
+
+        Returns
+        -------
+        FingerprintIndex"""
+        features = [k for k, v in mapping.items() if v]
+        counts = [len(mapping[k]) for k in features]
+        if not features:
+            return cls()
+        f1, f2, dt = zip(*features)
+        keys = np.repeat(pack_fingerprints(f1, f2, dt), counts)
+        postings = np.array(
+            [posting for k in features for posting in mapping[k]], dtype=np.int64
+        )
+        return cls.from_postings(keys, postings[:, 0], postings[:, 1])
+
+    @classmethod
+    def _from_sorted(
+        cls, keys: np.ndarray, song_ids: np.ndarray, times: np.ndarray
+    ) -> "FingerprintIndex":
+        # `keys` holds one (sorted) key per posting; collapse it into CSR form
+        if not len(keys):
+            return cls()
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        offsets = np.r_[starts, len(keys)].astype(OFFSET_DTYPE)
+        return cls(keys[starts], offsets, song_ids, times)
+
+    def posting_keys(self) -> np.ndarray:
+        """ Returns the key of every posting, shape=(N,), in the order of the
+        postings of `flatten()`."""
+        flat = self.flatten()
+        return np.repeat(flat.keys, np.diff(flat.offsets))
+
+    def get(
+        self, f1_f2_dt: Tuple[int, int, int], default=None
+    ) -> Optional[List[Tuple[int, int]]]:
+        """ Mimics `dict.get` for a single `(f1, f2, dt)` fingerprint feature.
+
+        Parameters
+        ----------
+        f1_f2_dt : Tuple[int, int, int]
+
+        default : Any, optional (default=None)
+            Returned if the feature is not in the index, or exceeds `max_postings`.
+
+        Returns
+        -------
+        Union[List[Tuple[int, int]], default]
+            The [(song-ID, t1), ...] postings for the feature."""
+        key = np.atleast_1d(pack_fingerprints(*f1_f2_dt))
+        _, song_ids, times = self.lookup(key)
+        if not len(song_ids):
+            return default
+        return list(zip(song_ids.tolist(), times.tolist()))
+
+    def lookup(self, keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """ Looks up the postings for many keys at once.
+
+        Parameters
+        ----------
+        keys : numpy.ndarray[uint64], shape=(Q,)
+            Packed fingerprint keys.
+
+        Returns
+        -------
+        Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]
+            (query, song_ids, times), each of shape (M,): for each posting that
+            matched a key, the position of that key in `keys`, along with the
+            posting's song-ID and time. Postings are ordered by query position,
+            and then by the order in which they were added to the index. The
+            postings of removed songs, and of keys with more than `max_postings`
+            postings, are excluded."""
+        keys = np.asarray(keys, dtype=KEY_DTYPE)
+        if not len(self):
+            empty = np.empty(0, dtype=np.intp)
+            return empty, self.song_ids[:0], self.times[:0]
+
+        with instrument.timer("lookup"):
+            ranges = [(layer, *layer._ranges(keys)) for layer in self._layers()]
+            if self.max_postings is not None:
+                lengths = np.zeros(len(keys), dtype=OFFSET_DTYPE)
+                for _, query, _, counts in ranges:
+                    lengths[query] += counts
+                common = lengths > self.max_postings
+
+            hits, parts = [], []
+            for layer, query, starts, counts in ranges:
+                if self.max_postings is not None:
+                    counts[common[query]] = 0
+
+                # gather the posting ranges [start, start + count) of each hit
+                ends = np.cumsum(counts)
+                positions = np.arange(ends[-1] if len(ends) else 0, dtype=OFFSET_DTYPE)
+                positions += np.repeat(starts - (ends - counts), counts)
+                hits.append(query)
+                parts.append(
+                    (
+                        np.repeat(query, counts),
+                        layer.song_ids[positions],
+                        layer.times[positions],
+                    )
+                )
+
+            query, song_ids, times = parts[0]
+            if len(parts) > 1:
+                # a key's postings in the overlay follow those in the mapped arrays
+                query, song_ids, times = (np.concatenate(x) for x in zip(*parts))
+                order = np.argsort(query, kind="stable")
+                query, song_ids, times = query[order], song_ids[order], times[order]
+                hits = [np.union1d(*hits)]
+            num_scanned = len(query)
+            live = self._live(song_ids)
+            if live is not None:
+                query, song_ids, times = query[live], song_ids[live], times[live]
+        instrument.count("hashes_hit", len(hits[0]))
+        instrument.count("postings_scanned", num_scanned)
+        instrument.count("matches", len(query))
+        return query, song_ids, times
+
+    def items(self):
+        """ Yields `((f1, f2, dt), [(song-ID, t1), ...])` for each key in the index."""
+        flat = self.flatten()
+        f1, f2, dt = unpack_fingerprints(flat.keys)
+        live = self._live(flat.song_ids)
+        song_ids = flat.song_ids.tolist()
+        times = flat.times.tolist()
+        offsets = flat.offsets.tolist()
+        for n, feature in enumerate(zip(f1.tolist(), f2.tolist(), dt.tolist())):
+            start, stop = offsets[n], offsets[n + 1]
+            postings = [
+                posting
+                for i, posting in enumerate(
+                    zip(song_ids[start:stop], times[start:stop]), start
+                )
+                if live is None or live[i]
+            ]
+            if postings:
+                yield feature, postings
+
+    def add(self, keys: np.ndarray, song_ids: np.ndarray, times: np.ndarray):
+        """ Adds postings to the index.
+
+        New postings are placed after the existing postings that share their key.
+        If the index's arrays are memory-mapped, the postings are merged into its
+        overlay instead, in time proportional to the size of the overlay.
+
+        Parameters
+        ----------
+        keys : numpy.ndarray[uint64], shape=(M,)
+        song_ids : numpy.ndarray[int], shape=(M,)
+        times : numpy.ndarray[int], shape=(M,)"""
+        new = type(self).from_postings(keys, song_ids, times)
+        if not len(new):
+            return
+        if self._song_sizes is not None:
+            self._song_sizes = _add_counts(self._song_sizes, np.bincount(new.song_ids))
+        if self.overlay is None and isinstance(self.keys, np.memmap):
+            self.overlay = type(self)()
+        if self.overlay is not None:
+            self.overlay._assign(self.overlay._merged(new))
+        else:
+            self._assign(self._merged(new))
+
+    def _merged(self, new: "FingerprintIndex") -> "FingerprintIndex":
+        # this index's own arrays merged with those of `new`, which has no overlay
+        if not len(self.song_ids):
+            return new
+        old_keys = np.repeat(self.keys, np.diff(self.offsets))
+        new_keys = new.posting_keys()
+
+        # Both posting sequences are sorted by key; inserting to the right
+        # of equal keys merges them in O(N) while keeping old postings first
+        where = np.searchsorted(old_keys, new_keys, side="right")
+        return type(self)._from_sorted(
+            np.insert(old_keys, where, new_keys),
+            np.insert(self.song_ids, where, new.song_ids),
+            np.insert(self.times, where, new.times),
+        )
+
+    def flatten(self) -> "FingerprintIndex":
+        """ Returns the index with its overlay (see `add`) merged into its arrays.
+
+        The merged arrays are held in memory; an index without an overlay is
+        returned as is.
+
+        Returns
+        -------
+        FingerprintIndex"""
+        if self.overlay is None:
+            return self
+        flat = self._merged(self.overlay)
+        flat.tombstones = self.tombstones.copy()
+        flat._song_sizes = self._song_sizes
+        flat.max_postings = self.max_postings
+        return flat
+
+    def snapshot(self) -> "FingerprintIndex":
+        """ Returns a copy of the index that is unaffected by later changes to it.
+
+        The posting arrays are never modified in-place - `add` and `compact` replace
+        them - thus the copy shares them, and only the tombstones are copied.
+
+        Returns
+        -------
+        FingerprintIndex"""
+        snapshot = type(self)(self.keys, self.offsets, self.song_ids, self.times)
+        snapshot.tombstones = self.tombstones.copy()
+        snapshot._song_sizes = self._song_sizes
+        snapshot.max_postings = self.max_postings
+        if self.overlay is not None:
+            snapshot.overlay = self.overlay.snapshot()
+        return snapshot
+
+    def _assign(self, other: "FingerprintIndex"):
+        # adopt the posting arrays of `other`
+        self.keys, self.offsets = other.keys, other.offsets
+        self.song_ids, self.times = other.song_ids, other.times
+
+    def remove_songs(self, song_ids: Iterable[int]):
+        """ Removes all of the postings for the specified songs.
+
+        The songs are marked as removed, in O(1) time per song, and their
+        postings are excluded from all subsequent lookups. `compact` reclaims
+        the space occupied by their postings.
+
+        Parameters
+        ----------
+        song_ids : Iterable[int]"""
+        song_ids = np.fromiter(song_ids, dtype=np.intp)
+        if not len(song_ids):
+            return
+        if song_ids.max() >= len(self.tombstones):
+            grown = np.zeros(song_ids.max() + 1, dtype=bool)
+            grown[: len(self.tombstones)] = self.tombstones
+            self.tombstones = grown
+        self.tombstones[song_ids] = True
+
+    def remove_song(self, song_id: int):
+        """ Removes all of the postings for the specified song.
+
+        See `remove_songs`.
+
+        Parameters
+        ----------
+        song_id : int"""
+        self.remove_songs([song_id])
+
+    def compact(self):
+        """ Drops the postings of removed songs, in O(N) time."""
+        if not self.num_dead:
+            return
+        flat = self.flatten()
+        keep = flat._live(flat.song_ids)
+        self._assign(
+            type(self)._from_sorted(
+                flat.posting_keys()[keep], flat.song_ids[keep], flat.times[keep]
+            )
+        )
+        self.overlay = None
+        self._song_sizes = None
+
+
+def _add_counts(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    # sums two arrays of per-song-ID counts, of possibly different lengths
+    if len(a) < len(b):
+        a, b = b, a
+    total = a.copy()
+    total[: len(b)] += b
+    return total
@@ -0,0 +1,343 @@
+"""
+Partitioning a fingerprint index into shards, and matching against the shards
+by scatter-gather.
+
+An index can be partitioned either
+
+ - by hash: each shard holds a contiguous range of fingerprint keys, chosen so that
+   the shards hold roughly equal numbers of postings. A query's hashes are only sent
+   to the shards whose key-ranges contain them.
+ - by song: each shard holds the postings of a contiguous range of song-IDs. A
+   query's hashes are sent to every shard.
+
+Each shard computes the offset histogram of its own matches; the partial histograms
+are then merged by summing the counts of each (song-ID, offset) pair. The shards can
+be held in-process, or be loaded (memory-mapped) by one worker process apiece, in
+which case the shards are queried concurrently.
+
+The merged histogram ranks candidates exactly as `songfp.functions.rank_matches`
+would for the unsharded index. For shards partitioned by song, this relies on the
+postings of each key being stored in order of song-ID, which holds because song-IDs
+are assigned in the order in which songs are added.
+"""
+
+import os
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from songfp import instrument
+from songfp.functions import Match, offset_histogram, rank_histogram
+
+from ._index import FingerprintIndex
+from ._storage import read_database
+
+__all__ = ["ShardedIndex", "partition_index", "shard_histogram", "merge_histograms"]
+
+Histogram = Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+
+
+def partition_index(
+    index: FingerprintIndex, num_shards: int, by: str = "hash"
+) -> Tuple[List[FingerprintIndex], Optional[np.ndarray]]:
+    """ Partitions the postings of an index into shards of roughly equal size.
+
+    The postings of removed songs, and of keys with more than `index.max_postings`
+    postings, are dropped.
+
+    Parameters
+    ----------
+    index : FingerprintIndex
+
+    num_shards : int
+
+    by : str, optional (default="hash")
+        "hash" to partition by ranges of fingerprint keys, or "song" to partition
+        by ranges of song-IDs.
+
+    Returns
+    -------
+    Tuple[List[FingerprintIndex], Optional[numpy.ndarray[uint64]]]
+        The shards, and, if partitioned by hash, the `num_shards - 1` keys that
+        bound the shards: shard `i` holds the keys in `[bounds[i - 1], bounds[i])`."""
+    assert 1 <= num_shards
+    assert by in {"hash", "song"}, by
+
+    index = index.flatten()
+    keys = index.posting_keys()
+    song_ids, times = np.asarray(index.song_ids), np.asarray(index.times)
+    live = index._live(song_ids)
+    if index.max_postings is not None:
+        lengths = index.posting_lengths()
+        common = np.repeat(lengths > index.max_postings, lengths)
+        live = ~common if live is None else live & ~common
+    if live is not None:
+        keys, song_ids, times = keys[live], song_ids[live], times[live]
+
+    if by == "hash":
+        cuts = np.linspace(0, len(keys), num_shards + 1)[1:-1].astype(np.intp)
+        bounds = keys[np.minimum(cuts, len(keys) - 1)] if len(keys) else np.zeros(
+            num_shards - 1, dtype=keys.dtype
+        )
+        edges = np.r_[0, np.searchsorted(keys, bounds), len(keys)]
+        shards = [
+            FingerprintIndex._from_sorted(
+                keys[start:stop], song_ids[start:stop], times[start:stop]
+            )
+            for start, stop in zip(edges[:-1], edges[1:])
+        ]
+        return shards, bounds
+
+    # balance the number of postings, rather than the number of songs
+    sizes = np.cumsum(np.bincount(song_ids))
+    targets = np.linspace(0, len(keys), num_shards + 1)[1:-1]
+    song_bounds = np.r_[0, np.searchsorted(sizes, targets, side="right"), np.inf]
+    shards = []
+    for low, high in zip(song_bounds[:-1], song_bounds[1:]):
+        mask = (low <= song_ids) & (song_ids < high)
+        shards.append(
+            FingerprintIndex._from_sorted(keys[mask], song_ids[mask], times[mask])
+        )
+    return shards, None
+
+
+def shard_histogram(
+    index: FingerprintIndex, hashes: np.ndarray, times: np.ndarray
+) -> Histogram:
+    """ Computes the offset histogram of a sample's matches against one shard.
+
+    Parameters
+    ----------
+    index : FingerprintIndex
+        The shard.
+
+    hashes : numpy.ndarray[uint64], shape=(Q,)
+        The sample's packed fingerprints.
+
+    times : numpy.ndarray, shape=(Q,)
+        The time at which each of the sample's fingerprints occurred.
+
+    Returns
+    -------
+    Tuple[numpy.ndarray, ...]
+        (song_ids, offsets, counts, first_query, first_rank), each of shape (P,):
+        the distinct (song-ID, offset) pairs and the number of matches for each. The
+        first match of each pair is located by the position, in `hashes`, of the hash
+        that it matched, and by its rank among that hash's matches."""
+    query, song_ids, song_times = index.lookup(hashes)
+    song_ids, offsets, counts, first = offset_histogram(
+        song_ids, song_times - np.asarray(times)[query]
+    )
+    # the matches are ordered by query position, thus each hash's matches are contiguous
+    first_query = query[first]
+    first_rank = first - np.searchsorted(query, first_query)
+    return song_ids, offsets, counts, first_query, first_rank
+
+
+def merge_histograms(
+    histograms: Sequence[Histogram],
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """ Merges the offset histograms computed by `shard_histogram`.
+
+    Parameters
+    ----------
+    histograms : Sequence[Tuple[numpy.ndarray, ...]]
+
+    Returns
+    -------
+    Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray, numpy.ndarray]
+        (song_ids, offsets, counts, first), as returned by
+        `songfp.functions.offset_histogram` for the unsharded index; `first`
+        orders the pairs by first occurrence."""
+    if not len(histograms):
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty.astype(np.int32), empty, empty.astype(np.intp)
+    song_ids, offsets, counts, first_query, first_rank = (
+        np.concatenate(column) for column in zip(*histograms)
+    )
+    if not len(counts):
+        return song_ids, offsets, counts, counts
+
+    # order the partial first occurrences as the unsharded matches would be ordered:
+    # by query position, then by position among that hash's postings
+    order = np.lexsort((first_rank, song_ids, first_query))
+    position = np.empty(len(order), dtype=np.intp)
+    position[order] = np.arange(len(order))
+
+    pairs, inverse = np.unique(
+        (song_ids.astype(np.int64) << 32) | (offsets.astype(np.int64) & 0xFFFFFFFF),
+        return_inverse=True,
+    )
+    merged_counts = np.bincount(inverse, weights=counts).astype(np.int64)
+    first = np.full(len(pairs), len(order), dtype=np.intp)
+    np.minimum.at(first, inverse, position)
+    merged_ids = pairs >> 32
+    merged_offsets = (pairs & 0xFFFFFFFF).astype(np.uint32).view(np.int32)
+    return merged_ids, merged_offsets, merged_counts, first
+
+
+# The shard loaded by a worker process
+_worker_shard: Optional[FingerprintIndex] = None
+
+
+def _load_worker_shard(path: str):
+    global _worker_shard
+    _worker_shard = read_database(path)[0]
+
+
+def _worker_histogram(hashes: np.ndarray, times: np.ndarray) -> Histogram:
+    return shard_histogram(_worker_shard, hashes, times)
+
+
+def _release(workers: List[ProcessPoolExecutor], paths: List[Path]):
+    # shuts down the worker processes, which unmaps the shard files, and then
+    # deletes the files; must not reference the `ShardedIndex` itself
+    for worker in workers:
+        worker.shutdown()
+    for path in paths:
+        try:
+            os.remove(str(path))
+        except OSError:
+            pass
+
+
+class ShardedIndex:
+    def __init__(
+        self,
+        shards: Sequence[Union[FingerprintIndex, str, Path]],
+        bounds: Optional[np.ndarray] = None,
+        remove_files: bool = False,
+    ):
+        """ Parameters
+        ----------
+        shards : Sequence[Union[FingerprintIndex, PathLike]]
+            The shards (see `partition_index`). A shard that is given as the path to a
+            `.fpdb` file is loaded by a dedicated worker process, and is queried
+            concurrently with the other shards.
+
+        bounds : Optional[numpy.ndarray[uint64]], shape=(len(shards) - 1,)
+            The keys that bound the shards, if the index was partitioned by hash;
+            `None` if it was partitioned by song.
+
+        remove_files : bool, optional (default=False)
+            If `True`, the shard files are deleted once the shards are closed.
+
+        Notes
+        -----
+        The worker processes are shut down by `close`, or else once the sharded
+        index is garbage-collected; thus a `songfp.database.Snapshot` that holds the
+        shards can be matched against for as long as it is referenced."""
+        assert bounds is None or len(bounds) == len(shards) - 1
+        self.bounds = bounds
+        self._shards = []
+        workers, paths = [], []
+        for shard in shards:
+            if isinstance(shard, FingerprintIndex):
+                self._shards.append(shard)
+            else:
+                workers.append(
+                    ProcessPoolExecutor(
+                        1, initializer=_load_worker_shard, initargs=(str(shard),)
+                    )
+                )
+                self._shards.append(workers[-1])
+                paths.append(Path(shard))
+        self._finalizer = weakref.finalize(
+            self, _release, workers, paths if remove_files else []
+        )
+
+    def __len__(self) -> int:
+        return len(self._shards)
+
+    @property
+    def closed(self) -> bool:
+        return not self._finalizer.alive
+
+    def close(self):
+        """ Shuts down the shards' worker processes; the shards can no longer be
+        queried."""
+        self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def histogram(
+        self, hashes: np.ndarray, times: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """ Scatters a sample's fingerprints to the shards, and merges the shards'
+        offset histograms.
+
+        Parameters
+        ----------
+        hashes : numpy.ndarray[uint64], shape=(Q,)
+        times : numpy.ndarray, shape=(Q,)
+
+        Returns
+        -------
+        Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray, numpy.ndarray]
+            (song_ids, offsets, counts, first); see `merge_histograms`."""
+        with instrument.timer("shards"):
+            return self._histogram(
+                np.asarray(hashes, dtype=np.uint64), np.asarray(times)
+            )
+
+    def _histogram(
+        self, hashes: np.ndarray, times: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        if self.closed:
+            raise RuntimeError("the shards have been closed")
+        if self.bounds is None:
+            queries = [np.arange(len(hashes))] * len(self._shards)
+        else:
+            owner = np.searchsorted(self.bounds, hashes, side="right")
+            queries = [np.flatnonzero(owner == n) for n in range(len(self._shards))]
+
+        # scatter: submit to the worker processes first, so that they run
+        # concurrently with the in-process shards
+        pending = []
+        for shard, query in zip(self._shards, queries):
+            if isinstance(shard, ProcessPoolExecutor):
+                pending.append(shard.submit(_worker_histogram, hashes[query], times[query]))
+            else:
+                pending.append(shard_histogram(shard, hashes[query], times[query]))
+
+        # gather: map each shard's query positions back onto the whole sample
+        histograms = []
+        for result, query in zip(pending, queries):
+            if not isinstance(result, tuple):
+                result = result.result()
+            song_ids, offsets, counts, first_query, first_rank = result
+            histograms.append((song_ids, offsets, counts, query[first_query], first_rank))
+        return merge_histograms(histograms)
+
+    def rank(
+        self,
+        hashes: np.ndarray,
+        times: np.ndarray,
+        k: int = 5,
+        time_step: float = 1.0,
+    ) -> List[Match]:
+        """ Ranks the songs that best match a sample.
+
+        Equivalent to `songfp.functions.rank_matches` applied to the matches
+        against the unsharded index.
+
+        Parameters
+        ----------
+        hashes : numpy.ndarray[uint64], shape=(Q,)
+        times : numpy.ndarray, shape=(Q,)
+        k : int, optional (default=5)
+        time_step : float, optional (default=1.)
+
+        Returns
+        -------
+        List[Match]"""
+        histogram = self.histogram(hashes, times)
+        with instrument.timer("rank"):
+            return rank_histogram(*histogram, len(hashes), k=k, time_step=time_step)
@@ -0,0 +1,418 @@
+"""
+Reading and writing song databases.
+
+Databases are stored as a single flat `.fpdb` file:
+
+    [magic (8 bytes)][version (uint32)][header length (uint32)]
+    [JSON header, padded to a 64-byte boundary]
+    [index arrays, each starting on a 64-byte boundary]
+
+The JSON header holds the song list, the index's `max_postings` setting, the
+parameters with which the songs were fingerprinted (`params`; see
+`songfp.functions.FingerprintParams`), and the dtype, shape, and byte-offset of
+each of the `FingerprintIndex` arrays; files that lack `params` were fingerprinted
+with the default parameters. The arrays are opened with `numpy.memmap`,
+thus loading a database takes the same amount of time regardless of the catalog's
+size, and processes that open the same database share its pages via the OS'
+page cache.
+
+Saving changes to an existing database does not rewrite the `.fpdb` file. Instead,
+the songs added and removed since the last save are appended as a new segment,
+`<name>.<sequence-number>.fpseg`, which is itself a small `.fpdb`-format file whose
+header also records the segment's sequence number, the song-ID of its first song,
+and the song-IDs removed. `read_database_segments` replays the segments on top of
+the base file; their postings are held in memory, in the index's overlay (see
+`FingerprintIndex.add`), while the base file's arrays remain memory-mapped.
+Compaction rewrites the base file to include the segments, recording the last
+segment folded into it, and then deletes those segments. Every file is moved into
+place atomically, thus a crash at any point leaves a readable database: segments
+that were already folded into the base file are simply ignored.
+
+Databases saved by earlier versions of `songfp` were stored as a pair of pickle
+files: `<name>.pkl` and `<name>_song_list.pkl`. These can still be read, and
+`convert_pickle_db` will rewrite them in the `.fpdb` format.
+"""
+
+import json
+import os
+import pickle
+import re
+import struct
+import tempfile
+from collections import defaultdict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+from songfp.functions import FingerprintParams
+
+from ._index import FingerprintIndex
+
+__all__ = [
+    "DB_SUFFIX",
+    "SEGMENT_SUFFIX",
+    "read_database",
+    "write_database",
+    "read_database_segments",
+    "write_segment",
+    "list_segments",
+    "remove_segments",
+    "read_pickle_database",
+    "convert_pickle_db",
+]
+
+DB_SUFFIX = ".fpdb"
+SEGMENT_SUFFIX = ".fpseg"
+
+_MAGIC = b"SONGFPDB"
+_VERSION = 1
+_PREAMBLE = struct.Struct("<8sII")
+_ALIGN = 64
+_ARRAYS = ("keys", "offsets", "song_ids", "times")
+
+SongList = List[Optional[Tuple[str, Optional[str]]]]
+
+
+def _aligned(n: int) -> int:
+    return -(-n // _ALIGN) * _ALIGN
+
+
+def write_database(
+    path: Union[str, Path],
+    index: FingerprintIndex,
+    song_list: SongList,
+    metadata: Optional[Dict[str, Any]] = None,
+):
+    """ Writes a database to a `.fpdb` file.
+
+    The file is written to a temporary file in the same directory and then moved
+    into place, thus a reader never observes a partially-written database.
+
+    Parameters
+    ----------
+    path : PathLike
+        The file to be written.
+
+    index : FingerprintIndex
+        The fingerprint index.
+
+    song_list : List[Optional[Tuple[str, Optional[str]]]]
+        The (name, artist) of each song-ID.
+
+    metadata : Optional[Dict[str, Any]]
+        Additional JSON-serializable entries to be stored in the header."""
+    path = Path(path)
+    index = index.flatten()
+    arrays = [np.ascontiguousarray(getattr(index, name)) for name in _ARRAYS]
+
+    def make_header(data_start: int) -> bytes:
+        layout = {}
+        offset = data_start
+        for name, arr in zip(_ARRAYS, arrays):
+            layout[name] = dict(
+                dtype=arr.dtype.str, shape=list(arr.shape), offset=offset
+            )
+            offset = _aligned(offset + arr.nbytes)
+        header = dict(
+            metadata or {},
+            song_list=song_list,
+            max_postings=index.max_postings,
+            arrays=layout,
+        )
+        return json.dumps(header).encode("utf-8")
+
+    # The array offsets are recorded in the header, whose own length
+    # depends on them; iterate until the layout is self-consistent
+    data_start = _aligned(_PREAMBLE.size)
+    header = make_header(data_start)
+    while _aligned(_PREAMBLE.size + len(header)) != data_start:
+        data_start = _aligned(_PREAMBLE.size + len(header))
+        header = make_header(data_start)
+
+    fd, tmp = tempfile.mkstemp(dir=str(path.parent), prefix=path.name, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(_PREAMBLE.pack(_MAGIC, _VERSION, len(header)))
+            f.write(header)
+            for arr in arrays:
+                f.seek(_aligned(f.tell()))
+                f.write(arr.tobytes())
+            f.truncate(_aligned(f.tell()))
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, str(path))
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def read_database(
+    path: Union[str, Path]
+) -> Tuple[FingerprintIndex, SongList, Dict[str, Any]]:
+    """ Opens a `.fpdb` database file.
+
+    The index arrays are read-only memory maps of the file.
+
+    Parameters
+    ----------
+    path : PathLike
+
+    Returns
+    -------
+    Tuple[FingerprintIndex, List[Optional[Tuple[str, Optional[str]]]], Dict[str, Any]]
+        The index, the song list, and the remainder of the file's header."""
+    path = Path(path)
+    with path.open(mode="rb") as f:
+        magic, version, header_len = _PREAMBLE.unpack(f.read(_PREAMBLE.size))
+        if magic != _MAGIC:
+            raise ValueError(f"{path} is not a song database")
+        if version != _VERSION:
+            raise ValueError(
+                f"{path} is a version-{version} database; "
+                f"this version of songfp reads version-{_VERSION} databases"
+            )
+        header = json.loads(f.read(header_len).decode("utf-8"))
+
+    layout = header.pop("arrays")
+    arrays = {}
+    for name in _ARRAYS:
+        spec = layout[name]
+        dtype = np.dtype(spec["dtype"])
+        shape = tuple(spec["shape"])
+        if not np.prod(shape):
+            # zero-length arrays cannot be memory-mapped
+            arrays[name] = np.zeros(shape, dtype=dtype)
+        else:
+            arrays[name] = np.memmap(
+                path, dtype=dtype, mode="r", offset=spec["offset"], shape=shape
+            )
+
+    song_list = [
+        None if entry is None else tuple(entry) for entry in header.pop("song_list")
+    ]
+    index = FingerprintIndex(**arrays)
+    index.max_postings = header.pop("max_postings", None)
+    return index, song_list, header
+
+
+def list_segments(path: Union[str, Path]) -> List[Tuple[int, Path]]:
+    """ Lists the segments of the database at `path`.
+
+    Parameters
+    ----------
+    path : PathLike
+        The path to the database's `.fpdb` file.
+
+    Returns
+    -------
+    List[Tuple[int, pathlib.Path]]
+        The (sequence-number, path) of each segment, in the order in which
+        they were written."""
+    path = Path(path)
+    pattern = re.compile(
+        re.escape(path.stem) + r"\.(\d+)" + re.escape(SEGMENT_SUFFIX) + "$"
+    )
+    if not path.parent.is_dir():
+        return []
+    segments = []
+    for name in os.listdir(str(path.parent)):
+        match = pattern.match(name)
+        if match:
+            segments.append((int(match.group(1)), path.parent / name))
+    return sorted(segments)
+
+
+def write_segment(
+    path: Union[str, Path],
+    sequence: int,
+    index: FingerprintIndex,
+    songs: SongList,
+    first_song_id: int,
+    removed: List[int],
+    metadata: Optional[Dict[str, Any]] = None,
+) -> Path:
+    """ Appends a segment of changes to the database at `path`.
+
+    Parameters
+    ----------
+    path : PathLike
+        The path to the database's `.fpdb` file.
+
+    sequence : int
+        The segment's sequence number; this must exceed that of every
+        segment written previously.
+
+    index : FingerprintIndex
+        The fingerprints of the songs added.
+
+    songs : List[Optional[Tuple[str, Optional[str]]]]
+        The (name, artist) of each song added.
+
+    first_song_id : int
+        The song-ID of `songs[0]`.
+
+    removed : List[int]
+        The song-IDs of the songs removed.
+
+    metadata : Optional[Dict[str, Any]]
+        Additional JSON-serializable entries to be stored in the header.
+
+    Returns
+    -------
+    pathlib.Path
+        The path of the segment."""
+    path = Path(path)
+    name = "{}.{:08d}{}".format(path.stem, sequence, SEGMENT_SUFFIX)
+    segment_path = path.parent / name
+    write_database(
+        segment_path,
+        index,
+        songs,
+        metadata=dict(
+            metadata or {},
+            segment=sequence,
+            first_song_id=first_song_id,
+            removed=list(removed),
+        ),
+    )
+    return segment_path
+
+
+def read_database_segments(
+    path: Union[str, Path]
+) -> Tuple[FingerprintIndex, SongList, Dict[str, Any]]:
+    """ Opens a `.fpdb` database file and replays the segments that have
+    not been folded into it.
+
+    Parameters
+    ----------
+    path : PathLike
+
+    Returns
+    -------
+    Tuple[FingerprintIndex, List[Optional[Tuple[str, Optional[str]]]], Dict[str, Any]]
+        The index, the song list, and the remainder of the file's header. The
+        index's arrays are memory maps of the base file, and the segments' postings
+        are held in its overlay. The header's "segment" entry is the sequence
+        number of the last segment replayed, and its "num_segments" entry is the
+        number of segments replayed.
+
+    Raises
+    ------
+    ValueError
+        If a segment's songs were fingerprinted with different parameters than
+        those of the base file."""
+    index, song_list, header = read_database(path)
+    last = header.get("segment", 0)
+    # files without parameters were fingerprinted with the defaults
+    params = FingerprintParams.from_dict(header.get("params") or {})
+
+    keys, song_ids, times = [], [], []
+    num_segments = 0
+    for sequence, segment_path in list_segments(path):
+        if sequence <= last:
+            # already folded into the base file
+            continue
+        segment, songs, segment_header = read_database(segment_path)
+        if segment_header["first_song_id"] != len(song_list):
+            raise ValueError(
+                f"{segment_path} does not follow the segments that precede it"
+            )
+        segment_params = FingerprintParams.from_dict(
+            segment_header.get("params") or {}
+        )
+        if segment_params != params:
+            raise ValueError(
+                f"the songs in {segment_path} were fingerprinted with different "
+                f"parameters ({segment_params}) than those in {path} ({params})"
+            )
+        song_list.extend(songs)
+        for song_id in segment_header["removed"]:
+            song_list[song_id] = None
+        # each segment records the setting at the time that it was saved
+        index.max_postings = segment.max_postings
+        keys.append(segment.posting_keys())
+        song_ids.append(np.asarray(segment.song_ids))
+        times.append(np.asarray(segment.times))
+        last = sequence
+        num_segments += 1
+
+    if keys:
+        # postings are replayed in the order that they were saved; they are added
+        # to the overlay of the memory-mapped index, which is left as is
+        index.add(np.concatenate(keys), np.concatenate(song_ids), np.concatenate(times))
+    header.update(segment=last, num_segments=num_segments)
+    return index, song_list, header
+
+
+def remove_segments(path: Union[str, Path], last: int):
+    """ Deletes the segments of the database at `path` up to, and including,
+    sequence number `last`.
+
+    Parameters
+    ----------
+    path : PathLike
+    last : int"""
+    for sequence, segment_path in list_segments(path):
+        if sequence <= last:
+            os.remove(str(segment_path))
+
+
+def read_pickle_database(path: Union[str, Path]) -> Tuple[FingerprintIndex, SongList]:
+    """ Reads a database stored as a `<name>.pkl` and `<name>_song_list.pkl` pair.
+
+    Parameters
+    ----------
+    path : PathLike
+        The path to `<name>.pkl`.
+
+    Returns
+    -------
+    Tuple[FingerprintIndex, List[Optional[Tuple[str, Optional[str]]]]]"""
+    path = Path(path)
+    with path.open(mode="rb") as f:
+        data = pickle.load(f)
+
+    # databases saved prior to the array-based index stored
+    # the (f1, f2, dt) -> [(song-ID, t1), ...] mapping directly
+    if isinstance(data, defaultdict):
+        data = FingerprintIndex.from_mapping(data)
+
+    assert isinstance(
+        data, FingerprintIndex
+    ), f"the loaded database should be a FingerprintIndex, got: {data}"
+
+    with (path.parent / (path.stem + "_song_list.pkl")).open(mode="rb") as f:
+        song_list = pickle.load(f)
+
+    assert isinstance(
+        song_list, list
+    ), f"the loaded song_list should be a list, got: {song_list}"
+    return data, song_list
+
+
+def convert_pickle_db(
+    path: Union[str, Path], out_path: Optional[Union[str, Path]] = None
+) -> Path:
+    """ Converts a `<name>.pkl` and `<name>_song_list.pkl` database to a `.fpdb` file.
+
+    Parameters
+    ----------
+    path : PathLike
+        The path to `<name>.pkl`.
+
+    out_path : Optional[PathLike]
+        The path of the resulting database. Defaults to `<name>.fpdb`,
+        alongside `path`.
+
+    Returns
+    -------
+    pathlib.Path
+        The path of the resulting database."""
+    path = Path(path)
+    out_path = path.with_suffix(DB_SUFFIX) if out_path is None else Path(out_path)
+    index, song_list = read_pickle_database(path)
+    write_database(out_path, index, song_list)
+    return out_path
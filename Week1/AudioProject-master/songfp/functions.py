@@ -1,15 +1,155 @@
 import random
 from collections import Counter
-from typing import Dict, Iterable, List, Sequence, Tuple, TypeVar, Union
+from typing import (
+    TYPE_CHECKING,
+    Dict,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+    Union,
+)
 
-import matplotlib.mlab as mlab
 import numpy as np
-from matplotlib.pyplot import Axes, Figure
-from scipy.ndimage.filters import maximum_filter
-from scipy.ndimage.morphology import generate_binary_structure, iterate_structure
+
+from . import instrument
+from .spectrogram import get_engine
+
+if TYPE_CHECKING:  # matplotlib is only imported when plotting
+    from matplotlib.pyplot import Axes, Figure
 
 SongID = TypeVar("SongID")
 
+# Peaks are encoded by their (time, frequency) spectrogram-bin indices
+PEAK_DTYPE = np.dtype([("t", np.int32), ("f", np.int16)])
+
+# Spectrogram parameters: the FFT length and the overlap between
+# successive FFT windows, in samples
+NFFT = 4096
+NOVERLAP = NFFT // 2
+
+
+class FingerprintParams(NamedTuple):
+    """The parameters with which songs, and the samples matched against them, are
+    fingerprinted. A sample must be fingerprinted with the same parameters as the
+    songs in the database; a database records the parameters of its songs."""
+
+    # the fraction of spectrogram intensities below the peak threshold
+    # (see `digital_to_spec`)
+    frac_cut: float = 0.77
+    # the radius of a peak's neighborhood (see `local_peak_array`)
+    p_nn: int = 20
+    # the number of subsequent peaks paired with each peak (see `peaks_to_hashes`)
+    fan_value: int = 15
+    # the FFT length, and the overlap between successive FFT windows, in samples
+    nfft: int = NFFT
+    noverlap: int = NOVERLAP
+
+    def validate(self) -> "FingerprintParams":
+        """Raises a `ValueError` if any of the parameters is out of range.
+
+        Returns
+        -------
+        FingerprintParams
+            These parameters."""
+        problems = []
+        if not 0.0 <= self.frac_cut <= 1.0:
+            problems.append("frac_cut must lie in [0, 1]")
+        if not (isinstance(self.p_nn, int) and 0 <= self.p_nn):
+            problems.append("p_nn must be a non-negative integer")
+        if not (isinstance(self.fan_value, int) and 1 <= self.fan_value):
+            problems.append("fan_value must be a positive integer")
+        if not (isinstance(self.nfft, int) and 2 <= self.nfft):
+            problems.append("nfft must be an integer of at least 2")
+        if not (isinstance(self.noverlap, int) and 0 <= self.noverlap < self.nfft):
+            problems.append("noverlap must be an integer in [0, nfft)")
+        if problems:
+            raise ValueError(
+                "invalid fingerprint parameters {}: {}".format(
+                    tuple(self), "; ".join(problems)
+                )
+            )
+        return self
+
+    @classmethod
+    def from_dict(cls, params: Dict[str, float]) -> "FingerprintParams":
+        """Constructs, and validates, parameters from `params._asdict()`; missing
+        parameters take their default values.
+
+        Parameters
+        ----------
+        params : Dict[str, float]
+
+        Returns
+        -------
+        FingerprintParams"""
+        unknown = set(params) - set(cls._fields)
+        if unknown:
+            raise ValueError(
+                "unknown fingerprint parameters: {}".format(", ".join(sorted(unknown)))
+            )
+        return cls(**params).validate()
+
+    def time_step(self, fs: float) -> float:
+        """The time, in seconds, spanned by a spectrogram column of a signal
+        sampled at `fs`."""
+        return (self.nfft - self.noverlap) / fs
+
+
+DEFAULT_PARAMS = FingerprintParams()
+
+# Each of f1, f2, and dt is packed into its own 16-bit field of an
+# unsigned 64-bit integer: (f1 << 32) | (f2 << 16) | dt
+_FIELD_BITS = 16
+_FIELD_MASK = (1 << _FIELD_BITS) - 1
+
+
+def pack_fingerprints(f1, f2, dt):
+    """Packs fingerprint features into integer hash keys.
+
+    Parameters
+    ----------
+    f1 : ArrayLike[int]
+        Frequency bin of the anchor peak.
+
+    f2 : ArrayLike[int]
+        Frequency bin of the paired peak.
+
+    dt : ArrayLike[int]
+        Time-bin separation between the two peaks.
+
+    Returns
+    -------
+    numpy.ndarray[uint64]
+        The packed keys: (f1 << 32) | (f2 << 16) | dt"""
+    f1, f2, dt = (
+        np.asarray(i).astype(np.int64) & _FIELD_MASK for i in (f1, f2, dt)
+    )
+    return ((f1 << 2 * _FIELD_BITS) | (f2 << _FIELD_BITS) | dt).astype(np.uint64)
+
+
+def unpack_fingerprints(keys) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Inverts `pack_fingerprints`.
+
+    Parameters
+    ----------
+    keys : ArrayLike[uint64]
+        Packed fingerprint keys.
+
+    Returns
+    -------
+    Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]
+        The int16 (f1, f2, dt) values of each key."""
+    keys = np.asarray(keys, dtype=np.uint64)
+    mask = np.uint64(_FIELD_MASK)
+    return tuple(
+        ((keys >> np.uint64(shift)) & mask).astype(np.uint16).view(np.int16)
+        for shift in (2 * _FIELD_BITS, _FIELD_BITS, 0)
+    )
+
 
 def rand_clip(digital: np.ndarray, new: float, fs: int = 44100) -> np.ndarray:
     """Produce a random "clip" of a digital signal
@@ -40,9 +180,14 @@ def rand_clip(digital: np.ndarray, new: float, fs: int = 44100) -> np.ndarray:
 
 
 def digital_to_spec(
-    digital: np.ndarray, fs: float, frac_cut: float, plot: bool = False
+    digital: np.ndarray,
+    fs: float,
+    frac_cut: float,
+    plot: bool = False,
+    nfft: int = NFFT,
+    noverlap: int = NOVERLAP,
 ) -> Union[
-    Tuple[np.ndarray, float], Tuple[np.ndarray, float, Figure, Axes, float, float]
+    Tuple[np.ndarray, float], Tuple[np.ndarray, float, "Figure", "Axes", float, float]
 ]:
     """Produces a spectrogram and a cut-off intensity to yield the
     specified fraction of data.
@@ -64,6 +209,12 @@ def digital_to_spec(
         If True, produce a plot of the spectrogram and return the
         matplotlib fig & ax objects.
 
+    nfft : int, optional (default=NFFT)
+        The length of each FFT window, in samples.
+
+    noverlap : int, optional (default=NOVERLAP)
+        The overlap between successive FFT windows, in samples.
+
     Returns
     -------
     Union[Tuple[numpy.ndarray, float]]
@@ -73,30 +224,31 @@ def digital_to_spec(
         is returned. Where (fig, ax) are the plot objects, and df
         and dt are the frequency and time units associated with the
         spectrogram bins."""
-    if digital.max() <= 1:
-        digital = digital * 2 ** 15
+    # signals in [-1, 1] are scaled to the range of 16-bit PCM
+    gain = 2 ** 15 if digital.max() <= 1 else 1
     assert 0.0 <= frac_cut <= 1.0
 
-    kwargs = dict(NFFT=4096, Fs=fs, window=mlab.window_hanning, noverlap=int(4096 / 2))
-    if not plot:
-        S, freqs, times = mlab.specgram(digital, **kwargs)
-    else:
-        import matplotlib.pyplot as plt
-        fig, ax = plt.subplots()
-        S, freqs, times, im = ax.specgram(digital, **kwargs)
-        fig.colorbar(im)
+    with instrument.timer("spectrogram"):
+        if not plot:
+            engine = get_engine(fs, nfft=nfft, noverlap=noverlap)
+            S = engine.transform(digital, gain=gain)
+        else:
+            import matplotlib.mlab as mlab
+            import matplotlib.pyplot as plt
 
-    # log-scaled Fourier amplitudes have a much more gradual distribution
-    # for audio data.
-    np.clip(S, a_min=1e-20, a_max=None, out=S)
-    np.log(S, out=S)
+            kwargs = dict(
+                NFFT=nfft, Fs=fs, window=mlab.window_hanning, noverlap=noverlap
+            )
+            fig, ax = plt.subplots()
+            S, freqs, times, im = ax.specgram(digital * gain, **kwargs)
+            fig.colorbar(im)
 
-    # Compute the cumulative distribution over Fourier component log-amplitudes.
-    # Use this to identify the threshold amplitude below which `frac_cutoff`
-    # proportion of amplitudes lie.
+        # log-scaled Fourier amplitudes have a much more gradual distribution
+        # for audio data.
+        np.clip(S, a_min=1e-20, a_max=None, out=S)
+        np.log(S, out=S)
 
-    a = np.sort(S.flatten())
-    cutoff = a[int(len(a) * frac_cut)]
+        cutoff = spectrogram_cutoff(S, frac_cut)
 
     if not plot:
         return S, cutoff
@@ -106,6 +258,117 @@ def digital_to_spec(
         return S, cutoff, fig, ax, df, dt
 
 
+def spectrogram_cutoff(log_spectrogram: np.ndarray, frac_cut: float) -> float:
+    """Identifies the threshold amplitude below which `frac_cut` proportion
+    of a spectrogram's amplitudes lie.
+
+    This is the value at position `int(N * frac_cut)` of the spectrogram's N
+    sorted amplitudes; it is found by selection, in O(N) time, rather than by
+    sorting.
+
+    Parameters
+    ----------
+    log_spectrogram : numpy.ndarray, shape=(n_freq, n_time)
+        Log-scaled spectrogram.
+
+    frac_cut : float
+        The fractional portion of intensities that lie below the cutoff.
+
+    Returns
+    -------
+    float
+        The cutoff intensity."""
+    assert 0.0 <= frac_cut <= 1.0
+    k = min(int(log_spectrogram.size * frac_cut), log_spectrogram.size - 1)
+    return np.partition(log_spectrogram, k, axis=None)[k]
+
+
+class CutoffSketch:
+    """Estimates the cutoff of `spectrogram_cutoff` for a spectrogram that is
+    produced column-by-column, in O(1) memory.
+
+    Log-amplitudes are tallied in a fixed histogram; the estimated cutoff is the
+    lower edge of the bin that contains the exact cutoff, and thus never exceeds
+    it."""
+
+    def __init__(
+        self,
+        frac_cut: float,
+        lower: float = np.log(1e-20),
+        upper: float = 64.0,
+        num_bins: int = 2 ** 14,
+    ):
+        """Parameters
+        ----------
+        frac_cut : float
+            The fractional portion of intensities that lie below the cutoff.
+
+        lower : float, optional (default=log(1e-20))
+            The smallest log-amplitude that can occur; `digital_to_spec`
+            clips amplitudes to 1e-20.
+
+        upper : float, optional (default=64.)
+            Log-amplitudes above this fall in the last bin.
+
+        num_bins : int, optional (default=2**14)
+            The number of histogram bins spanning [lower, upper]."""
+        assert 0.0 <= frac_cut <= 1.0
+        self.frac_cut = frac_cut
+        self.lower = lower
+        self.bin_width = (upper - lower) / num_bins
+        self.counts = np.zeros(num_bins, dtype=np.int64)
+
+    @property
+    def size(self) -> int:
+        """The number of amplitudes tallied thus far."""
+        return int(self.counts.sum())
+
+    def update(self, log_spectrogram: np.ndarray):
+        """Tallies the log-amplitudes of new spectrogram columns.
+
+        Parameters
+        ----------
+        log_spectrogram : numpy.ndarray, shape=(n_freq, n_new)"""
+        bins = self.bins(log_spectrogram)
+        self.counts += np.bincount(bins.ravel(), minlength=len(self.counts))
+
+    def bins(self, log_amplitudes: np.ndarray) -> np.ndarray:
+        """The histogram bin of each log-amplitude; the bins are non-decreasing in
+        the log-amplitudes.
+
+        Parameters
+        ----------
+        log_amplitudes : numpy.ndarray
+
+        Returns
+        -------
+        numpy.ndarray[intp], shape=log_amplitudes.shape"""
+        bins = (log_amplitudes - self.lower) / self.bin_width
+        return np.clip(bins, 0, len(self.counts) - 1).astype(np.intp)
+
+    def cutoff_bin(self) -> Tuple[int, int]:
+        """The bin that contains the exact cutoff for all of the columns tallied
+        thus far, and the cutoff's position among the sorted amplitudes of that bin.
+
+        Returns
+        -------
+        Tuple[int, int]"""
+        size = self.size
+        assert size, "no spectrogram columns have been tallied"
+        k = min(int(size * self.frac_cut), size - 1)
+        cumulative = np.cumsum(self.counts)
+        b = int(np.searchsorted(cumulative, k, side="right"))
+        return b, k - (int(cumulative[b - 1]) if b else 0)
+
+    def cutoff(self) -> float:
+        """The estimated cutoff intensity for all of the columns tallied thus far.
+
+        Returns
+        -------
+        float"""
+        return self.lower + self.cutoff_bin()[0] * self.bin_width
+
+
 def local_peaks(
     log_spectrogram: np.ndarray, amp_min: float, p_nn: int
 ) -> List[Tuple[float, float]]:
@@ -126,7 +389,15 @@ def local_peaks(
     -------
     List[Tuple[float, float]]
         Time and frequency values of local peaks in spectogram. Sorted by ascending
-        frequency and then time."""
+        frequency and then time.
+
+    Notes
+    -----
+    This is the reference implementation of peak-finding; `local_peak_array`
+    finds the same peaks, faster."""
+    # scipy.ndimage is slow to import, and only this reference implementation uses it
+    from scipy.ndimage import generate_binary_structure, iterate_structure, maximum_filter
+
     struct = generate_binary_structure(2, 1)
     neighborhood = iterate_structure(struct, p_nn)
 
@@ -147,8 +418,99 @@ def local_peaks(
     # locations much simpler.
 
     # take transpose so peaks are ordered by time then frequency
-    ts, fs = (i.astype(np.int16) for i in np.where(detected_peaks.T))
-    return list(zip(ts, fs))
+    ts, fs = np.where(detected_peaks.T)
+    return list(zip(ts.astype(PEAK_DTYPE["t"]), fs.astype(PEAK_DTYPE["f"])))
+
+
+def _diamond_steps(radius: int) -> List[int]:
+    # The diamond {|dt| + |df| <= r} is the Minkowski sum of a diamond of radius
+    # r - 1 and the radius-1 cross, and - for even r - of a diamond of radius r/2
+    # and the sparse cross {0, (+-r/2, 0), (0, +-r/2)}. Returns the arm lengths
+    # of the sparse crosses whose successive sum is the radius-`radius` diamond.
+    if radius == 0:
+        return []
+    if radius % 2:
+        return _diamond_steps(radius - 1) + [1]
+    return _diamond_steps(radius // 2) + [radius // 2]
+
+
+def diamond_maximum_filter(array: np.ndarray, radius: int) -> np.ndarray:
+    """Computes the maximum over the diamond-shaped neighborhood of each element.
+
+    Equivalent to `maximum_filter(array, footprint=iterate_structure(
+    generate_binary_structure(2, 1), radius))`, but the diamond is decomposed into
+    O(log(radius)) five-point sparse crosses, each of which is applied as
+    four shifted element-wise maxima.
+
+    Parameters
+    ----------
+    array : numpy.ndarray, shape=(N, M)
+
+    radius : int
+        The radius of the diamond: |i| + |j| <= radius
+
+    Returns
+    -------
+    numpy.ndarray, shape=(N, M)"""
+    assert array.ndim == 2 and radius >= 0
+    # Elements beyond the boundary never contribute to a maximum - the same
+    # result that `maximum_filter`'s "reflect" mode produces for a diamond.
+    # Padding by `radius` gives the intermediate dilations room to spill into.
+    out = np.pad(
+        array.astype(np.result_type(array, np.float32), copy=False),
+        radius,
+        mode="constant",
+        constant_values=-np.inf,
+    )
+    shifted = np.empty_like(out)
+    for k in _diamond_steps(radius):
+        shifted[...] = out
+        np.maximum(shifted[k:], out[:-k], out=shifted[k:])
+        np.maximum(shifted[:-k], out[k:], out=shifted[:-k])
+        np.maximum(shifted[:, k:], out[:, :-k], out=shifted[:, k:])
+        np.maximum(shifted[:, :-k], out[:, k:], out=shifted[:, :-k])
+        out, shifted = shifted, out
+    return out[radius : radius + array.shape[0], radius : radius + array.shape[1]]
+
+
+def local_peak_array(
+    log_spectrogram: np.ndarray, amp_min: float, p_nn: int
+) -> np.ndarray:
+    """Finds the local peaks of a spectrogram; the peaks are identical to those
+    found by `local_peaks`, but are found faster and are returned as an array.
+
+    Parameters
+    ----------
+    log_spectrogram : numpy.ndarray, shape=(n_freq, n_time)
+        Log-scaled spectrogram. Columns are the periodograms of successive segments of a
+        frequency-time spectrum.
+
+    amp_min : float
+        Amplitude threshold applied to local maxima
+
+    p_nn : int
+        Number of cells around an amplitude peak in the spectrogram in order
+
+    Returns
+    -------
+    numpy.ndarray[PEAK_DTYPE], shape=(N,)
+        Time ("t") and frequency ("f") bin indices of the local peaks. Sorted by
+        ascending time and then frequency."""
+    # `iterate_structure` treats zero iterations like one
+    neighborhood = max(p_nn, 1)
+    with instrument.timer("peaks"):
+        detected_peaks = (
+            diamond_maximum_filter(log_spectrogram, neighborhood) == log_spectrogram
+        )
+        detected_peaks &= log_spectrogram >= amp_min
+
+        # take transpose so peaks are ordered by time then frequency
+        ts, fs = np.nonzero(detected_peaks.T)
+        peaks = np.empty(len(ts), dtype=PEAK_DTYPE)
+        peaks["t"] = ts
+        peaks["f"] = fs
+    instrument.count("peaks", len(peaks))
+    return peaks
 
 
 def peaks_to_fingerprints(
@@ -171,7 +533,12 @@ def peaks_to_fingerprints(
     Tuple[Tuple[float, float, float], float]
         ((f_{n}, f_{n+j}, t_{n+j} - t_{n}), t_{n})
         The frequency value of peak n, peak n+j, their time-offset, along with the
-        time at which peak n occurred."""
+        time at which peak n occurred.
+
+    Notes
+    -----
+    This is the reference implementation of the fingerprinting scheme;
+    `peaks_to_fingerprint_arrays` produces identical features, vectorized."""
 
     assert 1 <= fan_value
     for n, (t1, f1) in enumerate(peaks):
@@ -179,6 +546,108 @@ def peaks_to_fingerprints(
             yield ((f1, f2, t2 - t1), t1)
 
 
+def _peak_columns(peaks) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the (times, freqs) columns of a sequence of time-frequency peaks."""
+    peaks = np.asarray(peaks)
+    if peaks.dtype.names is not None:
+        return peaks["t"], peaks["f"]
+    if not peaks.size:
+        return np.empty(0, dtype=np.int16), np.empty(0, dtype=np.int16)
+    return peaks[:, 0], peaks[:, 1]
+
+
+def peaks_to_fingerprint_arrays(
+    peaks: Sequence[Tuple[int, int]], fan_value: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Given the time-frequency locations of spectrogram peaks, computes
+    all of the 'fingerprint' features at once.
+
+    The features are identical to - and are in the same order as - those
+    yielded by `peaks_to_fingerprints`.
+
+    Parameters
+    ----------
+    peaks : Sequence[Tuple[int, int]]
+        The time-frequency peaks, as returned by `local_peak_array` or `local_peaks`.
+
+    fan_value : int
+        Given a peak, `fan_value` indicates the number of subsequent peaks
+        to be used to form fingerprint features.
+
+    Returns
+    -------
+    Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray, numpy.ndarray]
+        (f1, f2, dt, t1), each of shape (M,): the frequency value of peak n,
+        peak n+j, their time-offset, and the time at which peak n occurred."""
+    assert 1 <= fan_value
+    ts, fs = _peak_columns(peaks)
+
+    # Pair peak n with peaks n+1, ..., n+fan_value; flattening the (n, j)
+    # grid in row-major order reproduces the nested-loop ordering
+    n = np.arange(len(ts))[:, np.newaxis]
+    m = n + np.arange(1, fan_value + 1)
+    valid = m < len(ts)
+    first = np.broadcast_to(n, m.shape)[valid]
+    second = m[valid]
+
+    t1 = ts[first]
+    return fs[first], fs[second], ts[second] - t1, t1
+
+
+def peaks_to_hashes(
+    peaks: Sequence[Tuple[int, int]], fan_value: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Given the time-frequency locations of spectrogram peaks, computes
+    the packed fingerprint hashes.
+
+    Parameters
+    ----------
+    peaks : Sequence[Tuple[int, int]]
+        The time-frequency peaks, as returned by `local_peak_array` or `local_peaks`.
+
+    fan_value : int
+        Given a peak, `fan_value` indicates the number of subsequent peaks
+        to be used to form fingerprint features.
+
+    Returns
+    -------
+    Tuple[numpy.ndarray[uint64], numpy.ndarray]
+        The packed (f1, f2, dt) hashes (see `pack_fingerprints`), and the time
+        at which each fingerprint's first peak occurred."""
+    with instrument.timer("hashes"):
+        f1, f2, dt, t1 = peaks_to_fingerprint_arrays(peaks, fan_value)
+        hashes = pack_fingerprints(f1, f2, dt)
+    instrument.count("hashes", len(hashes))
+    return hashes, t1
+
+
+def digital_to_hashes(
+    digital: np.ndarray, fs: float, params: FingerprintParams = DEFAULT_PARAMS
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Computes the packed fingerprint hashes of a digital signal.
+
+    Parameters
+    ----------
+    digital : numpy.ndarray, shape=(Ts, )
+        The sampled audio-signal.
+
+    fs : float
+        The sample-frequency used to create the digital signal.
+
+    params : FingerprintParams, optional (default=DEFAULT_PARAMS)
+        The parameters of the spectrogram, its peaks, and their fingerprints.
+
+    Returns
+    -------
+    Tuple[numpy.ndarray[uint64], numpy.ndarray]
+        The packed hashes and their times, as returned by `peaks_to_hashes`."""
+    S, cutoff = digital_to_spec(
+        digital, fs, params.frac_cut, nfft=params.nfft, noverlap=params.noverlap
+    )
+    peaks = local_peak_array(S, cutoff, p_nn=params.p_nn)
+    return peaks_to_hashes(peaks, fan_value=params.fan_value)
+
+
 def fingerprints_to_matches(
     sample_fingerprints: Iterable[Tuple[Tuple[float, float, float], float]],
     database: Dict[Tuple[float, float, float], List[Tuple[SongID, float]]],
@@ -195,13 +664,19 @@ def fingerprints_to_matches(
         (freq_{n}, freq_{n+j, dt} -> [(song_ID, t), ... ]
         A dictionary that maps frequency peak-pairs and their offset to a list of all the
         song IDs containing that signature, and the time at which the signature occurred
-        in the song.
+        in the song. Any object providing this `get` method, such as
+        `songfp.database.FingerprintIndex`, may be used.
 
     Yields
     ------
     Tuple[song_ID, dt]
         A song ID that had a matching peak-pair signature, and the time offset between when
-        the signature occurred in the song versus the sample."""
+        the signature occurred in the song versus the sample.
+
+    Notes
+    -----
+    This is the reference implementation of the matching scheme; `hashes_to_matches`
+    performs all of the lookups at once."""
     for f1_f2_dt, t_sample in sample_fingerprints:
         o = database.get(f1_f2_dt)
         if o is not None:
@@ -221,10 +696,547 @@ def matches_to_best_match(matches: Iterable[Tuple[SongID, float]]) -> SongID:
     Returns
     -------
     SongID
-        The song-ID with the most common time-offset with the sample."""
+        The song-ID with the most common time-offset with the sample.
+
+    Notes
+    -----
+    This is the reference implementation of the scoring scheme;
+    `arrays_to_best_match` produces identical results from match arrays."""
     cntr = Counter(matches)
     if not cntr:
         return None
 
     item, cnt = cntr.most_common(1)[0]
     return item[0]
+
+
+def hashes_to_matches(
+    sample_hashes: np.ndarray, sample_times: np.ndarray, index
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Looks up all of a sample's fingerprint hashes in a fingerprint index at once.
+
+    Parameters
+    ----------
+    sample_hashes : numpy.ndarray[uint64], shape=(Q,)
+        The packed fingerprints of the sample (see `peaks_to_hashes`).
+
+    sample_times : numpy.ndarray, shape=(Q,)
+        The time at which each of the sample's fingerprints occurred.
+
+    index : songfp.database.FingerprintIndex
+        The fingerprint index being matched against.
+
+    Returns
+    -------
+    Tuple[numpy.ndarray, numpy.ndarray]
+        (song_ids, offsets), each of shape (M,): the song ID of each matching
+        fingerprint, and the time offset between when the fingerprint occurred in
+        the song versus the sample. These are in the same order as the matches
+        yielded by `fingerprints_to_matches`."""
+    query, song_ids, song_times = index.lookup(sample_hashes)
+    return song_ids, song_times - np.asarray(sample_times)[query]
+
+
+def weighted_hashes_to_matches(
+    sample_hashes: np.ndarray, sample_times: np.ndarray, index
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, float]:
+    """Looks up a sample's fingerprint hashes, weighing each match by the
+    inverse document frequency of its hash (see `FingerprintIndex.idf`).
+
+    Matches on fingerprints that occur in few songs thus count for more than
+    matches on fingerprints that occur in many songs.
+
+    Parameters
+    ----------
+    sample_hashes : numpy.ndarray[uint64], shape=(Q,)
+        The packed fingerprints of the sample (see `peaks_to_hashes`).
+
+    sample_times : numpy.ndarray, shape=(Q,)
+        The time at which each of the sample's fingerprints occurred.
+
+    index : songfp.database.FingerprintIndex
+        The fingerprint index being matched against.
+
+    Returns
+    -------
+    Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray, float]
+        (song_ids, offsets, weights, total_weight): the matches, as returned by
+        `hashes_to_matches`, the weight of each match, and the total weight of
+        the sample's fingerprints."""
+    query, song_ids, song_times = index.lookup(sample_hashes)
+    idf = index.idf(sample_hashes)
+    offsets = song_times - np.asarray(sample_times)[query]
+    return song_ids, offsets, idf[query], float(idf.sum())
+
+
+def batch_hashes_to_matches(
+    sample_hashes: Sequence[np.ndarray], sample_times: Sequence[np.ndarray], index
+) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """Looks up the fingerprint hashes of many samples in a single lookup.
+
+    Parameters
+    ----------
+    sample_hashes : Sequence[numpy.ndarray[uint64]]
+        The packed fingerprints of each sample.
+
+    sample_times : Sequence[numpy.ndarray]
+        The time at which each of each sample's fingerprints occurred.
+
+    index : songfp.database.FingerprintIndex
+        The fingerprint index being matched against.
+
+    Returns
+    -------
+    List[Tuple[numpy.ndarray, numpy.ndarray]]
+        The (song_ids, offsets) of each sample, as returned by `hashes_to_matches`."""
+    assert len(sample_hashes) == len(sample_times)
+    if not len(sample_hashes):
+        return []
+    bounds = np.cumsum([0] + [len(h) for h in sample_hashes])
+    hashes = np.concatenate([np.asarray(h, dtype=np.uint64) for h in sample_hashes])
+    times = np.concatenate([np.asarray(t) for t in sample_times])
+
+    # Look up each distinct hash once, in sorted order - which makes the index's
+    # binary searches and gathers cache-friendly - then expand the postings back
+    # out to every query position
+    unique, inverse = np.unique(hashes, return_inverse=True)
+    unique_query, unique_ids, unique_times = index.lookup(unique)
+    unique_counts = np.bincount(unique_query, minlength=len(unique))
+    counts = unique_counts[inverse.ravel()]
+    starts = (np.cumsum(unique_counts) - unique_counts)[inverse.ravel()]
+
+    ends = np.cumsum(counts)
+    positions = np.arange(ends[-1] if len(ends) else 0, dtype=np.intp)
+    positions += np.repeat(starts - (ends - counts), counts)
+    query = np.repeat(np.arange(len(hashes)), counts)
+    song_ids = unique_ids[positions]
+    offsets = unique_times[positions] - times[query]
+
+    # the matches are ordered by query position, thus each sample's are contiguous
+    edges = np.searchsorted(query, bounds)
+    return [
+        (song_ids[start:stop], offsets[start:stop])
+        for start, stop in zip(edges[:-1], edges[1:])
+    ]
+
+
+def _pack_matches(song_ids: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    # (song_id << 32) | offset, with the offset stored in its low 32 bits
+    song_ids = np.asarray(song_ids, dtype=np.int64)
+    offsets = np.asarray(offsets, dtype=np.int64) & 0xFFFFFFFF
+    return (song_ids << 32) | offsets
+
+
+def _unpack_matches(packed: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    song_ids = packed >> 32
+    offsets = (packed & 0xFFFFFFFF).astype(np.uint32).view(np.int32)
+    return song_ids, offsets
+
+
+def offset_histogram(
+    song_ids: np.ndarray, offsets: np.ndarray, weights: Optional[np.ndarray] = None
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Tallies the matches for each distinct (song-ID, offset) pair.
+
+    Parameters
+    ----------
+    song_ids : numpy.ndarray, shape=(M,)
+        The song ID of each match.
+
+    offsets : numpy.ndarray, shape=(M,)
+        The time offset of each match.
+
+    weights : Optional[numpy.ndarray], shape=(M,)
+        The weight of each match's vote; by default, each match has one vote.
+
+    Returns
+    -------
+    Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray, numpy.ndarray]
+        (song_ids, offsets, counts, first), each of shape (P,): the distinct
+        (song-ID, offset) pairs, the number (or total weight) of matches for each
+        pair, and the position of each pair's first occurrence among the matches."""
+    if weights is None:
+        pairs, first, counts = np.unique(
+            _pack_matches(song_ids, offsets), return_index=True, return_counts=True
+        )
+    else:
+        pairs, first, inverse = np.unique(
+            _pack_matches(song_ids, offsets), return_index=True, return_inverse=True
+        )
+        counts = np.bincount(inverse.ravel(), weights=weights, minlength=len(pairs))
+    return _unpack_matches(pairs) + (counts, first)
+
+
+def arrays_to_best_match(song_ids: np.ndarray, offsets: np.ndarray) -> SongID:
+    """Determines the song-ID that has the most consistent fingerprint-offset
+
+    Parameters
+    ----------
+    song_ids : numpy.ndarray, shape=(M,)
+        The song ID of each match (see `hashes_to_matches`).
+
+    offsets : numpy.ndarray, shape=(M,)
+        The time offset of each match.
+
+    Returns
+    -------
+    SongID
+        The song-ID with the most common time-offset with the sample. Ties
+        are broken in the same manner as `matches_to_best_match`."""
+    song_ids, _, counts, first = offset_histogram(song_ids, offsets)
+    if not len(counts):
+        return None
+
+    # among the most common pairs, the one seen first wins
+    tied = np.flatnonzero(counts == counts.max())
+    return int(song_ids[tied[np.argmin(first[tied])]])
+
+
+class Match(NamedTuple):
+    """A candidate song for a sample, as ranked by `rank_matches`."""
+
+    song_id: int
+    # The time in the song at which the sample begins
+    offset: float
+    # The number of the sample's fingerprints that match the song at `offset`
+    # (their total weight, if the fingerprints are weighted)
+    votes: int
+    # The fraction of the sample's fingerprints that are votes
+    fraction: float
+    # `votes` less the votes of the best-scoring other candidate
+    margin: int
+
+
+def rank_matches(
+    song_ids: np.ndarray,
+    offsets: np.ndarray,
+    num_hashes: int,
+    k: int = 5,
+    time_step: float = 1.0,
+    weights: Optional[np.ndarray] = None,
+) -> List[Match]:
+    """Ranks the songs that best match a sample.
+
+    Each song is scored by the number of matches at its most common
+    fingerprint-offset. All of the scores are computed from a single
+    pass over the matches.
+
+    Parameters
+    ----------
+    song_ids : numpy.ndarray, shape=(M,)
+        The song ID of each match (see `hashes_to_matches`).
+
+    offsets : numpy.ndarray, shape=(M,)
+        The time offset of each match.
+
+    num_hashes : int
+        The number of fingerprints in the sample (their total weight, if `weights`
+        is provided).
+
+    k : int, optional (default=5)
+        The maximum number of candidates to return.
+
+    time_step : float, optional (default=1.)
+        The time spanned by a spectrogram bin, which converts offsets to
+        physical units.
+
+    weights : Optional[numpy.ndarray], shape=(M,)
+        The weight of each match's vote (see `weighted_hashes_to_matches`);
+        by default, each match has one vote.
+
+    Returns
+    -------
+    List[Match]
+        Up to `k` candidates, in order of descending score. Without weights, the
+        first candidate is the song returned by `arrays_to_best_match`."""
+    with instrument.timer("rank"):
+        return rank_histogram(
+            *offset_histogram(song_ids, offsets, weights),
+            num_hashes,
+            k=k,
+            time_step=time_step,
+        )
+
+
+def rank_histogram(
+    song_ids: np.ndarray,
+    offsets: np.ndarray,
+    counts: np.ndarray,
+    first: np.ndarray,
+    num_hashes: int,
+    k: int = 5,
+    time_step: float = 1.0,
+) -> List[Match]:
+    """Ranks the songs that best match a sample, given its offset histogram.
+
+    Parameters
+    ----------
+    song_ids : numpy.ndarray, shape=(P,)
+        The distinct (song-ID, offset) pairs (see `offset_histogram`).
+
+    offsets : numpy.ndarray, shape=(P,)
+
+    counts : numpy.ndarray, shape=(P,)
+        The number (or total weight) of matches for each pair.
+
+    first : numpy.ndarray, shape=(P,)
+        Orders the pairs by their first occurrence among the matches; this
+        breaks ties between equal counts.
+
+    num_hashes : int
+        The number (or total weight) of fingerprints in the sample.
+
+    k : int, optional (default=5)
+        The maximum number of candidates to return.
+
+    time_step : float, optional (default=1.)
+        The time spanned by a spectrogram bin.
+
+    Returns
+    -------
+    List[Match]
+        Up to `k` candidates, in order of descending score."""
+    assert 1 <= k
+    if not len(counts):
+        return []
+
+    # Reduce to each song's best offset: the most common, with
+    # ties broken by first occurrence
+    order = np.lexsort((first, -counts, song_ids))
+    song_ids, offsets, counts, first = (
+        i[order] for i in (song_ids, offsets, counts, first)
+    )
+    lead = np.r_[True, song_ids[1:] != song_ids[:-1]]
+    song_ids, offsets, counts, first = (
+        i[lead] for i in (song_ids, offsets, counts, first)
+    )
+
+    rank = np.lexsort((first, -counts))
+    best = counts[rank[0]]
+    runner_up = counts[rank[1]] if len(rank) > 1 else 0
+    return [
+        Match(
+            song_id=int(song_ids[i]),
+            offset=float(offsets[i] * time_step),
+            votes=counts[i].item(),
+            fraction=float(counts[i] / num_hashes),
+            margin=(counts[i] - (runner_up if n == 0 else best)).item(),
+        )
+        for n, i in enumerate(rank[:k])
+    ]
+
+
+class OffsetSketch:
+    """Tallies matches per (song-ID, offset) pair in a count-min sketch of fixed
+    size, and tracks an upper bound on the score of each song.
+
+    A song's score (see `rank_matches`) is the number of matches at its most common
+    offset. The sketch never underestimates a pair's count, thus `song_bounds` never
+    underestimates a song's score; songs whose bounds fall below the exact score of
+    another song can therefore be ruled out without being scored exactly."""
+
+    def __init__(
+        self, num_songs: int = 0, width: int = 2 ** 16, depth: int = 4, seed: int = 0
+    ):
+        """Parameters
+        ----------
+        num_songs : int, optional (default=0)
+            The number of songs expected; `song_bounds` grows as needed.
+
+        width : int, optional (default=2**16)
+            The number of counters in each row of the sketch; must be a power of 2.
+
+        depth : int, optional (default=4)
+            The number of rows, each hashed independently, in the sketch.
+
+        seed : int, optional (default=0)
+            Seeds the hash functions of the rows."""
+        assert 1 <= width and width & (width - 1) == 0, "width must be a power of 2"
+        assert 1 <= depth
+        self.counts = np.zeros((depth, width), dtype=np.float64)
+        self.song_bounds = np.zeros(num_songs, dtype=np.float64)
+        # multiply-shift hashing: the top bits of (pair * odd multiplier) mod 2**64
+        rng = np.random.RandomState(seed)
+        multipliers = rng.randint(0, 2 ** 63, size=depth, dtype=np.uint64)
+        self._multipliers = multipliers * np.uint64(2) + np.uint64(1)
+        self._shift = np.uint64(64 - (width.bit_length() - 1))
+
+    def _buckets(self, song_ids: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+        pairs = _pack_matches(song_ids, offsets).view(np.uint64)
+        if self.counts.shape[1] == 1:
+            return np.zeros((len(self.counts), len(pairs)), dtype=np.intp)
+        hashed = pairs * self._multipliers[:, np.newaxis]
+        return (hashed >> self._shift).astype(np.intp)
+
+    def update(
+        self,
+        song_ids: np.ndarray,
+        offsets: np.ndarray,
+        weights: Optional[np.ndarray] = None,
+    ):
+        """Tallies new matches.
+
+        Parameters
+        ----------
+        song_ids : numpy.ndarray, shape=(M,)
+            The song ID of each match.
+
+        offsets : numpy.ndarray, shape=(M,)
+            The time offset of each match.
+
+        weights : Optional[numpy.ndarray], shape=(M,)
+            The weight of each match's vote; by default, each match has one vote."""
+        if not len(song_ids):
+            return
+        buckets = self._buckets(song_ids, offsets)
+        width = self.counts.shape[1]
+        for row, bucket in zip(self.counts, buckets):
+            row += np.bincount(bucket, weights=weights, minlength=width)
+
+        # every match of a pair seen so far has been tallied, thus its estimate bounds
+        # the pair's final count
+        estimates = np.min(np.take_along_axis(self.counts, buckets, axis=1), axis=0)
+        song_ids = np.asarray(song_ids, dtype=np.intp)
+        if song_ids.max() >= len(self.song_bounds):
+            self.song_bounds = np.r_[
+                self.song_bounds, np.zeros(song_ids.max() + 1 - len(self.song_bounds))
+            ]
+        np.maximum.at(self.song_bounds, song_ids, estimates)
+
+
+def rank_hashes(
+    sample_hashes: np.ndarray,
+    sample_times: np.ndarray,
+    index,
+    k: int = 5,
+    time_step: float = 1.0,
+    idf: bool = False,
+    chunk_size: int = 1024,
+    num_candidates: int = 8,
+    sketch_width: int = 2 ** 16,
+    sketch_depth: int = 4,
+) -> List[Match]:
+    """Ranks the songs that best match a sample, with an offset histogram whose size
+    is bounded by the number of candidate songs rather than by the number of matches.
+
+    The sample's hashes are looked up `chunk_size` at a time, and their matches are
+    tallied in an `OffsetSketch`; the matches themselves are retained only as packed
+    (song-ID, offset) integers. The songs with the highest bounds on their scores are
+    then scored exactly, from their matches alone; this is repeated, with more songs,
+    until no other song's bound reaches the exact score of the k-th best candidate.
+    Each hash is looked up once, however many times this is repeated.
+    The result is identical to that of `rank_matches` applied to all of the matches
+    (see `hashes_to_matches`, `weighted_hashes_to_matches`), except that, for k=1,
+    the margin may be understated (but never overstated) when the runner-up was not
+    among the songs scored exactly.
+
+    Parameters
+    ----------
+    sample_hashes : numpy.ndarray[uint64], shape=(Q,)
+        The packed fingerprints of the sample (see `peaks_to_hashes`).
+
+    sample_times : numpy.ndarray, shape=(Q,)
+        The time at which each of the sample's fingerprints occurred.
+
+    index : songfp.database.FingerprintIndex
+        The fingerprint index being matched against.
+
+    k : int, optional (default=5)
+        The maximum number of candidates to return.
+
+    time_step : float, optional (default=1.)
+        The time spanned by a spectrogram bin.
+
+    idf : bool, optional (default=False)
+        If `True`, each match's vote is weighted by the inverse document frequency
+        of its hash (see `FingerprintIndex.idf`).
+
+    chunk_size : int, optional (default=1024)
+        The number of hashes looked up at a time.
+
+    num_candidates : int, optional (default=8)
+        The number of songs that are initially scored exactly.
+
+    sketch_width : int, optional (default=2**16)
+    sketch_depth : int, optional (default=4)
+        The size of the sketch (see `OffsetSketch`).
+
+    Returns
+    -------
+    List[Match]
+        Up to `k` candidates, in order of descending score."""
+    assert 1 <= k and 1 <= chunk_size
+    sample_hashes = np.asarray(sample_hashes, dtype=np.uint64)
+    sample_times = np.asarray(sample_times)
+    weights = index.idf(sample_hashes) if idf else None
+    num_hashes = float(weights.sum()) if idf else len(sample_hashes)
+    chunks = [
+        slice(start, start + chunk_size)
+        for start in range(0, len(sample_hashes), chunk_size)
+    ]
+
+    # each chunk's matches, packed, along with their weights; these are rescored
+    # as the candidates grow, rather than being looked up anew
+    matches = []
+    sketch = OffsetSketch(index.num_songs, width=sketch_width, depth=sketch_depth)
+    for chunk in chunks:
+        query, song_ids, song_times = index.lookup(sample_hashes[chunk])
+        offsets = song_times - sample_times[chunk][query]
+        match_weights = None if weights is None else weights[chunk][query]
+        sketch.update(song_ids, offsets, match_weights)
+        matches.append((_pack_matches(song_ids, offsets), match_weights))
+    bounds = sketch.song_bounds
+
+    matched = np.flatnonzero(bounds > 0)
+    order = matched[np.argsort(-bounds[matched], kind="stable")]
+    candidates = np.zeros(len(bounds), dtype=bool)
+    candidates[order[: max(num_candidates, k)]] = True
+    while True:
+        # the candidates' histogram is accumulated chunk-by-chunk, in order of the
+        # matches' occurrence, thus ties are broken as they are by `rank_matches`
+        pairs = np.empty(0, dtype=np.int64)
+        counts = np.empty(0, dtype=np.float64 if idf else np.int64)
+        first = np.empty(0, dtype=np.intp)
+        num_kept = 0
+        for packed, w in matches:
+            ids, offs = _unpack_matches(packed)
+            keep = candidates[ids]
+            chunk_ids, chunk_offsets, chunk_counts, chunk_first = offset_histogram(
+                ids[keep], offs[keep], None if w is None else w[keep]
+            )
+            pairs, inverse = np.unique(
+                np.r_[pairs, _pack_matches(chunk_ids, chunk_offsets)],
+                return_inverse=True,
+            )
+            inverse = inverse.ravel()
+            counts = np.bincount(
+                inverse, weights=np.r_[counts, chunk_counts], minlength=len(pairs)
+            ).astype(counts.dtype)
+            merged_first = np.full(len(pairs), np.iinfo(np.intp).max, dtype=np.intp)
+            np.minimum.at(merged_first, inverse, np.r_[first, chunk_first + num_kept])
+            first = merged_first
+            num_kept += int(keep.sum())
+        histogram = _unpack_matches(pairs) + (counts, first)
+
+        # the exact score of the k-th best candidate; a song whose bound falls short
+        # of it cannot be among the k best songs
+        scores = np.zeros(len(bounds), dtype=np.float64)
+        np.maximum.at(scores, histogram[0], histogram[2])
+        best = np.sort(scores[candidates])[::-1]
+        threshold = best[k - 1] if len(best) >= k else 0.0
+        # (a small tolerance, since weighted sums may round differently)
+        missing = ~candidates & (bounds > 0) & (bounds >= threshold * (1 - 1e-9))
+        if not missing.any():
+            break
+        candidates |= missing
+
+    ranked = rank_histogram(*histogram, num_hashes, k=k, time_step=time_step)
+    if ranked and k == 1:
+        # the runner-up may not have been scored exactly: the margin is taken over the
+        # best bound among the songs that were not, thus it is never overstated
+        unscored = bounds[~candidates].max() if not candidates.all() else 0
+        runner_up = ranked[0].votes - ranked[0].margin
+        if unscored > runner_up:
+            margin = ranked[0].votes - unscored
+            ranked[0] = ranked[0]._replace(margin=margin if idf else int(margin))
+    return ranked
@@ -0,0 +1,190 @@
+"""
+Optional instrumentation of the stages of the songfp pipeline.
+
+The pipeline's stages report how long they take, and how much work they do, to
+whichever sinks are attached. A sink is any callable that accepts an `Event`; `Stats`
+is a sink that tallies the events it receives:
+
+    >>> from songfp import instrument, match_sample
+    >>> with instrument.collect() as stats:
+    ...     match_sample(digital, fs)
+    >>> print(stats)
+
+The stages are timed under the names:
+
+ - "spectrogram": `songfp.functions.digital_to_spec`
+ - "peaks": `songfp.functions.local_peak_array`
+ - "hashes": `songfp.functions.peaks_to_hashes`
+ - "lookup": `songfp.database.FingerprintIndex.lookup`
+ - "rank": `songfp.functions.rank_matches`, and `ShardedIndex.rank`
+ - "shards": the scatter-gather of `songfp.database.ShardedIndex.histogram`
+
+and the counters are:
+
+ - "peaks": the spectrogram peaks found
+ - "hashes": the fingerprint hashes generated
+ - "hashes_hit": the hashes looked up that are present in the index
+ - "postings_scanned": the posting entries gathered for those hashes
+ - "matches": the postings that survive filtering (see `FingerprintIndex.lookup`)
+
+While no sink is attached, a timer is a shared no-op context manager, and a
+counter returns immediately, thus the instrumentation costs a function call per
+stage. Sinks are called from whichever thread ran the stage; stages that run in
+other processes (e.g. those of `songfp.database.add_songs`, or of a sharded index's
+worker processes) are not reported.
+"""
+
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from typing import Callable, Dict, NamedTuple, Tuple
+
+__all__ = ["Event", "Stats", "attach", "detach", "collect", "enabled", "timer", "count"]
+
+
+class Event(NamedTuple):
+    kind: str  # "time" or "count"
+    name: str
+    value: float  # seconds, for "time"; an amount, for "count"
+
+
+Sink = Callable[[Event], None]
+
+# replaced, rather than mutated, so that emitting never sees a partial update
+_sinks: Tuple[Sink, ...] = ()
+_NULL_TIMER = nullcontext()
+
+
+def enabled() -> bool:
+    """ Returns `True` if any sink is attached."""
+    return bool(_sinks)
+
+
+def attach(sink: Sink) -> Sink:
+    """ Attaches a sink, which is then called with each `Event`.
+
+    Parameters
+    ----------
+    sink : Callable[[Event], None]
+
+    Returns
+    -------
+    Callable[[Event], None]
+        The sink."""
+    global _sinks
+    _sinks = _sinks + (sink,)
+    return sink
+
+
+def detach(sink: Sink):
+    """ Detaches a sink that was attached by `attach`.
+
+    Parameters
+    ----------
+    sink : Callable[[Event], None]"""
+    global _sinks
+    assert sink in _sinks, "the sink is not attached"
+    sinks = list(_sinks)
+    sinks.remove(sink)
+    _sinks = tuple(sinks)
+
+
+def _emit(event: Event):
+    for sink in _sinks:
+        sink(event)
+
+
+class _Timer:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        _emit(Event("time", self.name, time.perf_counter() - self.start))
+
+
+def timer(name: str):
+    """ Times the body of a `with` statement as one call of the stage `name`.
+
+    Parameters
+    ----------
+    name : str
+
+    Returns
+    -------
+    ContextManager"""
+    if not _sinks:
+        return _NULL_TIMER
+    return _Timer(name)
+
+
+def count(name: str, value: float = 1):
+    """ Increments the counter `name` by `value`.
+
+    Parameters
+    ----------
+    name : str
+
+    value : float, optional (default=1)"""
+    if _sinks:
+        _emit(Event("count", name, value))
+
+
+class Stats:
+    """ A sink that tallies the time spent in, and the number of calls of, each stage,
+    along with the total of each counter."""
+
+    def __init__(self):
+        self.seconds: Dict[str, float] = defaultdict(float)
+        self.calls: Dict[str, int] = defaultdict(int)
+        self.counts: Dict[str, float] = defaultdict(int)
+
+    def __call__(self, event: Event):
+        if event.kind == "time":
+            self.seconds[event.name] += event.value
+            self.calls[event.name] += 1
+        else:
+            self.counts[event.name] += event.value
+
+    def reset(self):
+        """ Discards everything tallied so far."""
+        self.seconds.clear()
+        self.calls.clear()
+        self.counts.clear()
+
+    def as_dict(self) -> Dict[str, Dict[str, float]]:
+        """ Returns the tallies, as `{"seconds": {...}, "calls": {...}, "counts": {...}}`."""
+        return dict(
+            seconds=dict(self.seconds), calls=dict(self.calls), counts=dict(self.counts)
+        )
+
+    def __str__(self) -> str:
+        lines = []
+        for name, seconds in self.seconds.items():
+            lines.append(
+                "{:<20} {:10.3f} ms {:8} calls".format(
+                    name, 1000 * seconds, self.calls[name]
+                )
+            )
+        for name, value in self.counts.items():
+            lines.append("{:<20} {:10}".format(name, value))
+        return "\n".join(lines)
+
+
+@contextmanager
+def collect():
+    """ Attaches a new `Stats` sink for the duration of a `with` statement.
+
+    Returns
+    -------
+    ContextManager[Stats]"""
+    stats = attach(Stats())
+    try:
+        yield stats
+    finally:
+        detach(stats)
@@ -0,0 +1,315 @@
+"""
+Multi-resolution fingerprints, which tolerate small changes of pitch and tempo.
+
+The exact fingerprints, `(f1, f2, dt)`, miss whenever a recording's frequencies or
+timing drift by a single bin: a recording played back 2% fast moves a peak at bin
+500 by ten bins. Here, each of f1, f2, and dt is instead quantized on a logarithmic
+scale - a change of speed scales them, and thus shifts their logarithms by a fixed
+amount - into bins that are a fraction of an octave wide. Each `Resolution` specifies
+the number of bins per octave, and a song is indexed at several resolutions at
+once: fine bins keep the fingerprints discriminative, and coarse bins catch larger
+drifts.
+
+A feature that lies near the edge of its bin is likely to fall into the neighboring
+bin in a degraded recording; thus, at query time, the neighboring bin of each such
+feature is probed too (see `multires_hashes`). The fingerprints of every
+resolution are stored in a single `songfp.database.FingerprintIndex`; the top 16
+bits of each key, which are unused by the exact fingerprints, hold its resolution.
+Coarse hashes are shared by many songs, thus votes are weighted by the rarity of
+the hash that cast them, and the longest posting lists may be ignored altogether.
+
+See `benchmarks/bench_multires.py` for the recall, and the query cost, of the
+multi-resolution fingerprints versus the exact fingerprints.
+
+This module is an experiment, and stands apart from `songfp.database`: a
+`MultiResolutionIndex` is built in memory, from signals, by its owner, and is
+neither saved nor loaded with the song database, nor consulted by `match_sample`
+and friends.
+
+    >>> index = MultiResolutionIndex()
+    >>> for song_id, digital in enumerate(songs):
+    ...     index.add_sample(digital, fs, song_id)
+    >>> index.rank_sample(recording, fs, k=1)
+"""
+
+from typing import List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .database import FingerprintIndex
+from .functions import (
+    DEFAULT_PARAMS,
+    FingerprintParams,
+    Match,
+    digital_to_spec,
+    local_peak_array,
+    pack_fingerprints,
+    peaks_to_fingerprint_arrays,
+    rank_matches,
+)
+
+__all__ = [
+    "Resolution",
+    "DEFAULT_RESOLUTIONS",
+    "quantize",
+    "multires_hashes",
+    "MultiResolutionIndex",
+]
+
+# the resolution of each key is stored, offset by one, above its (f1, f2, dt) fields
+_LEVEL_SHIFT = np.uint64(48)
+
+
+class Resolution(NamedTuple):
+    """The widths of the bins into which fingerprint features are quantized."""
+
+    # the number of bins per octave of f1 and f2
+    freq_bins: float
+    # the number of bins per octave of dt
+    dt_bins: float
+
+
+DEFAULT_RESOLUTIONS = (Resolution(24, 8), Resolution(8, 4))
+
+
+def quantize(values, bins_per_octave: float) -> Tuple[np.ndarray, np.ndarray]:
+    """Quantizes non-negative values into logarithmically-spaced bins.
+
+    Parameters
+    ----------
+    values : ArrayLike[int]
+        The values to be quantized (e.g. frequency bins).
+
+    bins_per_octave : float
+        The number of bins spanned by each doubling of `value + 1`.
+
+    Returns
+    -------
+    Tuple[numpy.ndarray[int64], numpy.ndarray[float64]]
+        The bin of each value, and the position of the value within its bin,
+        in [0, 1)."""
+    assert 0 < bins_per_octave
+    scaled = np.log2(np.asarray(values, dtype=np.float64) + 1) * bins_per_octave
+    bins = np.floor(scaled)
+    return bins.astype(np.int64), scaled - bins
+
+
+def multires_hashes(
+    peaks: Sequence[Tuple[int, int]],
+    fan_value: int,
+    resolutions: Sequence[Resolution] = DEFAULT_RESOLUTIONS,
+    probe: float = 0.0,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Given the time-frequency locations of spectrogram peaks, computes the packed
+    fingerprint hashes at each resolution.
+
+    Parameters
+    ----------
+    peaks : Sequence[Tuple[int, int]]
+        The time-frequency peaks, as returned by `local_peak_array` or `local_peaks`.
+
+    fan_value : int
+        Given a peak, `fan_value` indicates the number of subsequent peaks
+        to be used to form fingerprint features.
+
+    resolutions : Sequence[Resolution], optional (default=DEFAULT_RESOLUTIONS)
+        The resolutions at which the features are quantized; at most 65535.
+
+    probe : float, optional (default=0.)
+        A feature whose position within its bin is less than `probe` (or greater
+        than `1 - probe`) is also hashed into the preceding (or following) bin,
+        as is every combination of f1, f2, and dt neighbors. Each fingerprint
+        thus yields up to 8 hashes per resolution. Songs are indexed with
+        `probe=0`, and recordings are queried with `0 < probe <= 0.5`.
+
+    Returns
+    -------
+    Tuple[numpy.ndarray[uint64], numpy.ndarray]
+        The packed hashes, and the time at which each hash's fingerprint's first
+        peak occurred. The first M * len(resolutions) hashes are those of the M
+        fingerprints at each resolution, in turn; the probed hashes follow."""
+    assert 0 <= probe <= 0.5
+    assert 0 < len(resolutions) < 2 ** 16
+    f1, f2, dt, t1 = peaks_to_fingerprint_arrays(peaks, fan_value)
+
+    # the (3, M) bins of each resolution, and the neighbor to probe along each
+    # axis: -1 for the preceding bin, +1 for the following bin, or 0 for none
+    levels = []
+    for resolution in resolutions:
+        quantized = [
+            quantize(f1, resolution.freq_bins),
+            quantize(f2, resolution.freq_bins),
+            quantize(dt, resolution.dt_bins),
+        ]
+        bins = np.stack([q[0] for q in quantized])
+        fractions = np.stack([q[1] for q in quantized])
+        steps = np.where(fractions < probe, -1, np.where(fractions >= 1 - probe, 1, 0))
+        levels.append((bins, steps))
+
+    hashes, times = [], []
+    for axes in range(8 if probe > 0 else 1):
+        # probe the neighbors along the axes whose bits are set in `axes`
+        selected = np.array([(axes >> i) & 1 for i in range(3)], dtype=bool)
+        for level, (bins, steps) in enumerate(levels):
+            rows = np.all(steps[selected] != 0, axis=0)
+            probed = bins[:, rows] + steps[:, rows] * selected[:, np.newaxis]
+            tag = np.uint64(level + 1) << _LEVEL_SHIFT
+            hashes.append(pack_fingerprints(*probed) | tag)
+            times.append(t1[rows])
+
+    return np.concatenate(hashes), np.concatenate(times)
+
+
+class MultiResolutionIndex:
+    """ A fingerprint index of multi-resolution hashes, against which degraded
+    recordings are ranked. It is held in memory only (see the module's notes)."""
+
+    def __init__(
+        self,
+        resolutions: Sequence[Resolution] = DEFAULT_RESOLUTIONS,
+        offset_step: int = 4,
+        max_postings: Optional[int] = None,
+        params: FingerprintParams = DEFAULT_PARAMS,
+    ):
+        """ Parameters
+        ----------
+        resolutions : Sequence[Resolution], optional (default=DEFAULT_RESOLUTIONS)
+            The resolutions at which songs are indexed.
+
+        offset_step : int, optional (default=4)
+            The number of spectrogram bins of fingerprint-offset that are tallied
+            as one; a change of tempo makes a recording's offsets drift over its
+            duration, which would otherwise spread its votes across many offsets.
+
+        max_postings : Optional[int], optional (default=None)
+            Keys with more postings than this are ignored by queries (see
+            `FingerprintIndex.max_postings`). Coarse keys are shared by many more
+            songs than are exact keys; their long posting lists dominate the cost
+            of a query, while their votes count for little (see `rank_peaks`).
+
+        params : FingerprintParams, optional (default=DEFAULT_PARAMS)
+            The parameters of the spectrograms and peaks of the signals that are
+            indexed and ranked, and the number of subsequent peaks with which each
+            peak is paired (`fan_value`)."""
+        assert 1 <= offset_step
+        self.resolutions = tuple(Resolution(*r) for r in resolutions)
+        self.params = params.validate()
+        self.fan_value = params.fan_value
+        self.offset_step = offset_step
+        self.index = FingerprintIndex()
+        self.index.max_postings = max_postings
+
+    def add_peaks(self, peaks: Sequence[Tuple[int, int]], song_id: int):
+        """ Indexes a song's fingerprints.
+
+        Parameters
+        ----------
+        peaks : Sequence[Tuple[int, int]]
+            The song's time-frequency peaks (see `local_peak_array`).
+
+        song_id : int"""
+        hashes, times = multires_hashes(peaks, self.fan_value, self.resolutions)
+        self.index.add(hashes, np.full(len(hashes), song_id), times)
+
+    def add_sample(self, digital: np.ndarray, fs: int, song_id: int):
+        """ Indexes the fingerprints of a song's digital signal.
+
+        Parameters
+        ----------
+        digital : numpy.ndarray, shape=(T,)
+
+        fs : int
+            The sampling rate of the signal
+
+        song_id : int"""
+        self.add_peaks(_sample_peaks(digital, fs, self.params), song_id)
+
+    def rank_peaks(
+        self,
+        peaks: Sequence[Tuple[int, int]],
+        k: int = 5,
+        probe: float = 0.25,
+        time_step: float = 1.0,
+    ) -> List[Match]:
+        """ Ranks the songs that best match a recording's peaks.
+
+        Parameters
+        ----------
+        peaks : Sequence[Tuple[int, int]]
+            The recording's time-frequency peaks (see `local_peak_array`).
+
+        k : int, optional (default=5)
+            The maximum number of candidates to return.
+
+        probe : float, optional (default=0.25)
+            How close to the edge of its bin a feature must be for the neighboring
+            bin to be probed (see `multires_hashes`); 0 probes no neighbors.
+
+        time_step : float, optional (default=1.)
+            The time spanned by a spectrogram bin.
+
+        Returns
+        -------
+        List[Match]
+            Up to `k` candidates (see `rank_matches`). A recording's fingerprint
+            votes once at each resolution, and each vote is weighted by the inverse
+            document frequency of the matching hash (see `FingerprintIndex.idf`),
+            thus the votes of coarse resolutions, whose hashes are shared by many
+            songs, count for less than those of fine resolutions."""
+        hashes, times = multires_hashes(
+            peaks, self.fan_value, self.resolutions, probe=probe
+        )
+        query, song_ids, song_times = self.index.lookup(hashes)
+        offsets = (song_times - times[query]) // self.offset_step
+        idf = self.index.idf(hashes)
+
+        # peak n is paired with each of the (up to `fan_value`) peaks that follow
+        # it; the hashes of these fingerprints, unprobed, precede the probed hashes
+        following = np.arange(len(peaks))[::-1]
+        num_fingerprints = int(np.minimum(following, self.fan_value).sum())
+        total = float(idf[: num_fingerprints * len(self.resolutions)].sum())
+        return rank_matches(
+            song_ids,
+            offsets,
+            total,
+            k=k,
+            time_step=time_step * self.offset_step,
+            weights=idf[query],
+        )
+
+    def rank_sample(
+        self, digital: np.ndarray, fs: int, k: int = 5, probe: float = 0.25
+    ) -> List[Match]:
+        """ Ranks the songs that best match a recording's digital signal.
+
+        Parameters
+        ----------
+        digital : numpy.ndarray, shape=(T,)
+
+        fs : int
+            The sampling rate of the signal
+
+        k : int, optional (default=5)
+
+        probe : float, optional (default=0.25)
+            See `rank_peaks`.
+
+        Returns
+        -------
+        List[Match]
+            See `rank_peaks`; offsets are in seconds."""
+        return self.rank_peaks(
+            _sample_peaks(digital, fs, self.params),
+            k=k,
+            probe=probe,
+            time_step=self.params.time_step(fs),
+        )
+
+
+def _sample_peaks(
+    digital: np.ndarray, fs: int, params: FingerprintParams
+) -> np.ndarray:
+    S, cutoff = digital_to_spec(
+        digital, fs, params.frac_cut, nfft=params.nfft, noverlap=params.noverlap
+    )
+    return local_peak_array(S, cutoff, p_nn=params.p_nn)
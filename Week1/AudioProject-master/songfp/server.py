@@ -0,0 +1,691 @@
+"""
+A local song-recognition service, over HTTP.
+
+`RecognitionServer` loads a song database once, and serves recognitions of the
+audio that clients upload to it, either over TCP or over a Unix socket:
+
+    POST /recognize?fs=44100&dtype=int16&k=5    (body: raw mono PCM samples)
+    POST /recognize?format=file&k=5             (body: an audio file, e.g. .wav/.mp3)
+    GET  /health
+
+Recognitions are answered with JSON: `{"matches": [{"song_id": ..., "name": ...,
+"artist": ..., "offset": ..., "votes": ..., "fraction": ..., "margin": ...}, ...]}`.
+
+The CPU-bound stages are kept off of the event loop: uploads are decoded and
+fingerprinted by a pool of worker processes, and the fingerprints of concurrent
+queries are micro-batched - gathered for up to `batch_delay` seconds, or until
+`max_batch` queries are pending - and are looked up in the index at once (see
+`songfp.functions.batch_hashes_to_matches`), on a thread of the server's process.
+
+    $ python -m songfp.server --port 8000 --db path/to/songs.fpdb
+    >>> from songfp.server import recognize
+    >>> recognize(digital, fs=44100, port=8000)
+
+HTTP is spoken by a minimal, standard-library implementation, which supports
+persistent connections and `Content-Length`-delimited bodies; it is meant for
+local use, and not to be exposed to untrusted clients.
+"""
+
+import asyncio
+import json
+import multiprocessing
+import os
+import socket
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple, Union
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+
+from .cache import get_cache, use_cache
+from .functions import (
+    DEFAULT_PARAMS,
+    FingerprintParams,
+    Match,
+    batch_hashes_to_matches,
+    digital_to_hashes,
+    rank_matches,
+)
+
+__all__ = ["RecognitionServer", "ServerClosed", "serve", "recognize"]
+
+_DTYPES = {"int16": np.int16, "float32": np.float32, "float64": np.float64}
+_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+
+
+class ServerClosed(RuntimeError):
+    """ Raised for the queries that are pending when the server is closed."""
+
+
+def _warm_up():
+    # imports what fingerprinting needs, so that the first queries need not
+    from scipy import fft  # noqa: F401
+
+
+def _fingerprint_pcm(
+    digital: np.ndarray, fs: int, params: FingerprintParams
+) -> Tuple[np.ndarray, np.ndarray, int]:
+    return digital_to_hashes(digital, fs, params) + (fs,)
+
+
+def _fingerprint_upload(
+    data: bytes, suffix: str, params: FingerprintParams
+) -> Tuple[np.ndarray, np.ndarray, int]:
+    from .cache import decode
+
+    # decoders read from a path, rather than from memory
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        try:
+            digital, fs = decode(path, sr=44100)
+        except Exception as e:
+            # the decoders raise a variety of errors for malformed uploads
+            raise ValueError("the upload could not be decoded: {!r}".format(e))
+    finally:
+        os.remove(path)
+    return _fingerprint_pcm(digital, fs, params)
+
+
+class _Version(NamedTuple):
+    """A version of what is served: the index, the (name, artist) of each of its
+    song-IDs, and the parameters with which its songs were fingerprinted."""
+
+    index: object
+    song_list: Sequence[Optional[Tuple[str, Optional[str]]]]
+    params: FingerprintParams
+
+
+class _Query:
+    __slots__ = ("hashes", "times", "fs", "k", "version", "future")
+
+    def __init__(self, hashes, times, fs, k, version, future):
+        self.hashes = hashes
+        self.times = times
+        self.fs = fs
+        self.k = k
+        # the version whose parameters the fingerprints were computed with
+        self.version = version
+        self.future = future
+
+
+class RecognitionServer:
+    def __init__(
+        self,
+        index=None,
+        song_list=None,
+        workers: Optional[int] = None,
+        max_batch: int = 64,
+        batch_delay: float = 0.002,
+        max_body: int = 64 * 2 ** 20,
+        params: Optional[FingerprintParams] = None,
+    ):
+        """ Parameters
+        ----------
+        index : Optional[songfp.database.FingerprintIndex]
+            The index to match against. By default, the song database (see
+            `songfp.database.switch_db`) is served: each batch of queries is matched
+            against its latest version (see `Database.snapshot`), thus songs that are
+            added to it while the server runs are recognized.
+
+        song_list : Optional[List[Tuple[str, Optional[str]]]]
+            The (name, artist) of each song-ID in `index`; required if `index` is.
+
+        workers : Optional[int]
+            The number of worker processes that decode and fingerprint uploads.
+            Defaults to the number of CPUs. If 0, this is done on a thread of the
+            server's process instead.
+
+        max_batch : int, optional (default=64)
+            The most queries that are looked up in the index at once.
+
+        batch_delay : float, optional (default=0.002)
+            The longest time, in seconds, that a query waits for others to be
+            batched with it.
+
+        max_body : int, optional (default=64 MiB)
+            The largest upload, in bytes, that is accepted.
+
+        params : Optional[songfp.functions.FingerprintParams]
+            The parameters with which the songs in `index` were fingerprinted;
+            uploads are fingerprinted with the same parameters. Defaults to
+            `DEFAULT_PARAMS`. The song database supplies its own parameters.
+
+        Raises
+        ------
+        ValueError
+            If an argument is out of range, or if `index` and `song_list` are
+            not given together."""
+        if max_batch < 1:
+            raise ValueError("`max_batch` must be at least 1, got {}".format(max_batch))
+        if batch_delay < 0:
+            raise ValueError("`batch_delay` must be non-negative")
+        if (index is None) != (song_list is None):
+            raise ValueError("`song_list` must accompany `index`")
+        if index is None and params is not None:
+            raise ValueError("the song database supplies its own parameters")
+        if index is None:
+            from .database import database
+
+            database.load()
+            self._database = database
+        else:
+            self._database = None
+        self.index = index
+        self.song_list = song_list
+        self.params = DEFAULT_PARAMS if params is None else params.validate()
+        self.workers = os.cpu_count() if workers is None else workers
+        self.max_batch = max_batch
+        self.batch_delay = batch_delay
+        self.max_body = max_body
+        self.num_batches = 0
+        self.num_queries = 0
+
+        self._pool = None
+        self._lookup = None
+        self._queue = None
+        self._batcher = None
+        self._server = None
+
+    async def start(
+        self, host: str = "127.0.0.1", port: int = 8000, path: Optional[str] = None
+    ) -> asyncio.AbstractServer:
+        """ Starts listening for connections.
+
+        Parameters
+        ----------
+        host : str, optional (default="127.0.0.1")
+        port : int, optional (default=8000)
+            The address at which to listen; port 0 picks a free port.
+
+        path : Optional[str]
+            If given, listen on the Unix socket at this path instead.
+
+        Returns
+        -------
+        asyncio.AbstractServer"""
+        if self.workers:
+            # forking a process that runs threads (e.g. the executors' threads) can
+            # deadlock the child; spawned workers instead start from a clean slate
+            self._pool = ProcessPoolExecutor(
+                self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=use_cache,
+                initargs=(get_cache(),),
+            )
+            # start the workers now, rather than upon the first queries
+            loop = asyncio.get_running_loop()
+            warm_ups = [
+                loop.run_in_executor(self._pool, _warm_up) for _ in range(self.workers)
+            ]
+            await asyncio.gather(*warm_ups)
+        else:
+            self._pool = ThreadPoolExecutor(1)
+        # lookups are serialized onto one thread: each is a single vectorized batch
+        self._lookup = ThreadPoolExecutor(1)
+        self._queue = asyncio.Queue()
+        self._batcher = asyncio.ensure_future(self._batch_queries())
+        if path is not None:
+            self._server = await asyncio.start_unix_server(self._handle, path=path)
+        else:
+            self._server = await asyncio.start_server(self._handle, host, port)
+        return self._server
+
+    @property
+    def address(self):
+        """ The address (e.g. `(host, port)`, or a socket path) being listened at."""
+        return self._server.sockets[0].getsockname()
+
+    async def close(self):
+        """ Stops listening, and shuts down the worker pools. Queries that are still
+        pending fail with `ServerClosed`."""
+        if self._server is not None:
+            self._server.close()
+        if self._batcher is not None:
+            # the batcher fails the queries that it holds; then the queued ones fail
+            self._batcher.cancel()
+            try:
+                await self._batcher
+            except asyncio.CancelledError:
+                pass
+            self._batcher = None
+            pending = []
+            while not self._queue.empty():
+                pending.append(self._queue.get_nowait())
+            _fail(pending, ServerClosed("the server was closed"))
+        if self._server is not None:
+            # connections that await a pending query are answered before this returns
+            await self._server.wait_closed()
+            self._server = None
+        for executor in (self._pool, self._lookup):
+            if executor is not None:
+                executor.shutdown()
+        self._pool = self._lookup = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def recognize(
+        self,
+        data: Union[bytes, np.ndarray],
+        fs: Optional[int] = None,
+        k: int = 5,
+        suffix: Optional[str] = None,
+    ) -> List[Match]:
+        """ Recognizes a signal, or the contents of an audio file.
+
+        Parameters
+        ----------
+        data : Union[bytes, numpy.ndarray]
+            The mono signal, or, if `suffix` is given, the bytes of an audio file.
+
+        fs : Optional[int]
+            The sampling rate of the signal.
+
+        k : int, optional (default=5)
+            The maximum number of candidates to return.
+
+        suffix : Optional[str]
+            The file-extension (e.g. ".wav") of the audio file in `data`.
+
+        Returns
+        -------
+        List[Match]
+
+        Raises
+        ------
+        ValueError
+            If the arguments are invalid, or if the audio file cannot be decoded.
+
+        ServerClosed
+            If the server is closed before the query is answered."""
+        return (await self._recognize(data, fs, k, suffix))[1]
+
+    async def _recognize(
+        self,
+        data: Union[bytes, np.ndarray],
+        fs: Optional[int],
+        k: int,
+        suffix: Optional[str],
+    ) -> Tuple[_Version, List[Match]]:
+        # also returns the version that the matches' song-IDs refer to
+        _check_k(k)
+        if suffix is None and (fs is None or fs <= 0):
+            raise ValueError("a positive sampling rate is required, got {}".format(fs))
+        if suffix is None and not len(data):
+            raise ValueError("the signal is empty")
+        loop = asyncio.get_running_loop()
+        version = self._current()
+        if suffix is not None:
+            job = loop.run_in_executor(
+                self._pool, _fingerprint_upload, data, suffix, version.params
+            )
+        else:
+            job = loop.run_in_executor(
+                self._pool, _fingerprint_pcm, data, fs, version.params
+            )
+        hashes, times, fs = await job
+        return await self._rank(hashes, times, fs, k, version)
+
+    async def rank(
+        self, hashes: np.ndarray, times: np.ndarray, fs: int, k: int = 5
+    ) -> List[Match]:
+        """ Ranks the songs that match a signal's fingerprints; the fingerprints are
+        looked up in a batch with those of concurrent queries.
+
+        Parameters
+        ----------
+        hashes : numpy.ndarray[uint64], shape=(Q,)
+        times : numpy.ndarray, shape=(Q,)
+            The signal's fingerprints (see `songfp.functions.peaks_to_hashes`).
+
+        fs : int
+            The sampling rate of the signal.
+
+        k : int, optional (default=5)
+
+        Returns
+        -------
+        List[Match]
+
+        Raises
+        ------
+        ServerClosed
+            If the server is closed before the query is answered."""
+        _check_k(k)
+        return (await self._rank(hashes, times, fs, k, self._current()))[1]
+
+    async def _rank(
+        self, hashes: np.ndarray, times: np.ndarray, fs: int, k: int, version: _Version
+    ) -> Tuple[_Version, List[Match]]:
+        if self._batcher is None:
+            raise ServerClosed("the server is not running")
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(_Query(hashes, times, fs, k, version, future))
+        return await future
+
+    async def _batch_queries(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = []
+            try:
+                batch.append(await self._queue.get())
+                deadline = loop.time() + self.batch_delay
+                while len(batch) < self.max_batch:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(
+                            await asyncio.wait_for(self._queue.get(), timeout)
+                        )
+                    except asyncio.TimeoutError:
+                        break
+                # drain whatever else is already waiting, up to the batch size
+                while len(batch) < self.max_batch and not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+
+                results = await loop.run_in_executor(
+                    self._lookup, self._rank_batch, batch
+                )
+            except asyncio.CancelledError:
+                _fail(batch, ServerClosed("the server was closed"))
+                raise
+            except Exception as e:
+                _fail(batch, e)
+                continue
+            for query, result in zip(batch, results):
+                if not query.future.done():
+                    query.future.set_result(result)
+
+    def _current(self) -> _Version:
+        # the version being served
+        if self._database is None:
+            return _Version(self.index, self.song_list, self.params)
+        snapshot = self._database.snapshot()
+        return _Version(snapshot.index, snapshot.song_list, snapshot.params)
+
+    def _rank_batch(self, batch: List[_Query]) -> List[Tuple[_Version, List[Match]]]:
+        self.num_batches += 1
+        self.num_queries += len(batch)
+        # The batch is ranked against one version, which includes every song of the
+        # versions that its queries were fingerprinted for. A query fingerprinted with
+        # other parameters (i.e. before the database was switched) is ranked against
+        # the version that it was fingerprinted for instead.
+        current = self._current()
+        groups = {}
+        for n, query in enumerate(batch):
+            version = query.version
+            if version.params == current.params:
+                version = current
+            groups.setdefault(id(version), (version, []))[1].append(n)
+
+        results = [None] * len(batch)
+        for version, members in groups.values():
+            queries = [batch[n] for n in members]
+            matches = batch_hashes_to_matches(
+                [query.hashes for query in queries],
+                [query.times for query in queries],
+                version.index,
+            )
+            for n, query, (song_ids, offsets) in zip(members, queries, matches):
+                ranked = rank_matches(
+                    song_ids,
+                    offsets,
+                    len(query.hashes),
+                    k=query.k,
+                    time_step=version.params.time_step(query.fs),
+                )
+                results[n] = (version, ranked)
+        return results
+
+    async def _route(self, method: str, target: str, body: bytes) -> Tuple[int, Dict]:
+        url = urlsplit(target)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        if url.path == "/health":
+            version = self._current()
+            return 200, dict(
+                songs=sum(song is not None for song in version.song_list),
+                params=version.params._asdict(),
+                batches=self.num_batches,
+                queries=self.num_queries,
+            )
+        if url.path != "/recognize":
+            return 404, dict(error="no such path: {}".format(url.path))
+        if method != "POST":
+            return 405, dict(error="/recognize only accepts POST")
+
+        try:
+            k = int(params.get("k", 5))
+            if params.get("format", "pcm") == "file":
+                suffix = params.get("suffix", ".wav")
+                if not suffix.startswith("."):
+                    suffix = "." + suffix
+                version, ranked = await self._recognize(body, None, k, suffix)
+            else:
+                fs = int(params.get("fs", 44100))
+                dtype = params.get("dtype", "int16")
+                if dtype not in _DTYPES:
+                    raise ValueError("unsupported dtype: {}".format(dtype))
+                if not body or len(body) % np.dtype(_DTYPES[dtype]).itemsize:
+                    raise ValueError("the body is not a whole number of samples")
+                samples = np.frombuffer(body, _DTYPES[dtype])
+                version, ranked = await self._recognize(samples, fs, k, None)
+        except ValueError as e:
+            return 400, dict(error="bad request: {}".format(e))
+        except ServerClosed as e:
+            return 503, dict(error=str(e))
+        return 200, dict(matches=[_describe(version, match) for match in ranked])
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request = await _read_request(reader, self.max_body)
+                if request is None:
+                    break
+                method, target, headers, body = request
+                if body is None:
+                    status, payload = 413, dict(error="the upload is too large")
+                else:
+                    try:
+                        status, payload = await self._route(method, target, body)
+                    except Exception as e:
+                        status, payload = 500, dict(error=repr(e))
+                keep_alive = body is not None and (
+                    headers.get("connection", "").lower() != "close"
+                )
+                _write_response(writer, status, payload, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+def _check_k(k: int):
+    if k < 1:
+        raise ValueError("`k` must be at least 1, got {}".format(k))
+
+
+def _fail(queries: List[_Query], error: BaseException):
+    for query in queries:
+        if not query.future.done():
+            query.future.set_exception(error)
+
+
+def _describe(version: _Version, match: Match) -> Dict:
+    name, artist = version.song_list[match.song_id] or (None, None)
+    return dict(match._asdict(), name=name, artist=artist)
+
+
+async def _read_request(
+    reader: asyncio.StreamReader, max_body: int
+) -> Optional[Tuple[str, str, Dict[str, str], Optional[bytes]]]:
+    """ Reads one request; returns `None` once the client has closed the connection.
+    The body is `None` if it is larger than `max_body`."""
+    line = await reader.readline()
+    if not line.strip():
+        return None
+    method, target, _ = line.decode("latin-1").split(" ", 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", 0))
+    if length > max_body:
+        return method, target, headers, None
+    body = await reader.readexactly(length) if length else b""
+    return method, target, headers, body
+
+
+def _write_response(
+    writer: asyncio.StreamWriter, status: int, payload: Dict, keep_alive: bool
+):
+    body = json.dumps(payload).encode("utf-8")
+    head = (
+        "HTTP/1.1 {} {}\r\n"
+        "Content-Type: application/json\r\n"
+        "Content-Length: {}\r\n"
+        "Connection: {}\r\n\r\n"
+    ).format(
+        status, _REASONS[status], len(body), "keep-alive" if keep_alive else "close"
+    )
+    writer.write(head.encode("latin-1") + body)
+
+
+def serve(
+    host: str = "127.0.0.1", port: int = 8000, path: Optional[str] = None, **kwargs
+):
+    """ Runs a `RecognitionServer` until interrupted.
+
+    Parameters
+    ----------
+    host : str, optional (default="127.0.0.1")
+    port : int, optional (default=8000)
+    path : Optional[str]
+        See `RecognitionServer.start`.
+
+    **kwargs
+        Passed to `RecognitionServer`."""
+
+    async def main():
+        async with RecognitionServer(**kwargs) as server:
+            await server.start(host, port, path)
+            print("songfp server listening at {}".format(server.address))
+            await server._server.serve_forever()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+
+
+def recognize(
+    data: Union[np.ndarray, str, Path],
+    fs: int = 44100,
+    k: int = 5,
+    host: str = "127.0.0.1",
+    port: int = 8000,
+    path: Optional[str] = None,
+    timeout: Optional[float] = 60.0,
+) -> List[Dict]:
+    """ Asks a running `RecognitionServer` to recognize a signal or an audio file.
+
+    Parameters
+    ----------
+    data : Union[numpy.ndarray, PathLike]
+        A mono signal, or the path to an audio file.
+
+    fs : int, optional (default=44100)
+        The sampling rate of the signal.
+
+    k : int, optional (default=5)
+        The maximum number of candidates to return.
+
+    host : str, optional (default="127.0.0.1")
+    port : int, optional (default=8000)
+    path : Optional[str]
+        The address of the server: a TCP address, or the path to a Unix socket.
+
+    timeout : Optional[float], optional (default=60.)
+
+    Returns
+    -------
+    List[Dict]
+        The candidates, as described by the server."""
+    if isinstance(data, (str, Path)):
+        target = "/recognize?format=file&suffix={}&k={}".format(Path(data).suffix, k)
+        body = Path(data).read_bytes()
+    else:
+        data = np.asarray(data)
+        dtype = data.dtype.name if data.dtype.name in _DTYPES else "float64"
+        target = "/recognize?fs={}&dtype={}&k={}".format(fs, dtype, k)
+        body = np.ascontiguousarray(data, dtype=_DTYPES[dtype]).tobytes()
+
+    if path is not None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        sock.connect(path)
+    else:
+        sock = socket.create_connection((host, port), timeout=timeout)
+    with sock:
+        head = (
+            "POST {} HTTP/1.1\r\nHost: songfp\r\nContent-Length: {}\r\n"
+            "Connection: close\r\n\r\n"
+        ).format(target, len(body))
+        sock.sendall(head.encode("latin-1") + body)
+        response = b"".join(iter(lambda: sock.recv(2 ** 16), b""))
+    status_line, _, rest = response.partition(b"\r\n")
+    payload = json.loads(rest.partition(b"\r\n\r\n")[2])
+    status = int(status_line.split()[1])
+    if status != 200:
+        raise RuntimeError(
+            "the server responded {}: {}".format(status, payload["error"])
+        )
+    return payload["matches"]
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serves song recognition over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--unix", default=None, help="listen on this Unix socket")
+    parser.add_argument("--db", default=None, help="the song database to serve")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--max-batch", type=int, default=64)
+    parser.add_argument("--batch-delay", type=float, default=0.002)
+    args = parser.parse_args()
+
+    if args.db is not None:
+        from .database import switch_db
+
+        switch_db(args.db)
+    serve(
+        args.host,
+        args.port,
+        args.unix,
+        workers=args.workers,
+        max_batch=args.max_batch,
+        batch_delay=args.batch_delay,
+    )
@@ -0,0 +1,165 @@
+"""
+A reusable short-time Fourier transform engine.
+
+`SpectrogramEngine` produces the same power-spectral-density spectrogram as
+`matplotlib.mlab.specgram` with a Hann window, but:
+
+ - the window and the per-bin PSD normalization are computed once, up front
+ - real-input FFTs are used
+ - a signal can be fed block-by-block; each block only pays for the frames that
+   it completes, and the frames are identical to those of the whole signal
+ - a gain (e.g. 2**15 for signals in [-1, 1]) is folded into the normalization,
+   rather than being applied to a copy of the signal
+
+`scipy.fft` caches its FFT plans for a given transform length, so every engine
+of a given `nfft` reuses the same plan.
+"""
+
+from functools import lru_cache
+
+import numpy as np
+
+__all__ = ["SpectrogramEngine", "get_engine"]
+
+
+class SpectrogramEngine:
+    def __init__(self, fs: float, nfft: int = 4096, noverlap: int = 2048):
+        """ Parameters
+        ----------
+        fs : float
+            The sampling rate of the signals to be transformed.
+
+        nfft : int, optional (default=4096)
+            The number of samples in each FFT window.
+
+        noverlap : int, optional (default=2048)
+            The number of samples by which successive windows overlap."""
+        assert 0 <= noverlap < nfft
+        self.fs = fs
+        self.nfft = nfft
+        self.noverlap = noverlap
+        self.hop = nfft - noverlap
+
+        self.window = np.hanning(nfft)
+
+        # one-sided PSD normalization (see `matplotlib.mlab.psd`): all bins
+        # but DC (and Nyquist, for even `nfft`) are doubled, and the density
+        # is scaled by the sampling rate and the window's power
+        scaling = np.full(nfft // 2 + 1, 2.0)
+        scaling[0] = 1.0
+        if not nfft % 2:
+            scaling[-1] = 1.0
+        self._scaling = scaling / (fs * (self.window ** 2).sum())
+
+        self._pending = np.empty(0, dtype=np.float64)
+
+    @property
+    def num_freqs(self) -> int:
+        return self.nfft // 2 + 1
+
+    @property
+    def freqs(self) -> np.ndarray:
+        """ The frequency, in Hz, of each spectrogram row."""
+        return np.arange(self.num_freqs) * (self.fs / self.nfft)
+
+    @property
+    def time_step(self) -> float:
+        """ The time, in seconds, between successive spectrogram columns."""
+        return self.hop / self.fs
+
+    def num_frames(self, num_samples: int) -> int:
+        """ The number of spectrogram columns produced for a signal of `num_samples`."""
+        return max(1, (max(num_samples, self.nfft) - self.noverlap) // self.hop)
+
+    def _frames(self, digital: np.ndarray) -> np.ndarray:
+        # (n_frames, nfft) view of the signal's overlapping windows
+        digital = np.asarray(digital)
+        if len(digital) < self.nfft:
+            # like `mlab.specgram`, zero-pad short signals to one window
+            digital = np.concatenate(
+                [digital, np.zeros(self.nfft - len(digital), dtype=digital.dtype)]
+            )
+        windows = np.lib.stride_tricks.sliding_window_view(digital, self.nfft)
+        return windows[:: self.hop]
+
+    def _psd(self, frames: np.ndarray, gain: float) -> np.ndarray:
+        # (n_frames, nfft) -> (n_freq, n_frames) power spectral density
+        # (scipy.fft is slow to import; processes that only match need not pay for it)
+        from scipy import fft as sp_fft
+
+        spectrum = sp_fft.rfft(frames * self.window, axis=1)
+        power = np.square(spectrum.real)
+        power += np.square(spectrum.imag)
+        power *= self._scaling * gain ** 2
+        return power.T
+
+    def transform(self, digital: np.ndarray, gain: float = 1.0) -> np.ndarray:
+        """ Computes the spectrogram of an entire signal.
+
+        Parameters
+        ----------
+        digital : numpy.ndarray, shape=(T,)
+            The sampled audio-signal.
+
+        gain : float, optional (default=1.)
+            The factor by which the signal is scaled prior to the transform.
+
+        Returns
+        -------
+        numpy.ndarray, shape=(n_freq, n_time)
+            The spectrogram, as produced by `mlab.specgram`."""
+        return self._psd(self._frames(digital), gain)
+
+    def feed(self, block: np.ndarray, gain: float = 1.0) -> np.ndarray:
+        """ Appends a block to the signal being streamed, and computes the spectrogram
+        columns that the block completes.
+
+        Parameters
+        ----------
+        block : numpy.ndarray, shape=(T,)
+            The next samples of the signal.
+
+        gain : float, optional (default=1.)
+            The factor by which the signal is scaled prior to the transform.
+
+        Returns
+        -------
+        numpy.ndarray, shape=(n_freq, n_new)
+            The new spectrogram columns; `n_new` may be zero."""
+        pending = np.concatenate([self._pending, block])
+        num_frames = (len(pending) - self.noverlap) // self.hop
+        if num_frames < 1:
+            self._pending = pending
+            return np.empty((self.num_freqs, 0))
+
+        consumed = num_frames * self.hop
+        S = self._psd(self._frames(pending[: consumed + self.noverlap]), gain)
+        self._pending = pending[consumed:]
+        return S
+
+    def reset(self):
+        """ Discards the samples pending from `feed`."""
+        self._pending = np.empty(0, dtype=np.float64)
+
+
+@lru_cache(maxsize=None)
+def _get_engine(fs: float, nfft: int, noverlap: int) -> SpectrogramEngine:
+    return SpectrogramEngine(fs, nfft=nfft, noverlap=noverlap)
+
+
+def get_engine(fs: float, nfft: int = 4096, noverlap: int = 2048) -> SpectrogramEngine:
+    """ Returns a shared engine for whole-signal transforms.
+
+    The engine should not be used with `feed`, which is stateful; create a
+    `SpectrogramEngine` for each stream instead.
+
+    Parameters
+    ----------
+    fs : float
+    nfft : int, optional (default=4096)
+    noverlap : int, optional (default=2048)
+
+    Returns
+    -------
+    SpectrogramEngine"""
+    return _get_engine(fs, nfft, noverlap)
@@ -0,0 +1,337 @@
+"""
+Incremental song recognition for audio that arrives a buffer at a time.
+
+`StreamingRecognizer` consumes successive blocks of a signal, extends the
+spectrogram by the frames that those blocks complete, and fingerprints the
+peaks whose neighborhoods have been fully observed. The offset histogram is
+updated with each batch of fingerprints, so that a confident match can be
+reported long before a fixed-length recording would have finished.
+
+Only the spectrogram columns that peaks remain to be extracted from (and their
+neighbors), and the peaks that remain to be fingerprinted, are held; the matches
+are tallied into the histogram as they arrive, and are not kept. The histogram
+drops the (song-ID, offset) pairs that can receive no more votes - those whose
+offset exceeds the latest time in the index less the time of the earliest
+fingerprint yet to come - thus it holds pairs spanning about one song's length
+of offsets, however long the stream. Neither the time taken to process a block,
+nor the memory held, therefore grows with the length of the stream.
+"""
+
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from .functions import (
+    NFFT,
+    NOVERLAP,
+    PEAK_DTYPE,
+    CutoffSketch,
+    Match,
+    _pack_matches,
+    _unpack_matches,
+    hashes_to_matches,
+    local_peak_array,
+    offset_histogram,
+    pack_fingerprints,
+    peaks_to_fingerprint_arrays,
+    rank_histogram,
+)
+from .spectrogram import SpectrogramEngine
+
+__all__ = ["StreamingRecognizer"]
+
+
+def _grow(array: np.ndarray, size: int, fill) -> np.ndarray:
+    # `array`, extended with `fill` to at least `size` entries; doubles its capacity
+    if size <= len(array):
+        return array
+    grown = np.full(max(size, 2 * len(array)), fill, dtype=array.dtype)
+    grown[: len(array)] = array
+    return grown
+
+
+class _RunningHistogram:
+    """ The offset histogram (see `songfp.functions.offset_histogram`) of a stream of
+    matches, to which each batch of matches is added in time proportional to its
+    size; each song's best offset is maintained as the votes arrive.
+
+    The tallies of pairs that can receive no more votes are needed only insofar as
+    they are their songs' best offsets, which are kept apart; `prune` drops them."""
+
+    # `prune` rebuilds the slots only once they have doubled since the last rebuild
+    MIN_PRUNE_SIZE = 1024
+
+    def __init__(self):
+        self.num_matches = 0
+        # the slot of each distinct (song-ID, offset) pair, the packed pair, and its
+        # tally
+        self._slots: Dict[int, int] = {}
+        self._pairs = np.zeros(0, dtype=np.int64)
+        self._counts = np.zeros(0, dtype=np.int64)
+        # the position of each pair's first occurrence among the matches
+        self._first = np.zeros(0, dtype=np.int64)
+        # each song's most common offset, with ties broken by first occurrence
+        self._best_counts = np.zeros(0, dtype=np.int64)
+        self._best_first = np.zeros(0, dtype=np.int64)
+        self._best_offsets = np.zeros(0, dtype=np.int32)
+        self._prune_size = self.MIN_PRUNE_SIZE
+
+    def add(self, song_ids: np.ndarray, offsets: np.ndarray):
+        if not len(song_ids):
+            return
+        num_matches = self.num_matches
+        self.num_matches += len(song_ids)
+        song_ids, offsets, counts, first = offset_histogram(song_ids, offsets)
+        first += num_matches
+
+        num_slots = len(self._slots)
+        pairs = _pack_matches(song_ids, offsets)
+        slots = np.array(
+            [self._slots.setdefault(pair, len(self._slots)) for pair in pairs.tolist()],
+            dtype=np.intp,
+        )
+        self._pairs = _grow(self._pairs, len(self._slots), 0)
+        self._counts = _grow(self._counts, len(self._slots), 0)
+        self._first = _grow(self._first, len(self._slots), 0)
+        new = slots >= num_slots
+        self._pairs[slots[new]] = pairs[new]
+        self._first[slots[new]] = first[new]
+        # the pairs are distinct, thus their slots are too
+        self._counts[slots] += counts
+        counts, first = self._counts[slots], self._first[slots]
+
+        # only the pairs that received votes can displace their songs' best offsets
+        order = np.lexsort((first, -counts, song_ids))
+        lead = order[np.r_[True, song_ids[order][1:] != song_ids[order][:-1]]]
+        song_ids, offsets, counts, first = (
+            i[lead] for i in (song_ids, offsets, counts, first)
+        )
+        size = int(song_ids.max()) + 1
+        self._best_counts = _grow(self._best_counts, size, 0)
+        self._best_first = _grow(self._best_first, size, 0)
+        self._best_offsets = _grow(self._best_offsets, size, 0)
+        best_counts = self._best_counts[song_ids]
+        better = (counts > best_counts) | (
+            (counts == best_counts) & (first < self._best_first[song_ids])
+        )
+        song_ids = song_ids[better]
+        self._best_counts[song_ids] = counts[better]
+        self._best_first[song_ids] = first[better]
+        self._best_offsets[song_ids] = offsets[better]
+
+    def prune(self, max_offset: int):
+        """ Drops the pairs whose offsets exceed `max_offset`: the caller guarantees
+        that no such pair will receive another vote. The pairs are rebuilt only
+        once their number has doubled, thus this costs amortized O(1) per pair."""
+        num_slots = len(self._slots)
+        if num_slots < self._prune_size:
+            return
+        pairs = self._pairs[:num_slots]
+        keep = np.flatnonzero(_unpack_matches(pairs)[1] <= max_offset)
+        self._pairs = pairs[keep]
+        self._counts = self._counts[keep]
+        self._first = self._first[keep]
+        self._slots = dict(zip(self._pairs.tolist(), range(len(keep))))
+        self._prune_size = max(2 * len(keep), self.MIN_PRUNE_SIZE)
+
+    def rank(self, num_hashes: int, k: int, time_step: float) -> List[Match]:
+        """ The ranking of `songfp.functions.rank_matches` for all of the matches."""
+        (song_ids,) = np.nonzero(self._best_counts)
+        return rank_histogram(
+            song_ids,
+            self._best_offsets[song_ids],
+            self._best_counts[song_ids],
+            self._best_first[song_ids],
+            num_hashes,
+            k=k,
+            time_step=time_step,
+        )
+
+
+class StreamingRecognizer:
+    def __init__(
+        self,
+        index,
+        fs: int,
+        frac_cut: float = 0.77,
+        p_nn: int = 20,
+        fan_value: int = 15,
+        nfft: int = NFFT,
+        noverlap: int = NOVERLAP,
+        k: int = 5,
+        min_votes: int = 10,
+        min_margin: int = 5,
+    ):
+        """ Parameters
+        ----------
+        index : songfp.database.FingerprintIndex
+            The fingerprint index being matched against.
+
+        fs : int
+            The sampling rate of the signal.
+
+        frac_cut : float, optional (default=0.77)
+            The fraction of the spectrogram's intensities that fall below the
+            peak-amplitude threshold (see `songfp.functions.digital_to_spec`).
+
+        p_nn : int, optional (default=20)
+            The radius of a peak's neighborhood (see `songfp.functions.local_peaks`).
+
+        fan_value : int, optional (default=15)
+            The number of subsequent peaks that are paired with each peak
+            (see `songfp.functions.peaks_to_fingerprints`).
+
+        nfft : int, optional (default=NFFT)
+        noverlap : int, optional (default=NOVERLAP)
+            The length of, and overlap between, the spectrogram's FFT windows.
+            These, along with `frac_cut`, `p_nn`, and `fan_value`, must match the
+            parameters with which the songs in `index` were fingerprinted (see
+            `songfp.functions.FingerprintParams`).
+
+        k : int, optional (default=5)
+            The number of ranked candidates to maintain.
+
+        min_votes : int, optional (default=10)
+            The number of votes that the leading candidate must receive to be
+            considered a confident match.
+
+        min_margin : int, optional (default=5)
+            The number of votes by which the leading candidate must lead the
+            runner-up to be considered a confident match."""
+        assert 0.0 <= frac_cut <= 1.0
+        self.index = index
+        self.fs = fs
+        self.frac_cut = frac_cut
+        self.p_nn = p_nn
+        self.fan_value = fan_value
+        self.k = k
+        self.min_votes = min_votes
+        self.min_margin = min_margin
+
+        # buffers the samples that have not yet completed a spectrogram frame
+        self._engine = SpectrogramEngine(fs, nfft=nfft, noverlap=noverlap)
+        # the log-scaled spectrogram columns whose peaks have not been extracted,
+        # preceded by up to `p_nn` columns of context, shape=(n_freq, n_time);
+        # `_start` is the index of the first
+        self._spectrogram = np.empty((nfft // 2 + 1, 0), dtype=np.float64)
+        self._start = 0
+        # estimates the amplitude threshold from the columns seen thus far
+        self._cutoff = CutoffSketch(frac_cut)
+        # the first column whose peaks have not been extracted
+        self._next_column = 0
+
+        # the peaks that have not been fingerprinted as anchors, in order of time
+        # then frequency
+        self._peaks = np.empty(0, dtype=PEAK_DTYPE)
+
+        self._num_hashes = 0
+        self._histogram = _RunningHistogram()
+        # the latest time in the index, which bounds the offsets of future votes
+        self._max_time = index.max_time
+        self.ranking: List[Match] = []
+
+    @property
+    def num_columns(self) -> int:
+        """ The number of spectrogram columns computed thus far."""
+        return self._start + self._spectrogram.shape[1]
+
+    @property
+    def duration(self) -> float:
+        """ The duration, in seconds, of the spectrogram computed thus far."""
+        return self.num_columns * self._engine.time_step
+
+    @property
+    def best(self) -> Optional[Match]:
+        """ The leading candidate, or `None` if there are no matches."""
+        return self.ranking[0] if self.ranking else None
+
+    @property
+    def confident(self) -> bool:
+        """ Whether the leading candidate clears the confidence thresholds."""
+        best = self.best
+        return (
+            best is not None
+            and best.votes >= self.min_votes
+            and best.margin >= self.min_margin
+        )
+
+    def feed(self, samples: np.ndarray) -> List[Match]:
+        """ Consume the next block of the signal.
+
+        Parameters
+        ----------
+        samples : numpy.ndarray, shape=(T,)
+            The next samples of the signal. Integer samples are taken to be 16-bit
+            PCM; floating-point samples are taken to lie in [-1, 1].
+
+        Returns
+        -------
+        List[Match]
+            The current ranking of candidates."""
+        samples = np.asarray(samples)
+        gain = 2 ** 15 if np.issubdtype(samples.dtype, np.floating) else 1
+        S = self._engine.feed(samples, gain=gain)
+        if not S.shape[1]:
+            return self.ranking
+
+        np.clip(S, a_min=1e-20, a_max=None, out=S)
+        np.log(S, out=S)
+        self._spectrogram = np.concatenate([self._spectrogram, S], axis=1)
+        self._cutoff.update(S)
+
+        # A column's peaks are final once `p_nn` columns on either side are known
+        self._update(self.num_columns - self.p_nn, final=False)
+        return self.ranking
+
+    def finish(self) -> List[Match]:
+        """ Treat the signal fed thus far as complete: extract the peaks from the
+        trailing spectrogram columns and fingerprint the trailing peaks.
+
+        Returns
+        -------
+        List[Match]
+            The final ranking of candidates."""
+        self._update(self.num_columns, final=True)
+        return self.ranking
+
+    def _update(self, stop_column: int, final: bool):
+        if stop_column > self._next_column:
+            cutoff = self._cutoff.cutoff()
+
+            # the held columns begin at most `p_nn` columns before `_next_column`
+            S = self._spectrogram
+            peaks = local_peak_array(
+                S[:, : stop_column + self.p_nn - self._start], cutoff, p_nn=self.p_nn
+            )
+            peaks["t"] += self._start
+            keep = (self._next_column <= peaks["t"]) & (peaks["t"] < stop_column)
+            self._peaks = np.concatenate([self._peaks, peaks[keep]])
+            self._next_column = stop_column
+
+            # keep the context needed by the columns that remain to be searched
+            start = max(stop_column - self.p_nn, self._start)
+            self._spectrogram = S[:, start - self._start :].copy()
+            self._start = start
+
+        # A peak can be fingerprinted once its `fan_value` successors are known
+        num_anchors = len(self._peaks) if final else len(self._peaks) - self.fan_value
+        if num_anchors <= 0:
+            return
+
+        f1, f2, dt, t1 = peaks_to_fingerprint_arrays(self._peaks, self.fan_value)
+        if not final:
+            # each of these anchors is paired with exactly `fan_value` peaks
+            num = num_anchors * self.fan_value
+            f1, f2, dt, t1 = f1[:num], f2[:num], dt[:num], t1[:num]
+        self._peaks = self._peaks[num_anchors:]
+
+        hashes = pack_fingerprints(f1, f2, dt)
+        self._num_hashes += len(hashes)
+        self._histogram.add(*hashes_to_matches(hashes, t1, self.index))
+        # future fingerprints are anchored no earlier than the peaks that remain
+        frontier = self._peaks["t"][0] if len(self._peaks) else self._next_column
+        self._histogram.prune(self._max_time - int(frontier))
+        if self._num_hashes:
+            self.ranking = self._histogram.rank(
+                self._num_hashes, k=self.k, time_step=self._engine.time_step
+            )
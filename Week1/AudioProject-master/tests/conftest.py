@@ -0,0 +1,54 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+import songfp.cache
+from songfp.database._database import Database
+
+FS = 44100
+
+
+def synthetic_song(seed: int, duration: float = 8.0, fs: int = FS) -> np.ndarray:
+    """ A sequence of random chords, normalized to [-1, 1]."""
+    rng = np.random.RandomState(seed)
+    t = np.arange(int(duration * fs)) / fs
+    song = np.zeros_like(t)
+    for start in np.arange(0, duration, 0.25):
+        note = (start <= t) & (t < start + 0.25)
+        for freq in rng.uniform(100, 4000, size=3):
+            song[note] += np.sin(2 * np.pi * freq * t[note])
+    song += 0.01 * rng.randn(len(t))
+    return (song / np.abs(song).max()).astype(np.float32)
+
+
+@pytest.fixture(scope="session", autouse=True)
+def cache_directory(tmp_path_factory):
+    # keep the tests' decoded audio out of the user's cache
+    songfp.cache.configure(directory=tmp_path_factory.mktemp("cache"), enabled=True)
+
+
+@pytest.fixture(scope="session")
+def songs(tmp_path_factory):
+    """ The paths to, and signals of, six synthetic songs saved as .wav files."""
+    import soundfile
+
+    directory = tmp_path_factory.mktemp("songs")
+    paths, signals = [], []
+    for n in range(6):
+        signals.append(synthetic_song(n))
+        paths.append(directory / "song{}.wav".format(n))
+        soundfile.write(str(paths[-1]), signals[-1], FS)
+    return paths, signals
+
+
+@pytest.fixture
+def db(tmp_path) -> Database:
+    """ An empty database, saved in a temporary directory."""
+    database = Database()
+    database.switch_db(Path(tmp_path) / "test_db")
+    return database
+
+
+def clip(signal: np.ndarray, start: float = 2.0, duration: float = 3.0) -> np.ndarray:
+    return signal[int(start * FS) : int((start + duration) * FS)]
@@ -0,0 +1,62 @@
+import multiprocessing
+import os
+import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import songfp.cache
+from songfp.cache import AudioCache, get_cache, use_cache
+
+
+def cache_settings():
+    cache = get_cache()
+    return cache.directory, cache.enabled, cache.max_bytes
+
+
+def test_cache_is_opt_in():
+    env = {k: v for k, v in os.environ.items() if k != "SONGFP_CACHE_DIR"}
+    script = "import songfp.cache; print(songfp.cache.get_cache().enabled)"
+    for extra, expected in [({}, "False"), ({"SONGFP_CACHE_DIR": "x"}, "True")]:
+        out = subprocess.run(
+            [sys.executable, "-c", script],
+            env=dict(env, **extra),
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        assert out.stdout.strip() == expected
+
+
+def test_eviction_scans_only_past_the_bound(tmp_path, monkeypatch):
+    cache = AudioCache(tmp_path, max_bytes=10_000)
+    evictions = []
+    evict = AudioCache.evict
+    monkeypatch.setattr(
+        AudioCache, "evict", lambda self: evictions.append(1) or evict(self)
+    )
+    for n in range(20):
+        cache._write(cache._entry(str(n), "pcm"), np.zeros(250, dtype=np.float32))
+        assert cache.size <= cache.max_bytes
+    # each entry is about 1 kB: roughly every other write past the first ten evicts
+    assert 0 < len(evictions) < 20
+    assert len(list(tmp_path.glob("*.npy"))) <= 10
+    assert cache._size == cache.size
+
+
+def test_workers_use_the_configured_cache(tmp_path):
+    original = get_cache()
+    cache = AudioCache(tmp_path, max_bytes=12345, enabled=True)
+    use_cache(cache)
+    try:
+        with ProcessPoolExecutor(
+            1,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=use_cache,
+            initargs=(get_cache(),),
+        ) as pool:
+            assert pool.submit(cache_settings).result() == (tmp_path, True, 12345)
+    finally:
+        use_cache(original)
+    assert songfp.cache.get_cache() is original
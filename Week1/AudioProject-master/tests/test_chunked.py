@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from conftest import FS, synthetic_song
+from songfp.chunked import ChunkedPeakFinder, decode_blocks, file_peaks
+from songfp.functions import digital_to_spec, local_peak_array
+
+
+def reference_peaks(path, p_nn: int = 20) -> np.ndarray:
+    from songfp.cache import decode
+
+    digital, fs = decode(path, sr=FS)
+    return local_peak_array(*digital_to_spec(digital, fs, 0.77), p_nn=p_nn)
+
+
+def write(path, signal) -> str:
+    import soundfile
+
+    soundfile.write(str(path), signal, FS)
+    return str(path)
+
+
+@pytest.mark.parametrize("block_size", [3000, 2 ** 18])
+def test_peaks_match_local_peak_array(songs, block_size):
+    paths, _ = songs
+    for path in paths[:2]:
+        expected = reference_peaks(path)
+        assert np.array_equal(file_peaks(path, block_size=block_size), expected)
+
+
+@pytest.mark.parametrize("p_nn", [1, 2])
+def test_exact_threshold_decides_maxima_near_it(songs, p_nn):
+    # with small neighborhoods, many maxima lie within the sketch bin of the threshold
+    paths, _ = songs
+    expected = reference_peaks(paths[0], p_nn=p_nn)
+    assert np.array_equal(file_peaks(paths[0], p_nn=p_nn), expected)
+
+    finder = ChunkedPeakFinder(FS, p_nn=p_nn)
+    for block in decode_blocks(paths[0]):
+        finder.feed(block)
+    # the estimated threshold never exceeds the exact one
+    approximate = finder.finish()
+    assert len(np.intersect1d(approximate, expected)) == len(expected)
+
+
+@pytest.mark.parametrize("fraction_silent", [0.9, 1.0, 0.5])
+def test_mostly_silent_file(tmp_path, fraction_silent):
+    song = synthetic_song(7, duration=6.0)
+    signal = np.zeros(len(song), dtype=np.float32)
+    start = int(fraction_silent * len(song))
+    signal[start:] = song[start:]
+    path = write(tmp_path / "silent.wav", signal)
+
+    expected = reference_peaks(path)
+    assert np.array_equal(file_peaks(path, block_size=5000), expected)
@@ -0,0 +1,204 @@
+import multiprocessing
+import pickle
+from collections import defaultdict
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+import songfp
+from conftest import FS, clip
+from songfp.database._database import Database
+from songfp.database._storage import convert_pickle_db, list_segments
+
+
+def reopen(db: Database) -> Database:
+    reopened = Database()
+    reopened.switch_db(db.path)
+    return reopened
+
+
+def best(snapshot, signal) -> str:
+    ranked = songfp._rank_sample(snapshot, clip(signal), FS, 1, False, False)
+    name, _ = snapshot.song_list[ranked[0].song_id]
+    return name
+
+
+def test_segments_are_loaded_without_copying_the_base(db, songs):
+    paths, signals = songs
+    db.add_songs(paths[:3], names=["a", "b", "c"])
+    db.save()
+    db.add_songs(paths[3:5], names=["d", "e"])
+    db.save()
+    assert len(list_segments(db.path)) == 1
+
+    loaded = reopen(db)
+    index = loaded.snapshot().index
+    assert isinstance(index.keys, np.memmap)
+    assert isinstance(index.song_ids, np.memmap)
+    assert index.overlay is not None
+    assert len(index) == len(db.index)
+    assert best(loaded.snapshot(), signals[4]) == "e"
+    assert best(loaded.snapshot(), signals[0]) == "a"
+
+    # songs added after loading go to the overlay too
+    loaded.add_songs(paths[5:], names=["f"])
+    assert isinstance(loaded.index.keys, np.memmap)
+    assert best(loaded.snapshot(), signals[5]) == "f"
+
+
+def postings(index) -> dict:
+    # each key's live postings, regardless of their order
+    return {key: sorted(value) for key, value in index.items() if value}
+
+
+def test_save_round_trip(db, songs):
+    paths, signals = songs
+    db.add_songs(paths[:3], names=["a", "b", "c"], artists=["x", None, "z"])
+    db.save()
+
+    loaded = reopen(db)
+    assert loaded.snapshot().song_list == db.snapshot().song_list
+    assert loaded.params == db.params
+    assert postings(loaded.index) == postings(db.index)
+    assert best(loaded.snapshot(), signals[2]) == "c"
+
+
+def test_segments_round_trip(db, songs):
+    paths, signals = songs
+    db.add_songs(paths[:2], names=["a", "b"])
+    db.save()
+    for n in (2, 3):
+        db.add_songs(paths[n : n + 1], names=["cd"[n - 2]])
+        db.save()
+    assert len(list_segments(db.path)) == 2
+
+    loaded = reopen(db)
+    assert loaded.snapshot().song_list == db.snapshot().song_list
+    assert postings(loaded.index) == postings(db.index)
+    assert best(loaded.snapshot(), signals[3]) == "d"
+
+
+def test_remove_round_trip(db, songs):
+    paths, signals = songs
+    db.add_songs(paths[:3], names=["a", "b", "c"])
+    db.save()
+    db.remove_song("b")
+    db.save()
+
+    loaded = reopen(db)
+    assert [name for name, _ in loaded.list_songs()] == ["a", "c"]
+    ranked = songfp._rank_sample(
+        loaded.snapshot(), clip(signals[1]), FS, 3, False, False
+    )
+    assert 1 not in [match.song_id for match in ranked]
+    assert best(loaded.snapshot(), signals[0]) == "a"
+
+
+def test_compact_round_trip(db, songs):
+    paths, signals = songs
+    db.add_songs(paths[:3], names=["a", "b", "c"])
+    db.save()
+    db.add_songs(paths[3:4], names=["d"])
+    db.remove_song("a")
+    db.compact(wait=True)
+    assert not list_segments(db.path)
+    assert db.index.num_dead == 0
+
+    loaded = reopen(db)
+    assert loaded.index.num_dead == 0
+    assert postings(loaded.index) == postings(db.index)
+    assert [name for name, _ in loaded.list_songs()] == ["b", "c", "d"]
+    assert best(loaded.snapshot(), signals[3]) == "d"
+
+
+@pytest.mark.parametrize("by", ["hash", "song"])
+def test_shard_round_trip(db, songs, by):
+    paths, signals = songs
+    db.add_songs(paths[:4], names=["a", "b", "c", "d"])
+    db.save()
+    unsharded = [
+        songfp._rank_sample(db.snapshot(), clip(signal), FS, 3, False, False)
+        for signal in signals[:4]
+    ]
+
+    loaded = reopen(db)
+    loaded.shard(2, by=by, processes=False)
+    sharded = [
+        songfp._rank_sample(loaded.snapshot(), clip(signal), FS, 3, False, False)
+        for signal in signals[:4]
+    ]
+    assert sharded == unsharded
+
+    # sharding does not change what is saved
+    loaded.add_songs(paths[4:5], names=["e"])
+    loaded.save()
+    assert loaded.snapshot().shards is None
+    assert best(reopen(loaded).snapshot(), signals[4]) == "e"
+
+
+def test_parallel_add_songs_builds_the_same_index(db, songs, tmp_path, monkeypatch):
+    paths, _ = songs
+    contexts = []
+    get_context = multiprocessing.get_context
+    monkeypatch.setattr(
+        multiprocessing,
+        "get_context",
+        lambda method=None: contexts.append(method) or get_context(method),
+    )
+    # the duplicate is skipped, without shifting the song-IDs of those after it
+    files = list(paths[:4]) + [paths[1]] + list(paths[4:])
+    names = ["a", "b", "c", "d", "b", "e", "f"]
+    db.add_songs(files, names=names)
+
+    parallel = Database()
+    parallel.switch_db(Path(tmp_path) / "parallel_db")
+    parallel.add_songs(files, names=names, n_jobs=3)
+    assert contexts == ["spawn"]
+
+    assert parallel.snapshot().song_list == db.snapshot().song_list
+    expected, actual = db.index.flatten(), parallel.index.flatten()
+    for name in ("keys", "offsets", "song_ids", "times"):
+        np.testing.assert_array_equal(getattr(actual, name), getattr(expected, name))
+
+
+@pytest.mark.parametrize("legacy_mapping", [False, True])
+def test_convert_pickle_db(db, songs, tmp_path, legacy_mapping):
+    paths, signals = songs
+    db.add_songs(paths[:3], names=["a", "b", "c"], artists=["x", None, "z"])
+    snapshot = db.snapshot()
+
+    # the oldest databases pickled the (f1, f2, dt) -> [(song-ID, t1), ...] mapping
+    index = snapshot.index
+    if legacy_mapping:
+        index = defaultdict(list, postings(index))
+    pickled = Path(tmp_path) / "legacy.pkl"
+    with pickled.open("wb") as f:
+        pickle.dump(index, f)
+    with (Path(tmp_path) / "legacy_song_list.pkl").open("wb") as f:
+        pickle.dump(list(snapshot.song_list), f)
+
+    out_path = convert_pickle_db(pickled)
+    assert out_path == Path(tmp_path) / "legacy.fpdb"
+    converted = Database()
+    converted.switch_db(out_path)
+    assert converted.snapshot().song_list == snapshot.song_list
+    assert postings(converted.index) == postings(db.index)
+    for signal in signals[:3]:
+        assert best(converted.snapshot(), signal) == best(snapshot, signal)
+
+
+def test_save_reports_what_it_saved(db, songs, capsys):
+    paths, _ = songs
+    db.save()
+    assert db.path.is_file()
+    assert "Song database saved to" in capsys.readouterr().out
+    db.save()
+    assert capsys.readouterr().out == "No changes to song database to save\n"
+
+    db.add_songs(paths[:1], names=["a"])
+    capsys.readouterr()
+    db.save()
+    assert "Song database saved to" in capsys.readouterr().out
+    assert len(list_segments(db.path)) == 1
+    assert reopen(db).snapshot().song_list == db.snapshot().song_list
@@ -0,0 +1,157 @@
+import numpy as np
+import pytest
+
+from songfp.functions import (
+    PEAK_DTYPE,
+    CutoffSketch,
+    local_peak_array,
+    local_peaks,
+    pack_fingerprints,
+    peaks_to_fingerprint_arrays,
+    peaks_to_fingerprints,
+    peaks_to_hashes,
+    spectrogram_cutoff,
+)
+
+FLOOR = np.log(1e-20)
+
+
+def assert_same_peaks(log_spectrogram, amp_min, p_nn):
+    expected = local_peaks(log_spectrogram, amp_min, p_nn)
+    peaks = local_peak_array(log_spectrogram, amp_min, p_nn)
+    assert list(zip(peaks["t"].tolist(), peaks["f"].tolist())) == [
+        (int(t), int(f)) for t, f in expected
+    ]
+    return peaks
+
+
+@pytest.mark.parametrize("p_nn", [0, 1, 2, 3, 5, 20])
+@pytest.mark.parametrize("shape", [(1, 1), (7, 3), (64, 50), (129, 200)])
+def test_random_spectrograms(shape, p_nn):
+    rng = np.random.RandomState(sum(shape) + p_nn)
+    S = rng.randn(*shape)
+    for fraction in (0.0, 0.5, 0.9):
+        assert_same_peaks(S, np.quantile(S, fraction), p_nn)
+
+
+@pytest.mark.parametrize("p_nn", [1, 2, 20])
+def test_plateaus(p_nn):
+    # coarsely quantized intensities are full of ties between neighbors
+    rng = np.random.RandomState(p_nn)
+    S = rng.randint(0, 3, size=(65, 80)).astype(np.float64)
+    assert_same_peaks(S, 1.0, p_nn)
+
+
+@pytest.mark.parametrize("p_nn", [1, 20])
+def test_flat_spectrogram(p_nn):
+    S = np.full((33, 40), 2.5)
+    peaks = assert_same_peaks(S, 2.5, p_nn)
+    assert len(peaks) == S.size
+    assert not len(assert_same_peaks(S, 3.0, p_nn))
+
+
+@pytest.mark.parametrize("p_nn", [1, 20])
+def test_single_column_and_row(p_nn):
+    rng = np.random.RandomState(0)
+    assert_same_peaks(rng.randn(2049, 1), 0.0, p_nn)
+    assert_same_peaks(rng.randn(1, 300), 0.0, p_nn)
+
+
+@pytest.mark.parametrize("p_nn", [1, 20])
+def test_all_floor(p_nn):
+    # the spectrogram of digital silence
+    S = np.full((129, 30), FLOOR)
+    assert len(assert_same_peaks(S, FLOOR, p_nn)) == S.size
+    assert not len(assert_same_peaks(S, FLOOR + 1, p_nn))
+
+    # a tone amid silence
+    S[40, 10:20] = 3.0
+    assert_same_peaks(S, FLOOR, p_nn)
+    assert_same_peaks(S, 0.0, p_nn)
+
+
+def random_peaks(num_peaks, seed):
+    # sorted by time, then by frequency, as `local_peak_array` returns them
+    rng = np.random.RandomState(seed)
+    peaks = np.empty(num_peaks, dtype=PEAK_DTYPE)
+    peaks["t"] = rng.randint(0, 5000, size=num_peaks)
+    peaks["f"] = rng.randint(0, 2049, size=num_peaks)
+    return np.sort(peaks, order=["t", "f"])
+
+
+@pytest.mark.parametrize("fan_value", [1, 2, 5, 15, 40])
+@pytest.mark.parametrize("num_peaks", [0, 1, 2, 16, 500])
+def test_fingerprint_arrays_match_the_generator(num_peaks, fan_value):
+    peaks = random_peaks(num_peaks, seed=num_peaks + fan_value)
+    as_tuples = list(zip(peaks["t"].tolist(), peaks["f"].tolist()))
+    expected = list(peaks_to_fingerprints(as_tuples, fan_value))
+
+    for form in (peaks, as_tuples):
+        f1, f2, dt, t1 = peaks_to_fingerprint_arrays(form, fan_value)
+        actual = list(zip(zip(f1.tolist(), f2.tolist(), dt.tolist()), t1.tolist()))
+        assert actual == expected
+
+    hashes, times = peaks_to_hashes(peaks, fan_value)
+    if expected:
+        features, t1 = zip(*expected)
+        f1, f2, dt = zip(*features)
+        np.testing.assert_array_equal(hashes, pack_fingerprints(f1, f2, dt))
+        np.testing.assert_array_equal(times, t1)
+    else:
+        assert not len(hashes) and not len(times)
+
+
+def sorted_cutoff(log_spectrogram, frac_cut):
+    # the original cutoff, found by sorting (clamped, for frac_cut=1)
+    a = np.sort(log_spectrogram.flatten())
+    return a[min(int(len(a) * frac_cut), len(a) - 1)]
+
+
+def random_log_spectrogram(shape, seed):
+    # log-amplitudes like those of audio: a floor of silence, quantized ties, and
+    # a spread of values
+    rng = np.random.RandomState(seed)
+    S = rng.normal(10.0, 8.0, size=shape)
+    S[rng.rand(*shape) < 0.2] = FLOOR
+    ties = rng.rand(*shape) < 0.2
+    S[ties] = np.round(S[ties])
+    return S
+
+
+FRACTIONS = [0.0, 0.01, 0.5, 0.77, 0.9, 0.999, 1.0]
+
+
+@pytest.mark.parametrize("shape", [(1, 1), (1, 7), (2049, 1), (129, 200), (2049, 33)])
+def test_spectrogram_cutoff_matches_sorting(shape):
+    S = random_log_spectrogram(shape, seed=sum(shape))
+    for frac_cut in FRACTIONS:
+        assert spectrogram_cutoff(S, frac_cut) == sorted_cutoff(S, frac_cut)
+    S = np.full(shape, FLOOR)
+    assert spectrogram_cutoff(S, 0.77) == sorted_cutoff(S, 0.77) == FLOOR
+
+
+@pytest.mark.parametrize("num_bins", [2 ** 14, 2 ** 8, 16])
+@pytest.mark.parametrize("seed", range(3))
+def test_cutoff_sketch_error_is_under_one_bin(seed, num_bins):
+    S = random_log_spectrogram((513, 300), seed)
+    for frac_cut in FRACTIONS:
+        sketch = CutoffSketch(frac_cut, num_bins=num_bins)
+        for start in range(0, S.shape[1], 7):
+            sketch.update(S[:, start : start + 7])
+        assert sketch.size == S.size
+
+        exact = spectrogram_cutoff(S, frac_cut)
+        assert sketch.cutoff() <= exact < sketch.cutoff() + sketch.bin_width
+        # the exact cutoff lies in the sketch's bin, at the position that it reports
+        b, rank = sketch.cutoff_bin()
+        in_bin = np.sort(S[sketch.bins(S) == b])
+        assert in_bin[rank] == exact
+
+
+def test_cutoff_sketch_never_exceeds_out_of_range_cutoffs():
+    # amplitudes beyond `upper` share the last bin, which bounds them from below
+    S = random_log_spectrogram((257, 100), seed=0) + 100.0
+    for frac_cut in FRACTIONS:
+        sketch = CutoffSketch(frac_cut, upper=64.0)
+        sketch.update(S)
+        assert sketch.cutoff() <= spectrogram_cutoff(S, frac_cut)
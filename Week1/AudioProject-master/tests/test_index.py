@@ -0,0 +1,120 @@
+import numpy as np
+import pytest
+
+from songfp.database import FingerprintIndex
+from songfp.database._storage import read_database, write_database
+
+
+def random_postings(rng, num, num_keys=200, first_song=0, num_songs=5):
+    keys = rng.randint(0, num_keys, size=num).astype(np.uint64)
+    song_ids = rng.randint(first_song, first_song + num_songs, size=num)
+    times = rng.randint(0, 1000, size=num)
+    return keys, song_ids, times
+
+
+@pytest.fixture
+def layered(tmp_path):
+    """ A memory-mapped index with postings added to its overlay, and an in-memory
+    index with the same postings."""
+    rng = np.random.RandomState(0)
+    base = random_postings(rng, 2000)
+    added = random_postings(rng, 300, num_keys=250, first_song=5)
+
+    write_database(tmp_path / "base.fpdb", FingerprintIndex.from_postings(*base), [])
+    mapped = read_database(tmp_path / "base.fpdb")[0]
+    mapped.add(*added)
+
+    plain = FingerprintIndex.from_postings(*base)
+    plain.add(*added)
+    return mapped, plain
+
+
+def test_adding_to_a_mapped_index_leaves_it_mapped(layered):
+    mapped, _ = layered
+    assert isinstance(mapped.keys, np.memmap)
+    assert isinstance(mapped.song_ids, np.memmap)
+    assert mapped.overlay is not None and len(mapped.overlay) == 300
+
+
+@pytest.mark.parametrize("max_postings", [None, 12])
+def test_overlay_lookups_match_a_merged_index(layered, max_postings):
+    mapped, plain = layered
+    for index in (mapped, plain):
+        index.max_postings = max_postings
+        index.remove_songs([1, 6])
+    keys = np.arange(0, 260, dtype=np.uint64)[::-1]
+
+    for expected, actual in zip(plain.lookup(keys), mapped.lookup(keys)):
+        np.testing.assert_array_equal(expected, actual)
+    np.testing.assert_allclose(plain.idf(keys), mapped.idf(keys))
+    assert len(mapped) == len(plain)
+    assert mapped.num_keys == plain.num_keys
+    assert mapped.num_songs == plain.num_songs
+    assert mapped.num_dead == plain.num_dead
+    assert mapped.posting_stats() == plain.posting_stats()
+    assert list(mapped.items()) == list(plain.items())
+    assert mapped.get((0, 0, 3)) == plain.get((0, 0, 3))
+
+
+def test_flatten_and_compact_merge_the_overlay(layered):
+    mapped, plain = layered
+    flat = mapped.flatten()
+    assert flat.overlay is None
+    for name in ("keys", "offsets", "song_ids", "times"):
+        np.testing.assert_array_equal(getattr(flat, name), getattr(plain, name))
+
+    mapped.remove_song(6)
+    plain.remove_song(6)
+    mapped.compact()
+    plain.compact()
+    assert mapped.overlay is None
+    np.testing.assert_array_equal(mapped.song_ids, plain.song_ids)
+
+
+def test_snapshot_is_unaffected_by_overlay_additions(layered):
+    mapped, _ = layered
+    snapshot = mapped.snapshot()
+    key = np.array([7], dtype=np.uint64)
+    mapped.add(key, np.array([99]), np.array([1]))
+    assert len(snapshot) == len(mapped) - 1
+    assert 99 not in snapshot.lookup(key)[1]
+    assert 99 in mapped.lookup(key)[1]
+
+
+def test_max_postings_filters_lookups_only(layered, tmp_path, monkeypatch):
+    mapped, plain = layered
+    keys = np.arange(0, 260, dtype=np.uint64)
+    uncapped = mapped.lookup(keys)
+    lengths = mapped.posting_lengths()
+
+    mapped.max_postings = 12
+    num_ranges = []
+    ranges = FingerprintIndex._ranges
+    monkeypatch.setattr(
+        FingerprintIndex,
+        "_ranges",
+        lambda self, keys: num_ranges.append(1) or ranges(self, keys),
+    )
+    query, _, _ = mapped.lookup(keys)
+    # one range search of the mapped arrays and one of the overlay
+    assert len(num_ranges) == 2
+    monkeypatch.undo()
+    assert 0 < len(query) < len(uncapped[0])
+
+    # the capped keys' postings are stored, and saved, all the same
+    np.testing.assert_array_equal(mapped.posting_lengths(), lengths)
+    write_database(tmp_path / "capped.fpdb", mapped, [])
+    loaded = read_database(tmp_path / "capped.fpdb")[0]
+    assert loaded.max_postings == 12
+    np.testing.assert_array_equal(loaded.posting_lengths(), lengths)
+    loaded.max_postings = None
+    for expected, actual in zip(uncapped, loaded.lookup(keys)):
+        np.testing.assert_array_equal(expected, actual)
+
+
+def test_max_time_spans_the_overlay(layered):
+    mapped, plain = layered
+    assert mapped.max_time == plain.max_time == plain.times.max()
+    mapped.add(np.array([3], dtype=np.uint64), [9], [5000])
+    assert mapped.max_time == 5000
+    assert FingerprintIndex().max_time == -1
@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+
+import songfp
+from conftest import FS, clip
+from songfp import instrument
+from songfp.functions import (
+    digital_to_hashes,
+    digital_to_spec,
+    hashes_to_matches,
+    local_peak_array,
+)
+
+
+def test_disabled_instrumentation_is_a_no_op():
+    assert not instrument.enabled()
+    assert instrument.timer("peaks") is instrument.timer("lookup")
+    with instrument.timer("peaks"):
+        instrument.count("peaks", 3)
+
+    events = []
+    sink = instrument.attach(events.append)
+    assert instrument.enabled()
+    instrument.detach(sink)
+    assert not instrument.enabled()
+    with instrument.timer("peaks"):
+        instrument.count("peaks", 3)
+    assert events == []
+    with pytest.raises(AssertionError):
+        instrument.detach(sink)
+
+
+def test_sink_records_each_stage_of_a_match(db, songs):
+    paths, signals = songs
+    db.add_songs(paths[:3], names=["a", "b", "c"])
+    db.remove_song("a")
+    snapshot = db.snapshot()
+    sample = clip(signals[1])
+
+    # the work that each stage does, computed without instrumentation
+    params = snapshot.params
+    S, cutoff = digital_to_spec(sample, FS, params.frac_cut)
+    peaks = local_peak_array(S, cutoff, p_nn=params.p_nn)
+    hashes, times = digital_to_hashes(sample, FS, params)
+    index = snapshot.index
+    hit = np.isin(hashes, index.keys)
+    scanned = index.posting_lengths()[np.searchsorted(index.keys, hashes[hit])]
+    song_ids, _ = hashes_to_matches(hashes, times, index)
+
+    events = []
+    sink = instrument.attach(events.append)
+    try:
+        ranked = songfp._rank_sample(snapshot, sample, FS, 1, False, False)
+    finally:
+        instrument.detach(sink)
+    assert ranked[0].song_id == 1
+
+    timers = [event.name for event in events if event.kind == "time"]
+    assert timers == ["spectrogram", "peaks", "hashes", "lookup", "rank"]
+    assert all(event.value >= 0 for event in events)
+    counts = {event.name: event.value for event in events if event.kind == "count"}
+    assert counts == {
+        "peaks": len(peaks),
+        "hashes": len(hashes),
+        "hashes_hit": int(hit.sum()),
+        "postings_scanned": int(scanned.sum()),
+        "matches": len(song_ids),
+    }
+    # song "a" was removed: its postings are scanned, but are not matches
+    assert counts["matches"] < counts["postings_scanned"]
+
+
+def test_collect_tallies_each_stage(db, songs):
+    paths, signals = songs
+    db.add_songs(paths[:2], names=["a", "b"])
+    snapshot = db.snapshot()
+
+    with instrument.collect() as stats:
+        for signal in signals[:2]:
+            songfp._rank_sample(snapshot, clip(signal), FS, 1, False, False)
+    assert not instrument.enabled()
+
+    stages = ["spectrogram", "peaks", "hashes", "lookup", "rank"]
+    assert stats.calls == dict.fromkeys(stages, 2)
+    assert set(stats.seconds) == set(stages)
+    hashes = [digital_to_hashes(clip(s), FS, snapshot.params)[0] for s in signals[:2]]
+    assert stats.counts["hashes"] == sum(map(len, hashes))
+    assert stats.counts["matches"] <= stats.counts["postings_scanned"]
+    assert all(name in str(stats) for name in stages)
+
+    stats.reset()
+    assert stats.as_dict() == dict(seconds={}, calls={}, counts={})
@@ -0,0 +1,39 @@
+import numpy as np
+
+from conftest import FS, clip
+from songfp.functions import FingerprintParams, digital_to_spec, local_peak_array
+from songfp.multires import MultiResolutionIndex, _sample_peaks
+
+
+def test_multires_index_uses_its_params(songs):
+    _, signals = songs
+    params = FingerprintParams(
+        frac_cut=0.85, p_nn=12, fan_value=8, nfft=2048, noverlap=1024
+    )
+    index = MultiResolutionIndex(params=params)
+    for song_id, signal in enumerate(signals[:4]):
+        index.add_sample(signal, FS, song_id)
+
+    S, cutoff = digital_to_spec(signals[0], FS, 0.85, nfft=2048, noverlap=1024)
+    expected = local_peak_array(S, cutoff, p_nn=12)
+    assert np.array_equal(_sample_peaks(signals[0], FS, params), expected)
+
+    (best,) = index.rank_sample(clip(signals[3]), FS, k=1)
+    assert best.song_id == 3
+    # a clip that begins 2 s into the song
+    assert abs(best.offset - 2.0) <= index.offset_step * params.time_step(FS)
+
+
+def test_multires_index_matches_sped_up_recordings(songs):
+    _, signals = songs
+    index = MultiResolutionIndex()
+    for song_id, signal in enumerate(signals):
+        index.add_sample(signal, FS, song_id)
+
+    for song_id in (1, 4):
+        # played back 2% fast: every frequency rises, and every duration shrinks, by 2%
+        recording = clip(signals[song_id], duration=4.0)
+        t = np.arange(0, len(recording) - 1, 1.02)
+        sped_up = np.interp(t, np.arange(len(recording)), recording)
+        (best,) = index.rank_sample(sped_up, FS, k=1)
+        assert best.song_id == song_id
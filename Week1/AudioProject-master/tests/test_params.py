@@ -0,0 +1,87 @@
+import pytest
+
+import songfp
+from conftest import FS, clip
+from songfp.database._database import Database
+from songfp.database._storage import list_segments, read_database, write_database
+from songfp.functions import DEFAULT_PARAMS, FingerprintParams
+
+
+def reopen(db: Database) -> Database:
+    reopened = Database()
+    reopened.switch_db(db.path)
+    return reopened
+
+
+def test_database_without_params_accepts_segments(db, songs):
+    paths, signals = songs
+    db.add_songs(paths[:2], names=["a", "b"])
+    db.save()
+    # a database saved before the parameters were recorded in its header
+    index, song_list, header = read_database(db.path)
+    header.pop("params")
+    write_database(db.path, index.flatten(), song_list, metadata=header)
+    del index
+
+    legacy = reopen(db)
+    assert legacy.params == DEFAULT_PARAMS
+    legacy.add_songs(paths[2:3], names=["c"])
+    legacy.save()
+    assert len(list_segments(db.path)) == 1
+
+    loaded = reopen(legacy)
+    assert [name for name, _ in loaded.list_songs()] == ["a", "b", "c"]
+    snapshot = loaded.snapshot()
+    ranked = songfp._rank_sample(snapshot, clip(signals[2]), FS, 1, False, False)
+    assert ranked[0].song_id == 2
+
+
+PARAMS = FingerprintParams(
+    frac_cut=0.8, p_nn=15, fan_value=10, nfft=2048, noverlap=1024
+)
+
+
+def test_params_survive_save_and_load(db, songs):
+    paths, signals = songs
+    db.set_params(PARAMS)
+    db.add_songs(paths[:2], names=["a", "b"])
+    db.save()
+
+    loaded = reopen(db)
+    assert loaded.params == PARAMS
+    assert loaded.snapshot().params == PARAMS
+    snapshot = loaded.snapshot()
+    ranked = songfp._rank_sample(snapshot, clip(signals[1]), FS, 1, False, False)
+    assert ranked[0].song_id == 1
+
+
+def test_segments_inherit_params(db, songs):
+    paths, signals = songs
+    db.set_params(PARAMS)
+    db.add_songs(paths[:2], names=["a", "b"])
+    db.save()
+    loaded = reopen(db)
+    loaded.add_songs(paths[2:3], names=["c"])
+    loaded.save()
+
+    ((_, segment),) = list_segments(db.path)
+    assert FingerprintParams.from_dict(read_database(segment)[2]["params"]) == PARAMS
+    reloaded = reopen(loaded)
+    assert reloaded.params == PARAMS
+    snapshot = reloaded.snapshot()
+    ranked = songfp._rank_sample(snapshot, clip(signals[2]), FS, 1, False, False)
+    assert ranked[0].song_id == 2
+
+
+def test_set_params_is_refused_once_songs_are_added(db, songs):
+    paths, _ = songs
+    db.add_songs(paths[:1], names=["a"])
+    with pytest.raises(ValueError):
+        db.set_params(PARAMS)
+    # setting the current parameters is harmless
+    db.set_params(DEFAULT_PARAMS)
+    assert db.params == DEFAULT_PARAMS
+
+    db.remove_song("a")
+    db.set_params(PARAMS)
+    assert db.snapshot().params == PARAMS
@@ -0,0 +1,15 @@
+import pytest
+
+import songfp
+from conftest import synthetic_song
+
+
+def test_plot_song_uses_the_microphone_rate(db, monkeypatch):
+    pytest.importorskip("matplotlib")
+    context_managers = pytest.importorskip("microphone.context_managers")
+    monkeypatch.setattr("songfp.database.database", db)
+    monkeypatch.setattr(context_managers, "RATE", 22050)
+
+    fig, ax = songfp.plot_song(synthetic_song(0, duration=2.0, fs=22050), False)
+    # the spectrogram spans the signal's duration at the microphone's rate
+    assert ax.get_xlim()[1] == pytest.approx(2.0, rel=0.1)
@@ -0,0 +1,127 @@
+import numpy as np
+import pytest
+
+import songfp
+from conftest import FS, clip
+from songfp import instrument
+from songfp.database import FingerprintIndex
+from songfp.functions import (
+    batch_hashes_to_matches,
+    hashes_to_matches,
+    rank_hashes,
+    rank_matches,
+    weighted_hashes_to_matches,
+)
+
+
+def random_sample(seed, num_songs=30, num_keys=300, num_postings=20000, num_hashes=600):
+    # few distinct keys and offsets, so that songs share many hashes and scores tie
+    rng = np.random.RandomState(seed)
+    keys = rng.randint(0, num_keys, size=num_postings).astype(np.uint64)
+    song_ids = rng.randint(0, num_songs, size=num_postings)
+    times = rng.randint(0, 50, size=num_postings)
+    index = FingerprintIndex.from_postings(keys, song_ids, times)
+
+    hashes = rng.randint(0, num_keys + 50, size=num_hashes).astype(np.uint64)
+    sample_times = rng.randint(0, 20, size=num_hashes)
+    return hashes, sample_times, index
+
+
+def expected_ranking(hashes, times, index, k, idf):
+    if idf:
+        song_ids, offsets, weights, total = weighted_hashes_to_matches(
+            hashes, times, index
+        )
+        return rank_matches(song_ids, offsets, total, k=k, weights=weights)
+    song_ids, offsets = hashes_to_matches(hashes, times, index)
+    return rank_matches(song_ids, offsets, len(hashes), k=k)
+
+
+def assert_same_ranking(ranked, expected, idf, exact_margin=True):
+    assert [(m.song_id, m.offset) for m in ranked] == [
+        (m.song_id, m.offset) for m in expected
+    ]
+    for match, reference in zip(ranked, expected):
+        if idf:
+            assert match.votes == pytest.approx(reference.votes)
+            assert match.fraction == pytest.approx(reference.fraction)
+        else:
+            assert match.votes == reference.votes
+            assert match.fraction == reference.fraction
+        if exact_margin:
+            assert match.margin == pytest.approx(reference.margin)
+        else:
+            assert match.margin <= reference.margin + 1e-9
+
+
+@pytest.mark.parametrize("idf", [False, True])
+@pytest.mark.parametrize(
+    "sketch", [dict(), dict(sketch_width=1, sketch_depth=1), dict(sketch_width=4)]
+)
+@pytest.mark.parametrize("seed", range(4))
+def test_rank_hashes_matches_rank_matches(seed, sketch, idf):
+    hashes, times, index = random_sample(seed)
+    for k in (2, 5):
+        ranked = rank_hashes(
+            hashes, times, index, k, idf=idf, chunk_size=97, num_candidates=1, **sketch
+        )
+        assert_same_ranking(ranked, expected_ranking(hashes, times, index, k, idf), idf)
+
+
+@pytest.mark.parametrize("idf", [False, True])
+@pytest.mark.parametrize("seed", range(4))
+def test_rank_hashes_understates_the_margin_of_one(seed, idf):
+    hashes, times, index = random_sample(seed)
+    expected = expected_ranking(hashes, times, index, 1, idf)
+    for width in (4, 16, 2 ** 16):
+        ranked = rank_hashes(
+            hashes, times, index, 1, idf=idf, num_candidates=1, sketch_width=width
+        )
+        assert_same_ranking(ranked, expected, idf, exact_margin=False)
+
+    # a sketch of a single counter bounds every song by the number of matches, thus
+    # every song is scored exactly, and the margin is exact
+    ranked = rank_hashes(hashes, times, index, k=1, idf=idf, sketch_width=1)
+    assert_same_ranking(ranked, expected, idf)
+
+
+def test_rank_hashes_looks_up_each_hash_once():
+    hashes, times, index = random_sample(0)
+    with instrument.collect() as expected:
+        hashes_to_matches(hashes, times, index)
+    with instrument.collect() as stats:
+        # a tiny sketch forces the candidates to be expanded repeatedly
+        rank_hashes(hashes, times, index, num_candidates=1, sketch_width=1)
+    assert stats.counts == expected.counts
+
+
+@pytest.mark.parametrize("max_postings", [None, 30])
+def test_batch_lookup_matches_per_sample_lookups(max_postings):
+    hashes, times, index = random_sample(0)
+    index.remove_song(3)
+    index.max_postings = max_postings
+    # samples of various lengths - including none, and one - that share hashes
+    bounds = [0, 0, 1, 50, 50, 200, 600]
+    samples = [(hashes[a:b], times[a:b]) for a, b in zip(bounds[:-1], bounds[1:])]
+    samples.append((hashes[::-1], times[::-1]))
+
+    batched = batch_hashes_to_matches(*zip(*samples), index)
+    assert len(batched) == len(samples)
+    for (h, t), (song_ids, offsets) in zip(samples, batched):
+        expected_ids, expected_offsets = hashes_to_matches(h, t, index)
+        np.testing.assert_array_equal(song_ids, expected_ids)
+        np.testing.assert_array_equal(offsets, expected_offsets)
+    assert batch_hashes_to_matches([], [], index) == []
+
+
+def test_rank_samples_matches_rank_sample(db, songs):
+    paths, signals = songs
+    db.add_songs(paths[:4], names=list("abcd"))
+    snapshot = db.snapshot()
+    samples = [clip(signals[n], start=n + 1) for n in range(4)] + [signals[5][:100]]
+
+    expected = [
+        songfp._rank_sample(snapshot, sample, FS, 3, False, False) for sample in samples
+    ]
+    assert songfp._rank_samples(snapshot, samples, FS, 3) == expected
+    assert [ranked[0].song_id for ranked in expected[:4]] == [0, 1, 2, 3]
@@ -0,0 +1,116 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+import songfp.database
+from conftest import FS, clip
+from songfp.server import RecognitionServer, ServerClosed, recognize
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+@pytest.fixture
+def served(db, songs, monkeypatch):
+    """ The database that a `RecognitionServer()` serves, holding three songs."""
+    paths, _ = songs
+    db.add_songs(paths[:3], names=["a", "b", "c"])
+    monkeypatch.setattr(songfp.database, "database", db)
+    return db
+
+
+async def post(server, signal):
+    # the blocking client, off of the server's event loop
+    loop = asyncio.get_running_loop()
+    port = server.address[1]
+    return await loop.run_in_executor(None, lambda: recognize(signal, FS, port=port))
+
+
+def test_recognizes_over_http(served, songs):
+    _, signals = songs
+
+    async def main():
+        async with RecognitionServer(workers=0) as server:
+            await server.start(port=0)
+            return await post(server, clip(signals[1]))
+
+    matches = run(main())
+    assert matches[0]["name"] == "b"
+
+
+@pytest.mark.parametrize(
+    "target, body",
+    [
+        ("/recognize?k=0", np.zeros(FS, np.int16).tobytes()),
+        ("/recognize?k=five", np.zeros(FS, np.int16).tobytes()),
+        ("/recognize?fs=0", np.zeros(FS, np.int16).tobytes()),
+        ("/recognize?dtype=int8", np.zeros(FS, np.int16).tobytes()),
+        ("/recognize?dtype=float32", b"\x00" * 6),
+        ("/recognize", b""),
+        ("/recognize?format=file&suffix=.wav", b"not audio"),
+    ],
+)
+def test_bad_requests_are_rejected(served, target, body):
+    async def main():
+        async with RecognitionServer(workers=0) as server:
+            await server.start(port=0)
+            return await server._route("POST", target, body)
+
+    status, payload = run(main())
+    assert status == 400, payload
+
+
+def test_invalid_arguments_raise():
+    with pytest.raises(ValueError):
+        RecognitionServer(index=object(), song_list=[], max_batch=0)
+    with pytest.raises(ValueError):
+        RecognitionServer(index=object(), song_list=[], batch_delay=-1)
+    with pytest.raises(ValueError):
+        RecognitionServer(index=object())
+
+
+def test_songs_added_while_a_query_waits_are_matched(served, songs):
+    paths, signals = songs
+
+    async def main():
+        async with RecognitionServer(workers=0, batch_delay=3.0) as server:
+            await server.start(port=0)
+            # fingerprinted against a version of the database without the song
+            query = asyncio.ensure_future(
+                server.recognize(clip(signals[4]), fs=FS, k=1)
+            )
+            # the query is fingerprinted, and waits for others to be batched with
+            await asyncio.sleep(1.0)
+            assert not query.done()
+            served.add_songs(paths[4:5], names=["e"])
+            (match,) = await query
+            body = clip(signals[4]).astype(np.float32).tobytes()
+            target = "/recognize?fs={}&dtype=float32&k=1".format(FS)
+            status, payload = await server._route("POST", target, body)
+            return match, served.snapshot().song_list, payload
+
+    match, song_list, payload = run(main())
+    assert song_list[match.song_id][0] == "e"
+    assert payload["matches"][0]["name"] == "e"
+
+
+def test_close_fails_pending_queries(served, songs):
+    _, signals = songs
+
+    async def main():
+        server = RecognitionServer(workers=0, batch_delay=60.0)
+        await server.start(port=0)
+        queries = [
+            asyncio.ensure_future(server.recognize(clip(signals[0]), fs=FS))
+            for _ in range(2)
+        ]
+        # both queries are fingerprinted, and wait for others to be batched with
+        await asyncio.sleep(1.0)
+        assert not any(query.done() for query in queries)
+        await asyncio.wait_for(server.close(), 10)
+        return await asyncio.gather(*queries, return_exceptions=True)
+
+    results = run(main())
+    assert all(isinstance(result, ServerClosed) for result in results)
@@ -0,0 +1,109 @@
+import threading
+
+import numpy as np
+import pytest
+
+import songfp
+from conftest import FS, clip
+
+
+def test_snapshot_is_unaffected_by_later_writes(db, songs):
+    paths, signals = songs
+    db.add_songs(paths[:3], names=["a", "b", "c"])
+    snapshot = db.snapshot()
+    num_postings = len(snapshot.index)
+
+    db.add_songs(paths[3:], names=["d", "e", "f"])
+    db.remove_song("a")
+    db.compact(wait=True)
+
+    assert snapshot.song_list == (("a", None), ("b", None), ("c", None))
+    assert len(snapshot.index) == num_postings
+    ranked = songfp._rank_sample(snapshot, clip(signals[0]), FS, 1, False, False)
+    assert ranked[0].song_id == 0
+    assert db.snapshot().song_list[0] is None
+
+
+@pytest.mark.parametrize("processes", [False, True])
+def test_sharded_snapshot_survives_resharding(db, songs, processes):
+    paths, signals = songs
+    db.add_songs(paths[:4], names=["a", "b", "c", "d"])
+    db.shard(2, processes=processes)
+    snapshot = db.snapshot()
+    assert snapshot.shards is not None
+    before = songfp._rank_sample(snapshot, clip(signals[1]), FS, 3, False, False)
+    assert before[0].song_id == 1
+
+    # adding songs, or unsharding, discards the database's shards
+    db.add_songs(paths[4:], names=["e", "f"])
+    db.shard(2, processes=processes)
+    db.unshard()
+    assert db.snapshot().shards is None
+
+    after = songfp._rank_sample(snapshot, clip(signals[1]), FS, 3, False, False)
+    assert after == before
+
+
+def test_shards_are_closed_once_unreferenced(db, songs):
+    paths, _ = songs
+    db.add_songs(paths[:2], names=["a", "b"])
+    db.shard(2, processes=True)
+    shards = db.snapshot().shards
+    files = list(db.path.parent.glob("*.shard-*"))
+    assert len(files) == 2
+
+    db.unshard()
+    assert not shards.closed  # still referenced here
+    del shards
+    assert not any(path.exists() for path in files)
+
+
+def test_readers_match_while_writing(db, songs):
+    paths, signals = songs
+    db.add_songs(paths[:3], names=["a", "b", "c"])
+    db.shard(2, processes=False)
+    errors = []
+    stop = threading.Event()
+
+    def reader():
+        while not stop.is_set():
+            snapshot = db.snapshot()
+            try:
+                ranked = songfp._rank_sample(
+                    snapshot, clip(signals[2]), FS, 1, False, False
+                )
+                assert snapshot.song_list[ranked[0].song_id] == ("c", None)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=reader) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for n in range(3, 6):
+        db.add_songs(paths[n : n + 1], names=[str(n)])
+        db.shard(2, processes=False)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    assert not errors
+
+
+def test_merge_histograms_of_no_shards():
+    from songfp.database._shards import merge_histograms
+
+    song_ids, offsets, counts, first = merge_histograms([])
+    assert len(song_ids) == len(offsets) == len(counts) == len(first) == 0
+    assert np.issubdtype(counts.dtype, np.integer)
+
+
+@pytest.mark.parametrize("idf, bounded", [(True, False), (False, True)])
+def test_sharded_database_rejects_idf_and_bounded_ranking(db, songs, idf, bounded):
+    paths, signals = songs
+    db.add_songs(paths[:2], names=["a", "b"])
+    db.shard(2, processes=False)
+    with pytest.raises(ValueError):
+        songfp._rank_sample(db.snapshot(), clip(signals[0]), FS, 1, idf, bounded)
+
+    db.unshard()
+    ranked = songfp._rank_sample(db.snapshot(), clip(signals[0]), FS, 1, idf, bounded)
+    assert ranked[0].song_id == 0
@@ -0,0 +1,70 @@
+import matplotlib.mlab as mlab
+import numpy as np
+import pytest
+
+from conftest import FS, synthetic_song
+from songfp.functions import digital_to_spec
+from songfp.spectrogram import SpectrogramEngine
+
+FLOOR = np.log(1e-20)
+
+# mlab warns of signals no longer than a window, which it zero-pads
+pytestmark = pytest.mark.filterwarnings("ignore:Only one segment is calculated")
+
+
+def reference_spec(digital, fs, frac_cut, nfft=4096, noverlap=2048):
+    # the original `digital_to_spec`: `mlab.specgram`, and a cutoff found by sorting
+    if digital.max() <= 1:
+        digital = digital * 2 ** 15
+    S, _, _ = mlab.specgram(
+        digital, NFFT=nfft, Fs=fs, window=mlab.window_hanning, noverlap=noverlap
+    )
+    np.clip(S, a_min=1e-20, a_max=None, out=S)
+    np.log(S, out=S)
+    a = np.sort(S.flatten())
+    return S, a[int(len(a) * frac_cut)]
+
+
+def signals():
+    rng = np.random.RandomState(0)
+    song = synthetic_song(3, duration=3.0)
+    return {
+        # shorter than, as long as, and longer than a window
+        "short": song[:1000],
+        "one window": song[:4096],
+        "just over a window": song[:4097],
+        "song": song,
+        "pcm": np.round(song * 2 ** 15),
+        "noise": rng.uniform(-1, 1, size=FS // 2),
+    }
+
+
+@pytest.mark.parametrize("name", list(signals()))
+@pytest.mark.parametrize("nfft, noverlap", [(4096, 2048), (1024, 512), (1000, 250)])
+def test_spectrogram_matches_mlab(name, nfft, noverlap):
+    digital = signals()[name]
+    expected, expected_cutoff = reference_spec(digital, FS, 0.77, nfft, noverlap)
+    S, cutoff = digital_to_spec(digital, FS, 0.77, nfft=nfft, noverlap=noverlap)
+
+    assert S.shape == expected.shape
+    assert S.shape[1] == SpectrogramEngine(FS, nfft, noverlap).num_frames(len(digital))
+    # the FFTs differ only in their rounding: the log-amplitudes agree to ~1e-13,
+    # and to ~1e-11 for the faintest bins
+    np.testing.assert_allclose(S, expected, rtol=0, atol=1e-10)
+
+    # the cutoff is exactly the value of the same spectrogram bin as that selected by
+    # sorting mlab's spectrogram
+    k = int(S.size * 0.77)
+    position = np.argsort(expected, axis=None, kind="stable")[k]
+    assert np.argsort(S, axis=None, kind="stable")[k] == position
+    assert cutoff == S.flat[position] == np.sort(S, axis=None)[k]
+    assert cutoff == pytest.approx(expected_cutoff, rel=0, abs=1e-10)
+
+
+@pytest.mark.parametrize("length", [1, 100, 4095, 4096, 4097, 3 * 4096])
+def test_silence_matches_mlab(length):
+    digital = np.zeros(length)
+    expected, expected_cutoff = reference_spec(digital, FS, 0.77)
+    S, cutoff = digital_to_spec(digital, FS, 0.77)
+    np.testing.assert_array_equal(S, expected)
+    assert cutoff == expected_cutoff == FLOOR
@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+
+from conftest import FS
+from songfp.functions import rank_matches
+from songfp.streaming import StreamingRecognizer, _RunningHistogram
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_running_histogram_ranks_like_rank_matches(seed):
+    rng = np.random.RandomState(seed)
+    histogram = _RunningHistogram()
+    song_ids, offsets = [], []
+    for _ in range(20):
+        size = rng.randint(0, 200)
+        song_ids.append(rng.randint(0, 30, size))
+        offsets.append(rng.randint(-20, 20, size).astype(np.int32))
+        histogram.add(song_ids[-1], offsets[-1])
+
+        num_hashes = sum(map(len, song_ids)) + 1
+        expected = rank_matches(
+            np.concatenate(song_ids), np.concatenate(offsets), num_hashes, k=10
+        )
+        assert histogram.rank(num_hashes, k=10, time_step=1.0) == expected
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_pruned_histogram_ranks_like_rank_matches(seed):
+    # a stream many times longer than the songs, whose votes fall at song times
+    # in [0, max_time]: a pair can receive no more votes once its offset exceeds
+    # max_time less the sample time of the next batch
+    rng = np.random.RandomState(seed)
+    num_songs, max_time, batch_time = 20, 300, 7
+    histogram = _RunningHistogram()
+    song_ids, offsets, sizes = [], [], []
+    for start in range(0, 30 * max_time, batch_time):
+        size = rng.randint(0, 300)
+        sample_times = rng.randint(start, start + batch_time, size)
+        song_ids.append(rng.randint(0, num_songs, size))
+        offsets.append(rng.randint(0, max_time + 1, size) - sample_times)
+        histogram.add(song_ids[-1], offsets[-1].astype(np.int32))
+        histogram.prune(max_time - (start + batch_time))
+        sizes.append(len(histogram._slots))
+
+        if start % (10 * batch_time) == 0:
+            num_hashes = sum(map(len, song_ids)) + 1
+            expected = rank_matches(
+                np.concatenate(song_ids), np.concatenate(offsets), num_hashes, k=10
+            )
+            assert histogram.rank(num_hashes, k=10, time_step=1.0) == expected
+
+    # live pairs span about one song's length of offsets
+    bound = 2 * num_songs * (max_time + batch_time + 1)
+    assert max(sizes) <= max(bound, _RunningHistogram.MIN_PRUNE_SIZE)
+    assert len(np.unique(np.concatenate(offsets))) > 10 * (max_time + batch_time)
+
+
+def test_streaming_holds_bounded_state(db, songs):
+    paths, signals = songs
+    db.add_songs(paths[:4], names=["a", "b", "c", "d"])
+    index = db.snapshot().index
+    names = [name for name, _ in db.snapshot().song_list]
+
+    recognizer = StreamingRecognizer(index, FS)
+    pcm = (signals[2] * 2 ** 15).astype(np.int16)
+    widths = []
+    for start in range(0, len(pcm), 4096):
+        recognizer.feed(pcm[start : start + 4096])
+        widths.append(recognizer._spectrogram.shape[1])
+    assert names[recognizer.finish()[0].song_id] == "c"
+    assert recognizer.num_columns > 3 * max(widths)
+    assert max(widths) <= 2 * recognizer.p_nn + 4096 // 2048 + 1
+
+
+def test_pruning_leaves_the_ranking_unchanged(db, songs, monkeypatch):
+    paths, signals = songs
+    db.add_songs(paths[:3], names=["a", "b", "c"])
+    index = db.snapshot().index
+    # a stream longer than any song, so that many pairs can receive no more votes
+    pcm = (np.tile(signals[1], 3) * 2 ** 15).astype(np.int16)
+
+    def stream():
+        recognizer = StreamingRecognizer(index, FS, k=3)
+        rankings = [
+            recognizer.feed(pcm[n : n + 8192]) for n in range(0, len(pcm), 8192)
+        ]
+        return rankings + [recognizer.finish()], recognizer._histogram
+
+    monkeypatch.setattr(_RunningHistogram, "MIN_PRUNE_SIZE", 1)
+    pruned, histogram = stream()
+    monkeypatch.setattr(_RunningHistogram, "MIN_PRUNE_SIZE", np.inf)
+    expected, unpruned = stream()
+    assert pruned == expected
+    assert pruned[-1][0].song_id == 1
+    assert len(histogram._slots) < len(unpruned._slots)